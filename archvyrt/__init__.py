@@ -5,25 +5,63 @@ Libvirt provisioning for ArchLinux host system.
 """
 
 import argparse
+import concurrent.futures
+import glob
 import json
 import logging
 import os
+import sys
 
+import archvyrt.tools as tools
+from archvyrt.cache import BootstrapCache
+from archvyrt.cache import PackageCache
+from archvyrt.checkpoint import CheckpointJournal
 from archvyrt.domain import Domain
+from archvyrt.executor import RecordingExecutor
+from archvyrt.executor import ReplayExecutor
+from archvyrt.executor import SubprocessExecutor
+from archvyrt.libvirt import LibvirtConnection
+from archvyrt.nbd import NbdAllocator
+from archvyrt.numa import NumaPlacer
+from archvyrt.plan import check_plans
+from archvyrt.plan import compile_definition
 from archvyrt.provisioner import ArchlinuxProvisioner
 from archvyrt.provisioner import PlainProvisioner
 from archvyrt.provisioner import UbuntuProvisioner
+from archvyrt.timing import TimingReport
 from archvyrt.version import __version__
 
 LOG = logging.getLogger(__name__)
 
+# provisioners by guesttype
+PROVISIONERS = {
+    'archlinux': ArchlinuxProvisioner,
+    'ubuntu': UbuntuProvisioner,
+    'plain': PlainProvisioner,
+}
+
+
+def positive_int(value):
+    """
+    Argument type of positive integers, f.e. the number of jobs
+
+    :param value - Command line argument
+    """
+    try:
+        number = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError('invalid int value: %r' % value)
+    if number < 1:
+        raise argparse.ArgumentTypeError('must be at least 1, got %d' % number)
+    return number
+
 
 def main():
     """
     main function.
 
-    parse command line arguments, create VM and run the appropriate
-    provisioner
+    parse command line arguments, create VMs and run the appropriate
+    provisioners
     """
 
     parser = argparse.ArgumentParser(
@@ -31,6 +69,79 @@ def main():
         formatter_class=argparse.ArgumentDefaultsHelpFormatter,
         prog='archvyrt',
     )
+    parser.add_argument(
+        '--cache-dir',
+        dest='cachedir',
+        default=None,
+        help='Directory to cache bootstrapped guests in (disabled if unset)'
+    )
+    parser.add_argument(
+        '--cache-max-age',
+        dest='cachemaxage',
+        default=7,
+        type=int,
+        help='Days a cached bootstrap is reused before bootstrapping again, '
+             '0 never reuses cached bootstraps'
+    )
+    parser.add_argument(
+        '--cache-max-size',
+        dest='cachemaxsize',
+        default=10,
+        type=int,
+        help='Maximum size of the bootstrap cache in GB'
+    )
+    parser.add_argument(
+        '--refresh-cache',
+        dest='refreshcache',
+        action='store_true',
+        help='Ignore cached bootstraps and replace them with fresh ones'
+    )
+    parser.add_argument(
+        '--package-cache-dir',
+        dest='pkgcachedir',
+        default=None,
+        help='Host directory to share downloaded guest packages in '
+             '(disabled if unset)'
+    )
+    parser.add_argument(
+        '--package-cache-max-size',
+        dest='pkgcachemaxsize',
+        default=20,
+        type=int,
+        help='Maximum size of the package cache in GB'
+    )
+    parser.add_argument(
+        '--connect',
+        dest='libvirturl',
+        default=None,
+        help='Libvirt connection URI'
+    )
+    recording = parser.add_mutually_exclusive_group()
+    recording.add_argument(
+        '--record',
+        action='store_true',
+        help='Record all commands with their output and duration to '
+             '<vmdefinition>.recording.jsonl'
+    )
+    recording.add_argument(
+        '--replay',
+        action='store_true',
+        help='Replay commands from <vmdefinition>.recording.jsonl instead '
+             'of running them'
+    )
+    parser.add_argument(
+        '--replay-latency',
+        dest='replaylatency',
+        default=0.0,
+        type=float,
+        help='Factor applied to recorded command durations during replay'
+    )
+    parser.add_argument(
+        '--jobs',
+        default=1,
+        type=positive_int,
+        help='Number of VMs to provision concurrently'
+    )
     parser.add_argument(
         '--log-level',
         dest='loglevel',
@@ -41,7 +152,49 @@ def main():
     parser.add_argument(
         '--mountpoint',
         default='/provision',
-        help='Temporary mountpoint for provisioning'
+        help='Base directory for temporary provisioning mountpoints, '
+             'each VM is mounted in a subdirectory named after its fqdn'
+    )
+    parser.add_argument(
+        '--io-mode',
+        dest='iomode',
+        default='safe',
+        choices=('safe', 'fast'),
+        help='Cache mode of disks attached while provisioning: fast uses an '
+             'unsafe write-back cache, flushed before disconnecting'
+    )
+    parser.add_argument(
+        '--unsafe-io',
+        dest='unsafeio',
+        action='store_true',
+        help='Suppress fsync of the package manager in the guest while '
+             'installing, filesystems are synced once before unmounting'
+    )
+    parser.add_argument(
+        '--compact',
+        default=None,
+        choices=('sparse', 'compressed'),
+        help='Compact volumes once provisioned: trim the filesystems and '
+             'rewrite the images sparse, or additionally compressed'
+    )
+    parser.add_argument(
+        '--numa',
+        action='store_true',
+        help='Pin each new VM to a single NUMA node of the host, with '
+             'dedicated cpus and hugepages of that node'
+    )
+    parser.add_argument(
+        '--resume',
+        action='store_true',
+        help='Resume VMs left behind by a failed run from their last '
+             'checkpoint (<vmdefinition>.checkpoint.json)'
+    )
+    parser.add_argument(
+        '--timing-report',
+        dest='timingreport',
+        default=None,
+        help='Write timing reports of all VMs to this file, instead of '
+             '<vmdefinition>.timing.json next to each VM definition'
     )
     parser.add_argument(
         '--version',
@@ -50,40 +203,218 @@ def main():
     )
     parser.add_argument(
         'vmdefinition',
-        help='Path to VM definition file'
+        nargs='+',
+        help='Path to VM definition file or directory of definition files'
     )
     args = parser.parse_args()
 
+    log_format = '%(asctime)s - %(levelname)s - %(message)s'
+    if args.jobs > 1:
+        log_format = '%(asctime)s - %(threadName)s - %(levelname)s - %(message)s'
     logging.basicConfig(level=logging.getLevelName(args.loglevel.upper()),
-                        format='%(asctime)s - %(levelname)s - %(message)s')
+                        format=log_format)
 
-    with open(args.vmdefinition) as jsonfile:
-        domain = Domain(json.load(jsonfile))
+    if args.cachemaxage < 0:
+        parser.error('--cache-max-age must not be negative')
+    cache = None
+    if args.cachedir and args.cachemaxage == 0:
+        LOG.info('Bootstrap cache disabled, cached bootstraps are never '
+                 'reused')
+    elif args.cachedir:
+        cache = BootstrapCache(
+            args.cachedir,
+            max_age=args.cachemaxage,
+            max_size=args.cachemaxsize,
+            refresh=args.refreshcache
+        )
 
+    pkgcache = None
+    if args.pkgcachedir:
+        pkgcache = PackageCache(
+            args.pkgcachedir,
+            max_size=args.pkgcachemaxsize
+        )
+
+    definitions = []
+    for path in args.vmdefinition:
+        if os.path.isdir(path):
+            definitions.extend(sorted(glob.glob(os.path.join(path, '*.json'))))
+        else:
+            definitions.append(path)
+    if not definitions:
+        parser.error('No VM definitions found')
+
+    journals = {}
+    for path in definitions:
+        journals[path] = CheckpointJournal(
+            '%s.checkpoint.json' % os.path.splitext(path)[0]
+        )
+        if journals[path].exists and not args.resume:
+            LOG.warning('Discard checkpoint journal %s, not resuming',
+                        journals[path].path)
+            journals[path].discard()
+            journals[path] = CheckpointJournal(journals[path].path)
+
+    # validate everything before the first volume is created
+    plans = {}
+    problems = []
+    for path in definitions:
+        try:
+            with open(path) as jsonfile:
+                plans[path] = compile_definition(json.load(jsonfile), path)
+        except (OSError, ValueError) as exc:
+            problems.append('Cannot read %s: %s' % (path, exc))
+        except RuntimeError as exc:
+            problems.append(str(exc))
+    preloads = [plan.fqdn for plan in plans.values()
+                if PROVISIONERS[plan.guesttype].UNSAFE_IO_PRELOAD]
+    if args.unsafeio and preloads and not os.path.exists(tools.LIBEATMYDATA):
+        problems.append('Unsafe io of %s requires %s (libeatmydata)'
+                        % (', '.join(preloads), tools.LIBEATMYDATA))
+    if not problems:
+        try:
+            check_plans(LibvirtConnection.get(args.libvirturl),
+                        list(plans.values()),
+                        [journal.fqdn for journal in journals.values()
+                         if journal.exists])
+        except RuntimeError as exc:
+            problems.append(str(exc))
+    if problems:
+        for problem in problems:
+            LOG.error(problem)
+        sys.exit(1)
+
+    provisioner_args = {
+        'cache': cache,
+        'nbd': NbdAllocator.simulated() if args.replay else NbdAllocator(),
+        'pkgcache': pkgcache,
+        'io_mode': args.iomode,
+        'unsafe_io': args.unsafeio,
+        'compact': args.compact,
+    }
+    placer = None
+    if args.numa:
+        placer = NumaPlacer.from_connection(
+            LibvirtConnection.get(args.libvirturl)
+        )
+    timings = {path: TimingReport(path) for path in definitions}
+    executors = {}
+    for path in definitions:
+        recording = '%s.recording.jsonl' % os.path.splitext(path)[0]
+        if args.record:
+            executors[path] = RecordingExecutor(recording)
+        elif args.replay:
+            executors[path] = ReplayExecutor(recording,
+                                             latency=args.replaylatency)
+        else:
+            executors[path] = SubprocessExecutor()
+    os.makedirs(args.mountpoint, exist_ok=True)
+    results = {}
+    with concurrent.futures.ThreadPoolExecutor(
+            args.jobs, thread_name_prefix='provision') as executor:
+        futures = {
+            executor.submit(provision, plans[path], args.mountpoint,
+                            timings[path], executors[path],
+                            args.libvirturl, journals[path], placer,
+                            **provisioner_args): path
+            for path in definitions
+        }
+        for future in concurrent.futures.as_completed(futures):
+            path = futures[future]
+            try:
+                future.result()
+                results[path] = None
+            except Exception as exc:  # pylint: disable=broad-except
+                LOG.exception('Provisioning of %s failed', path)
+                results[path] = exc
+    provisioner_args['nbd'].release_all()
+    LibvirtConnection.close_all()
+    try:
+        os.rmdir(args.mountpoint)
+    except OSError:
+        pass
+
+    if args.timingreport:
+        TimingReport.write(
+            args.timingreport,
+            [timings[path].as_dict() for path in definitions]
+        )
+    else:
+        for path in definitions:
+            TimingReport.write(
+                '%s.timing.json' % os.path.splitext(path)[0],
+                timings[path].as_dict()
+            )
+
+    LOG.info('Provisioning summary:')
+    for path in definitions:
+        if results[path] is None:
+            LOG.info('  %s: success', path)
+        else:
+            LOG.error('  %s: failed (%s)', path, results[path])
+    if any(result is not None for result in results.values()):
+        sys.exit(1)
+
+
+# pylint: disable=too-many-arguments
+def provision(plan, mountpoint, timing, executor, libvirt_url=None,
+              journal=None, placer=None, **kwargs):
+    """
+    Create and provision a single VM
+
+    :param plan - Compiled VM definition (see archvyrt.plan)
+    :param mountpoint - Base directory for temporary provisioning mountpoints
+    :param timing - TimingReport to record phases and commands in
+    :param executor - Executor running commands and file operations
+    :param libvirt_url - URL for libvirt connection
+    :param journal - CheckpointJournal, resumes the VM if it exists
+    :param placer - NumaPlacer to pin the VM to a host NUMA node
+    :param kwargs - Additional arguments for linux provisioners
+    """
+    existing = journal is not None and journal.exists
+    if journal is not None and plan.guesttype != 'plain':
+        # record the domain before creating it, so a failure is resumable
+        journal.start(plan.fqdn)
+    else:
+        journal = None
+    with timing.phase('define'):
+        domain = Domain(plan, libvirt_url, existing=existing, placer=placer,
+                        timing=timing, executor=executor)
+    timing.domain = domain.fqdn
+
+    target = os.path.join(mountpoint, domain.fqdn)
     if domain.guesttype == 'archlinux':
-        os.mkdir(args.mountpoint)
-        provisioner = ArchlinuxProvisioner(domain)
+        os.makedirs(target, exist_ok=True)
+        provisioner = ArchlinuxProvisioner(domain, target,
+                                           timing=timing, executor=executor,
+                                           journal=journal, **kwargs)
         provisioner.cleanup()
-        domain.autostart(True)
-        LOG.info('Enabled %s autostart', domain.fqdn)
-        domain.start()
-        LOG.info('Started domain %s', domain.fqdn)
-        os.rmdir(args.mountpoint)
+        with timing.phase('start'):
+            domain.autostart(True)
+            LOG.info('Enabled %s autostart', domain.fqdn)
+            domain.start()
+            LOG.info('Started domain %s', domain.fqdn)
+        os.rmdir(target)
     elif domain.guesttype == 'ubuntu':
-        os.mkdir(args.mountpoint)
-        provisioner = UbuntuProvisioner(domain)
+        os.makedirs(target, exist_ok=True)
+        provisioner = UbuntuProvisioner(domain, target,
+                                        timing=timing, executor=executor,
+                                        journal=journal, **kwargs)
         provisioner.cleanup()
-        domain.autostart(True)
-        LOG.info('Enabled %s autostart', domain.fqdn)
-        domain.start()
-        LOG.info('Started domain %s', domain.fqdn)
-        os.rmdir(args.mountpoint)
+        with timing.phase('start'):
+            domain.autostart(True)
+            LOG.info('Enabled %s autostart', domain.fqdn)
+            domain.start()
+            LOG.info('Started domain %s', domain.fqdn)
+        os.rmdir(target)
     elif domain.guesttype == 'plain':
-        provisioner = PlainProvisioner(domain)
+        provisioner = PlainProvisioner(domain, timing=timing, executor=executor)
         provisioner.cleanup()
         domain.autostart(True)
         LOG.info('Enabled %s autostart', domain.fqdn)
     else:
         raise RuntimeError('Unsupported guest type: %s' % domain.guesttype)
 
-    LOG.info('Provisioning of %s (%s) completed', domain.fqdn, domain.guesttype)
+    timing.libvirt_calls = domain.rpc_count
+    LOG.info('Provisioning of %s (%s) completed, %d libvirt calls',
+             domain.fqdn, domain.guesttype, domain.rpc_count)
@@ -0,0 +1,274 @@
+"""archvyrt cache module"""
+
+# stdlib
+import contextlib
+import fcntl
+import hashlib
+import logging
+import os
+import threading
+import time
+
+LOG = logging.getLogger(__name__)
+
+
+class BootstrapCache:
+    """
+    Cache of bootstrapped guest root filesystems
+
+    Each entry is a compressed tar archive of a freshly bootstrapped target,
+    keyed by guest type, release, package set and freshness window.
+    """
+
+    def __init__(self, path, max_age=7, max_size=10, refresh=False):
+        """
+        Initialize bootstrap cache
+
+        :param path - Directory holding the cached archives
+        :param max_age - Freshness window in days, at least one
+        :param max_size - Maximum total size of the cache in GB
+        :param refresh - Ignore existing entries and bootstrap again
+        """
+        if int(max_age) < 1:
+            raise RuntimeError('Bootstrap cache max age must be at least '
+                               'one day, got %s' % max_age)
+        self._path = path
+        self._max_age = int(max_age) * 86400
+        self._max_size = int(max_size) * 1073741824
+        self._refresh = refresh
+        self._refreshed = set()
+        self._pending = {}
+        self._lock = threading.Lock()
+        os.makedirs(self._path, exist_ok=True)
+
+    def key(self, guesttype, release, packages):
+        """
+        Cache key for a bootstrap
+
+        :param guesttype - Type of guest (archlinux, ubuntu, ...)
+        :param release - Release of the guest distribution
+        :param packages - Packages installed by the bootstrap
+        """
+        digest = hashlib.sha256(
+            ' '.join(sorted(packages)).encode()
+        ).hexdigest()[:16]
+        window = int(time.time() // self._max_age)
+        return '%s-%s-%s-%d' % (guesttype, release, digest, window)
+
+    def archive(self, key):
+        """
+        Path to the archive of a cache entry
+        """
+        return os.path.join(self._path, '%s.tar.gz' % key)
+
+    def lookup(self, key):
+        """
+        Lookup a cache entry
+
+        Returns the path to the archive, or None on a cache miss. The caller
+        of a miss is expected to commit() or abandon() the entry, concurrent
+        lookups of the same entry wait for that. With refresh, each entry is
+        refreshed once per run.
+        """
+        self.evict()
+        archive = self.archive(key)
+        while True:
+            with self._lock:
+                pending = self._pending.get(key)
+                if pending is None:
+                    if self._refresh and key not in self._refreshed:
+                        LOG.info('Bootstrap cache refresh requested for %s',
+                                 key)
+                    elif os.path.isfile(archive):
+                        LOG.info('Bootstrap cache hit for %s', key)
+                        return archive
+                    else:
+                        LOG.info('Bootstrap cache miss for %s', key)
+                    self._refreshed.add(key)
+                    self._pending[key] = threading.Event()
+                    return None
+            LOG.info('Wait for bootstrap cache entry %s', key)
+            pending.wait()
+
+    def abandon(self, key):
+        """
+        Give up on writing a cache entry after a miss, f.e. if the bootstrap
+        failed
+        """
+        try:
+            os.remove(self.partial(key))
+        except OSError:
+            pass
+        with self._lock:
+            pending = self._pending.pop(key, None)
+        if pending is not None:
+            pending.set()
+
+    def commit(self, key):
+        """
+        Publish a freshly written cache entry
+
+        The archive is expected to be written to the path returned by
+        partial(), it is moved in place atomically.
+        """
+        os.rename(self.partial(key), self.archive(key))
+        LOG.info('Stored bootstrap cache entry %s', key)
+        with self._lock:
+            pending = self._pending.pop(key, None)
+        if pending is not None:
+            pending.set()
+        self.evict()
+
+    def partial(self, key):
+        """
+        Path to write a new cache entry to, before it is committed
+
+        The path is unique per thread, so concurrent provisioning runs
+        bootstrapping the same entry do not clobber each other.
+        """
+        return '%s.%d.%d.part' % (self.archive(key),
+                                  os.getpid(),
+                                  threading.get_ident())
+
+    def evict(self):
+        """
+        Remove expired entries and enforce the maximum cache size
+
+        Oldest entries are removed first, until the cache fits.
+        """
+        with self._lock:
+            self._evict()
+
+    def _evict(self):
+        """
+        Eviction, expects the cache lock to be held
+        """
+        now = time.time()
+        entries = []
+        for name in os.listdir(self._path):
+            if not name.endswith('.tar.gz'):
+                continue
+            path = os.path.join(self._path, name)
+            stat = os.stat(path)
+            if now - stat.st_mtime > self._max_age:
+                LOG.info('Evict expired bootstrap cache entry %s', name)
+                os.remove(path)
+            else:
+                entries.append((stat.st_mtime, stat.st_size, path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self._max_size:
+                break
+            LOG.info('Evict bootstrap cache entry %s (cache size %d bytes)',
+                     os.path.basename(path), total)
+            os.remove(path)
+            total -= size
+
+
+class PackageCache:
+    """
+    Host-side cache of downloaded guest packages
+
+    The cache directory of each guest type is bind-mounted into the guest
+    during installation, so packages downloaded once are reused by later
+    provisioning runs. The least recently used packages are pruned, once the
+    cache grows beyond its maximum size.
+    """
+
+    def __init__(self, path, max_size=20):
+        """
+        Initialize package cache
+
+        :param path - Directory holding the cached packages
+        :param max_size - Maximum total size of the cache in GB
+        """
+        self._path = path
+        self._max_size = int(max_size) * 1073741824
+        self._lock = threading.Lock()
+
+    def directory(self, guesttype):
+        """
+        Cache directory for a guest type
+
+        :param guesttype - Type of guest (archlinux, ubuntu, ...)
+        """
+        path = os.path.join(self._path, guesttype)
+        os.makedirs(path, exist_ok=True)
+        return path
+
+    @contextlib.contextmanager
+    def lock(self, guesttype):
+        """
+        Context manager holding the host-wide lock of the cache directory of
+        a guest type
+
+        Package managers of concurrent provisioning runs must not download
+        into the same directory at once (f.e. apt-get fails on its lock
+        file, pacman writes the same partial files).
+
+        :param guesttype - Type of guest (archlinux, ubuntu, ...)
+        """
+        os.makedirs(self._path, exist_ok=True)
+        path = os.path.join(self._path, '.%s.lock' % guesttype)
+        with open(path, 'w') as lockfile:
+            try:
+                fcntl.flock(lockfile, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                LOG.info('Wait for package cache %s in use', guesttype)
+                fcntl.flock(lockfile, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lockfile, fcntl.LOCK_UN)
+
+    def snapshot(self, guesttype):
+        """
+        Packages currently in the cache of a guest type
+        """
+        return set(os.listdir(self.directory(guesttype)))
+
+    def report(self, guesttype, before, prefixes):
+        """
+        Report cache hits and downloads of a provisioning run
+
+        Packages used by the run are marked as recently used, afterwards
+        the cache is pruned.
+
+        :param guesttype - Type of guest (archlinux, ubuntu, ...)
+        :param before - Result of snapshot() before the run
+        :param prefixes - Filename prefixes of the packages installed
+        """
+        directory = self.directory(guesttype)
+        prefixes = tuple(prefixes)
+        used = [name for name in os.listdir(directory)
+                if name.startswith(prefixes)]
+        hits = len([name for name in used if name in before])
+        downloads = len(used) - hits
+        now = time.time()
+        for name in used:
+            os.utime(os.path.join(directory, name), (now, now))
+        LOG.info('Package cache %s: %d hits, %d downloads',
+                 guesttype, hits, downloads)
+        self.prune()
+        return hits, downloads
+
+    def prune(self):
+        """
+        Remove least recently used packages beyond the maximum cache size
+        """
+        with self._lock:
+            entries = []
+            for root, _, files in os.walk(self._path):
+                for name in files:
+                    if name.endswith('.lock') and name.startswith('.'):
+                        continue
+                    path = os.path.join(root, name)
+                    stat = os.stat(path)
+                    entries.append((stat.st_mtime, stat.st_size, path))
+            total = sum(size for _, size, _ in entries)
+            for _, size, path in sorted(entries):
+                if total <= self._max_size:
+                    break
+                LOG.debug('Prune cached package %s', path)
+                os.remove(path)
+                total -= size
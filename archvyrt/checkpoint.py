@@ -0,0 +1,124 @@
+"""archvyrt checkpoint module"""
+
+# stdlib
+import json
+import logging
+import os
+import threading
+
+LOG = logging.getLogger(__name__)
+
+
+class CheckpointJournal:
+    """
+    Journal of completed provisioning phases and disk snapshots
+
+    The journal is rewritten atomically after each change, so an aborted run
+    can be resumed from its last snapshot.
+    """
+
+    def __init__(self, path):
+        """
+        Initialize journal, loading it if it exists
+
+        :param path - Path of the journal file
+        """
+        self.path = path
+        self._lock = threading.Lock()
+        self._data = {'fqdn': None, 'phases': [], 'snapshots': []}
+        if os.path.exists(path):
+            with open(path) as fobj:
+                self._data = json.load(fobj)
+
+    @property
+    def exists(self):
+        """
+        Whether a previous run left this journal behind
+        """
+        return os.path.exists(self.path)
+
+    @property
+    def fqdn(self):
+        """
+        FQDN of the domain being provisioned
+        """
+        return self._data['fqdn']
+
+    @property
+    def snapshots(self):
+        """
+        Names of all disk snapshots taken
+        """
+        return [snapshot['name'] for snapshot in self._data['snapshots']]
+
+    @property
+    def snapshot(self):
+        """
+        Latest disk snapshot, with the phases completed when it was taken
+        """
+        if self._data['snapshots']:
+            return self._data['snapshots'][-1]
+        return None
+
+    def start(self, fqdn):
+        """
+        Start recording a provisioning run
+
+        Phases completed after the latest snapshot are forgotten, as the
+        disks will be reverted to that snapshot.
+
+        :param fqdn - FQDN of the domain being provisioned
+        """
+        with self._lock:
+            self._data['fqdn'] = fqdn
+            if self._data['snapshots']:
+                self._data['phases'] = list(
+                    self._data['snapshots'][-1]['phases']
+                )
+            else:
+                self._data['phases'] = []
+            self._write()
+
+    def complete(self, phase):
+        """
+        Record a completed phase
+
+        :param phase - Name of the phase
+        """
+        with self._lock:
+            if phase not in self._data['phases']:
+                self._data['phases'].append(phase)
+            self._write()
+
+    def snapshot_taken(self, name):
+        """
+        Record a disk snapshot, covering all phases completed so far
+
+        :param name - Name of the qcow2 snapshot
+        """
+        with self._lock:
+            self._data['snapshots'].append({
+                'name': name,
+                'phases': list(self._data['phases']),
+            })
+            self._write()
+
+    def discard(self):
+        """
+        Remove the journal, once provisioning completed
+        """
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+    def _write(self):
+        """
+        Write the journal atomically
+        """
+        partial = '%s.partial' % self.path
+        with open(partial, 'w') as fobj:
+            json.dump(self._data, fobj, indent=2)
+            fobj.write('\n')
+        os.replace(partial, self.path)
+        LOG.debug('Checkpoint journal %s: %s', self.path, self._data['phases'])
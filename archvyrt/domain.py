@@ -1,14 +1,21 @@
 """archvyrt domain module"""
 
 # stdlib
+import asyncio
+import concurrent.futures
+import contextvars
 import logging
 # 3rd-party
 import libvirt
 # archvyrt
+from archvyrt.executor import SubprocessExecutor
+from archvyrt.libvirt import LibvirtConnection
 from archvyrt.libvirt import LibvirtDomain
 from archvyrt.libvirt import LibvirtDisk
 from archvyrt.libvirt import LibvirtNetwork
 from archvyrt.libvirt import LibvirtRng
+from archvyrt.plan import template_volumes
+from archvyrt.timing import TimingReport
 
 LOG = logging.getLogger(__name__)
 
@@ -18,61 +25,183 @@ class Domain:
     High-level domain object
     """
 
-    def __init__(self, domain_info, libvirt_url=None):
+    # pylint: disable=too-many-arguments
+    def __init__(self, plan, libvirt_url=None, existing=False, placer=None,
+                 timing=None, executor=None):
         """
         Initialize libvirt domain
 
-        :param domain_info - JSON definition of domain
+        :param plan - Compiled definition of domain (see archvyrt.plan)
         :param libvirt_url - URL for libvirt connection
-        """
-        self._conn = libvirt.open(libvirt_url)
-        self._domain_info = domain_info
+        :param existing - Reuse domain and volumes left by a previous run
+        :param placer - NumaPlacer to pin the domain to a host NUMA node,
+                        applies to the dedicated memory profile only
+        :param timing - TimingReport to record commands in
+        :param executor - Executor running commands, f.e. to preallocate
+                          volumes
+        """
+        self._conn = LibvirtConnection.get(libvirt_url)
+        self._timing = timing if timing is not None else TimingReport(None)
+        self._executor = (executor if executor is not None
+                          else SubprocessExecutor())
+        self._handle = None
+        self._generation = None
+        self.rpc_count = 0
+        self._plan = plan
+        self._existing = existing
         self._domain = LibvirtDomain(self.fqdn)
-        self._domain.memory = int(self.memory)
-        self._domain.vcpu = int(self.vcpu)
+        self._domain.machine = plan.machine
+        # recorded for vms cloned from this one later on
+        self._domain.guesttype = plan.guesttype
+        self._domain.memory = self.memory
+        self._domain.vcpu = self.vcpu
+        self._domain.set_memory_profile(plan.memory_profile)
+        self._domain.set_cpu(
+            plan.cpu.mode,
+            plan.cpu.model,
+            plan.cpu.features,
+            plan.cpu.sockets,
+            plan.cpu.cores,
+            plan.cpu.threads
+        )
         self._disks = []
         self._init_disks()
         self._networks = []
         self._init_networks()
         self._init_rng()
-        self._conn.defineXML(str(self._domain))
-        self._domain.xml = self._conn.lookupByName(self.fqdn).XMLDesc()
+        if existing:
+            try:
+                # keep the previous definition, f.e. its mac addresses
+                self._domain.xml = self._call('XMLDesc')
+                LOG.info('Reuse domain %s', self.fqdn)
+                return
+            except libvirt.libvirtError:
+                self._handle = None
+        # overcommitted domains float, they have no dedicated resources
+        if placer is not None and plan.memory_profile == 'dedicated':
+            self._domain.set_placement(placer.place(self.vcpu, self.memory))
+        self.rpc_count += 1
+        self._handle = self._conn.defineXML(self._domain.compact())
+        self._generation = self._conn.generation
+        self._domain.xml = self._call('XMLDesc')
         LOG.info('New domain %s', self.fqdn)
-        LOG.debug(
-            'Define new domain %s: %s',
-            self.fqdn,
-            str(self._domain).replace('\n', ' ').replace('\r', '')
-        )
+        if LOG.isEnabledFor(logging.DEBUG):
+            LOG.debug('Define new domain %s: %s',
+                      self.fqdn, self._domain.compact())
 
-    def __del__(self):
+    @property
+    def handle(self):
         """
-        Make sure to cleanup connection when object is destroyed
+        Cached libvirt domain handle
+
+        Looked up again after undefine or when the connection was renewed.
+        """
+        if self._handle is None or self._generation != self._conn.generation:
+            self.rpc_count += 1
+            self._handle = self._conn.lookupByName(self.fqdn)
+            self._generation = self._conn.generation
+        return self._handle
+
+    def _call(self, method, *args):
         """
+        Call a method of the libvirt domain, retry once if the connection
+        was lost meanwhile
+
+        :param method - Name of the virDomain method
+        :param args - Arguments for the method
+        """
+        self.rpc_count += 1
+        self._conn.count()
         try:
-            if self._conn:
-                try:
-                    self._conn.close()
-                except libvirt.libvirtError:
-                    pass
+            return getattr(self.handle, method)(*args)
         except libvirt.libvirtError:
-            pass
+            if not self._conn.lost():
+                raise
+        self.rpc_count += 1
+        self._conn.count()
+        return getattr(self.handle, method)(*args)
+
+    def _run(self, *cmds):
+        """
+        Run a unix command through the executor, blocking until it is
+        completed
+
+        The command is recorded in the timing report.
+
+        :param cmds - Command line
+        """
+        LOG.debug('Run command: %s', ' '.join(cmds))
+        result = asyncio.run(self._executor.execute(cmds))
+        self._timing.command(
+            cmds,
+            result.wall,
+            result.cpu_user,
+            result.cpu_system,
+            result.returncode
+        )
+        if result.returncode != 0:
+            raise RuntimeError('Command %s failed' % ' '.join(cmds))
 
     def _init_disks(self):
         """
         Initialize disks
 
-        will create libvirt disks and attach them to the domain
-        """
-        for alias, details in sorted(self._domain_info['disks'].items()):
-            disk_name = '%s-%s' % (self.fqdn, alias)
-            self._disks.append(
-                LibvirtDisk(
+        will create libvirt disks and attach them to the domain, cloned
+        from the template if the plan names one. Disks are spread across
+        the iothreads of the domain, scsi disks share one controller.
+        """
+        disks = self._plan.disks
+        sources = {}
+        template = self._plan.template
+        if template is not None:
+            sources = template_volumes(self._conn, template.domain)
+            # lookup and XMLDesc of the template, a lookup per volume
+            self.rpc_count += 2 + len(sources)
+        # volumes are created concurrently, preallocation may take a while
+        with concurrent.futures.ThreadPoolExecutor(max(len(disks), 1)) as workers:
+            futures = [
+                # run in a copy of the context, to keep the timing phase
+                workers.submit(
+                    contextvars.copy_context().run,
+                    LibvirtDisk,
                     self._conn,
-                    disk_name,
-                    alias,
-                    **details
+                    '%s-%s' % (self.fqdn, disk.alias),
+                    disk.alias,
+                    self._existing,
+                    sources.get(disk.target),
+                    template is not None and template.overlay,
+                    self._run,
+                    pool=disk.pool,
+                    capacity=disk.capacity,
+                    fstype=disk.fstype,
+                    mountpoint=disk.mountpoint,
+                    target=disk.target,
+                    fsprofile=disk.fsprofile,
+                    preallocation=disk.preallocation,
+                    bus=disk.bus,
+                    driver=disk.driver,
+                    number=disk.number
                 )
+                for disk in disks
+            ]
+            self._disks.extend(future.result() for future in futures)
+        # pool and volume calls made by the disks
+        self.rpc_count += sum(disk.rpc_count for disk in self._disks)
+        iothreads = self._plan.iothreads
+        self._domain.iothreads = iothreads
+        # iothreads are numbered from 1, the controller takes the first
+        scsi = [disk for disk in self._disks if disk.bus == 'scsi']
+        virtio = [disk for disk in self._disks if disk.bus != 'scsi']
+        if scsi:
+            queues = [disk.driver['queues'] for disk in scsi
+                      if disk.driver.get('queues')]
+            self._domain.add_scsi_controller(
+                1 if iothreads else None,
+                max(queues) if queues else None
             )
+        for index, disk in enumerate(virtio, start=1 if scsi else 0):
+            if iothreads:
+                disk.iothread = index % iothreads + 1
         for disk in self._disks:
             self._domain.add_device(disk.xml)
             LOG.debug('Add disk %s to domain %s', disk.name, self.fqdn)
@@ -81,11 +210,20 @@ class Domain:
         """
         Initialize networks
         """
-        for alias, details in sorted(self._domain_info['networks'].items()):
+        for network in self._plan.networks:
             self._networks.append(
                 LibvirtNetwork(
-                    alias,
-                    **details
+                    network.alias,
+                    bridge=network.bridge,
+                    vlan=network.vlan,
+                    ipv4_address=network.ipv4_address,
+                    ipv4_gateway=network.ipv4_gateway,
+                    ipv6_address=network.ipv6_address,
+                    ipv6_gateway=network.ipv6_gateway,
+                    dns=network.dns,
+                    queues=network.queues,
+                    rx_queue_size=network.rx_queue_size,
+                    tx_queue_size=network.tx_queue_size
                 )
             )
 
@@ -95,9 +233,8 @@ class Domain:
 
     def _init_rng(self):
         """Initialize rng"""
-        if 'rng' in self._domain_info:
-            rng_bytes = self._domain_info['rng'].get('bytes', 2048)
-            rng = LibvirtRng(rng_bytes=rng_bytes)
+        if self._plan.rng_bytes:
+            rng = LibvirtRng(rng_bytes=self._plan.rng_bytes)
             self._domain.add_device(rng.xml)
             LOG.debug('Add rng to domain %s', self.fqdn)
 
@@ -107,15 +244,13 @@ class Domain:
 
         Warning: Will not check if the domain is provisioned yet...
         """
-        domain = self._conn.lookupByName(self.fqdn)
-        domain.create()
+        self._call('create')
 
     def stop(self):
         """
         Stop domain
         """
-        domain = self._conn.lookupByName(self.fqdn)
-        domain.destroy()
+        self._call('destroy')
 
     def autostart(self, autostart):
         """
@@ -123,33 +258,42 @@ class Domain:
 
         :param autostart - True/False
         """
-        domain = self._conn.lookupByName(self.fqdn)
-        domain.setAutostart(autostart)
+        self._call('setAutostart', autostart)
+
+    def undefine(self):
+        """
+        Undefine domain, invalidates the cached domain handle
+        """
+        self._call('undefine')
+        self._handle = None
+
+    @property
+    def plan(self):
+        """
+        Compiled definition of this domain
+        """
+        return self._plan
 
     @property
     def sshkeys(self):
         """
         sshkeys (from JSON representation)
         """
-        if self._domain_info.get('access', {}):
-            return self._domain_info.get('access').get('ssh-keys', {})
-        return None
+        return self._plan.sshkeys
 
     @property
     def password(self):
         """
         password (encrypted, salted hash from JSON representation)
         """
-        if self._domain_info.get('access', {}):
-            return self._domain_info.get('access').get('password', None)
-        return None
+        return self._plan.password
 
     @property
     def guesttype(self):
         """
         Type of domain (archlinux, plain, ...)
         """
-        return self._domain_info.get('guesttype')
+        return self._plan.guesttype
 
     @property
     def disks(self):
@@ -158,6 +302,14 @@ class Domain:
         """
         return self._disks
 
+    @property
+    def mounts(self):
+        """
+        Disks holding a mounted filesystem, parent mountpoints first
+        """
+        by_alias = {disk.alias: disk for disk in self._disks}
+        return [by_alias[disk.alias] for disk in self._plan.mounts]
+
     @property
     def networks(self):
         """
@@ -170,28 +322,28 @@ class Domain:
         """
         FQDN of this domain
         """
-        return self._domain_info.get('fqdn')
+        return self._plan.fqdn
 
     @property
     def hostname(self):
         """
         hostname of this domain
         """
-        return self._domain_info.get('hostname')
+        return self._plan.hostname
 
     @property
     def memory(self):
         """
         Memory (in MB) of this domain
         """
-        return self._domain_info.get('memory')
+        return self._plan.memory
 
     @property
     def vcpu(self):
         """
         Number of virtual cpus for this domain
         """
-        return self._domain_info.get('vcpu')
+        return self._plan.vcpu
 
     @property
     def xml(self):
@@ -0,0 +1,97 @@
+"""archvyrt engine module"""
+
+# stdlib
+import asyncio
+import collections
+import logging
+import threading
+
+LOG = logging.getLogger(__name__)
+
+Step = collections.namedtuple('Step', ['name', 'func', 'after'])
+
+
+class Engine:
+    """
+    Asyncio engine running steps concurrently, respecting dependencies
+
+    Steps may be coroutine functions or plain callables. Plain callables are
+    run in a thread. If a step fails, all other steps are cancelled and the
+    error is raised once they have stopped.
+    """
+
+    def __init__(self, concurrency=4, cancel=None):
+        """
+        Initialize engine
+
+        :param concurrency - Maximum number of steps running at once
+        :param cancel - threading.Event set when steps shall be cancelled,
+                        steps running in threads are expected to check it
+        """
+        self._concurrency = concurrency
+        self._cancel = cancel if cancel is not None else threading.Event()
+        self._steps = collections.OrderedDict()
+
+    def add(self, name, func, after=()):
+        """
+        Add a step
+
+        :param name - Unique name of the step
+        :param func - Coroutine function or callable doing the work
+        :param after - Names of steps that have to complete first
+        """
+        if name in self._steps:
+            raise RuntimeError('Duplicate step %s' % name)
+        for dependency in after:
+            if dependency not in self._steps:
+                raise RuntimeError(
+                    'Step %s depends on unknown step %s' % (name, dependency)
+                )
+        self._steps[name] = Step(name, func, tuple(after))
+
+    async def _run_step(self, step, tasks, semaphore):
+        """
+        Wait for dependencies, then run a single step
+        """
+        for dependency in step.after:
+            await tasks[dependency]
+        async with semaphore:
+            LOG.debug('Start step %s', step.name)
+            if asyncio.iscoroutinefunction(step.func):
+                await step.func()
+            else:
+                future = asyncio.get_running_loop().run_in_executor(
+                    None, step.func
+                )
+                try:
+                    await asyncio.shield(future)
+                except asyncio.CancelledError:
+                    # threads cannot be interrupted, wait for them to notice
+                    await asyncio.gather(future, return_exceptions=True)
+                    raise
+            LOG.debug('Completed step %s', step.name)
+
+    async def run(self):
+        """
+        Run all steps
+        """
+        semaphore = asyncio.Semaphore(self._concurrency)
+        tasks = {}
+        for step in self._steps.values():
+            tasks[step.name] = asyncio.ensure_future(
+                self._run_step(step, tasks, semaphore)
+            )
+        try:
+            await asyncio.gather(*tasks.values())
+        except BaseException:
+            self._cancel.set()
+            for task in tasks.values():
+                task.cancel()
+            await asyncio.gather(*tasks.values(), return_exceptions=True)
+            raise
+
+    def run_sync(self):
+        """
+        Run all steps, blocking until they are completed
+        """
+        asyncio.run(self.run())
@@ -0,0 +1,252 @@
+"""archvyrt executor module
+
+executors run the external commands and file operations of provisioners.
+"""
+
+# stdlib
+import asyncio
+import collections
+import json
+import logging
+import os
+import re
+import subprocess
+import threading
+import time
+
+LOG = logging.getLogger(__name__)
+
+# numbered devices allocated at runtime, which differ between runs
+DEVICE_PATTERN = re.compile(r'/dev/(nbd|loop)[0-9]+')
+
+CommandResult = collections.namedtuple(
+    'CommandResult',
+    ['returncode', 'output', 'wall', 'cpu_user', 'cpu_system']
+)
+
+
+def _normalize(cmds):
+    """
+    Command line with numbered device names replaced, for replay matching
+
+    :param cmds - Command line
+    """
+    return [DEVICE_PATTERN.sub(r'/dev/\1N', arg) for arg in cmds]
+
+
+class SubprocessExecutor:
+    """
+    Executor running commands as local subprocesses
+    """
+
+    @staticmethod
+    async def execute(cmds, output=False, **kwargs):
+        """
+        Run a unix command
+
+        The child is reaped with wait4() in a worker thread, so its own CPU
+        time is recorded, even while other commands run concurrently.
+
+        :param cmds - Command line
+        :param output - Capture and return output of the command
+        :param kwargs - Additional arguments for subprocess.Popen
+        """
+        start = time.monotonic()
+        # output shall be captured
+        if output:
+            proc = subprocess.Popen(
+                cmds,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT,
+                **kwargs
+            )
+        # output does not matter, send it to /dev/null
+        else:
+            proc = subprocess.Popen(
+                cmds,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+                **kwargs
+            )
+        reap = asyncio.get_running_loop().run_in_executor(
+            None, SubprocessExecutor._reap, proc
+        )
+        try:
+            stdout, rusage = await asyncio.shield(reap)
+        except asyncio.CancelledError:
+            proc.kill()
+            await reap
+            raise
+        return CommandResult(
+            proc.returncode,
+            stdout.decode() if output else None,
+            time.monotonic() - start,
+            rusage.ru_utime,
+            rusage.ru_stime
+        )
+
+    @staticmethod
+    def _reap(proc):
+        """
+        Read the output of a child and reap it, returns output and rusage
+
+        :param proc - subprocess.Popen of the child
+        """
+        stdout = None
+        if proc.stdout is not None:
+            with proc.stdout:
+                stdout = proc.stdout.read()
+        # reap the child ourselves, to get its resource usage
+        _, status, rusage = os.wait4(proc.pid, 0)
+        if os.WIFEXITED(status):
+            proc.returncode = os.WEXITSTATUS(status)
+        else:
+            proc.returncode = -os.WTERMSIG(status)
+        return stdout, rusage
+
+    @staticmethod
+    def writefile(filename, lines, mode='w'):
+        """
+        Write to a file
+        """
+        with open(filename, mode) as fobj:
+            fobj.write('%s\n' % '\n'.join(lines))
+
+    @staticmethod
+    def makedirs(path, exist_ok=False):
+        """
+        Create a directory, including missing parents
+        """
+        os.makedirs(path, exist_ok=exist_ok)
+
+    @staticmethod
+    def chmod(path, mode):
+        """
+        Change permission of a file
+        """
+        os.chmod(path, mode)
+
+    @staticmethod
+    def remove(path):
+        """
+        Delete a file
+        """
+        os.remove(path)
+
+
+class RecordingExecutor(SubprocessExecutor):
+    """
+    Executor running commands as local subprocesses, recording each command
+    with its output and duration to a file for later replay.
+    """
+
+    def __init__(self, path):
+        """
+        Initialize recording executor
+
+        :param path - Recording file, will be overwritten
+        """
+        self._path = path
+        self._lock = threading.Lock()
+        with open(self._path, 'w'):
+            pass
+
+    async def execute(self, cmds, output=False, **kwargs):
+        """
+        Run and record a unix command
+        """
+        result = await super().execute(cmds, output, **kwargs)
+        record = dict(result._asdict())
+        record['command'] = list(cmds)
+        with self._lock:
+            with open(self._path, 'a') as fobj:
+                fobj.write('%s\n' % json.dumps(record))
+        return result
+
+
+class ReplayExecutor:
+    """
+    Executor serving recorded command results, without running anything
+
+    File operations are skipped as well.
+    """
+
+    def __init__(self, path, latency=0.0):
+        """
+        Initialize replay executor
+
+        :param path - Recording file (see RecordingExecutor)
+        :param latency - Factor applied to the recorded command durations,
+                         to simulate command runtime (0 replays instantly)
+        """
+        self._latency = latency
+        self._lock = threading.Lock()
+        with open(path) as fobj:
+            self._records = [json.loads(line) for line in fobj if line.strip()]
+
+    def _next(self, cmds):
+        """
+        Pop the recorded result for a command
+
+        Commands are matched by their command line, device names (f.e. of
+        the allocated nbd device) may differ from the recording.
+        """
+        command = _normalize(cmds)
+        with self._lock:
+            for index, record in enumerate(self._records):
+                if record['command'] == list(cmds):
+                    return self._records.pop(index)
+            for index, record in enumerate(self._records):
+                if _normalize(record['command']) == command:
+                    return self._records.pop(index)
+        raise RuntimeError(
+            'No recorded result for %s' % ' '.join(cmds)
+        )
+
+    async def execute(self, cmds, output=False, **kwargs):
+        """
+        Replay a recorded unix command
+        """
+        # pylint: disable=unused-argument
+        start = time.monotonic()
+        record = self._next(cmds)
+        if self._latency:
+            await asyncio.sleep(record['wall'] * self._latency)
+        return CommandResult(
+            record['returncode'],
+            record['output'] if output else None,
+            time.monotonic() - start,
+            record['cpu_user'],
+            record['cpu_system']
+        )
+
+    @staticmethod
+    def writefile(filename, lines, mode='w'):
+        """
+        Skip writing a file
+        """
+        # pylint: disable=unused-argument
+        LOG.debug('Skip writing %s', filename)
+
+    @staticmethod
+    def makedirs(path, exist_ok=False):
+        """
+        Skip creating a directory
+        """
+        # pylint: disable=unused-argument
+        LOG.debug('Skip creating %s', path)
+
+    @staticmethod
+    def chmod(path, mode):
+        """
+        Skip changing permissions of a file
+        """
+        # pylint: disable=unused-argument
+        LOG.debug('Skip chmod %s', path)
+
+    @staticmethod
+    def remove(path):
+        """
+        Skip deleting a file
+        """
+        LOG.debug('Skip deleting %s', path)
@@ -1,5 +1,6 @@
 """archvyrt libvirt module"""
 
+from .connection import LibvirtConnection
 from .disk import LibvirtDisk
 from .domain import LibvirtDomain
 from .network import LibvirtNetwork
@@ -0,0 +1,130 @@
+"""archvyrt libvirt connection module"""
+
+# stdlib
+import functools
+import logging
+import threading
+# 3rd-party
+import libvirt
+
+LOG = logging.getLogger(__name__)
+
+
+class LibvirtConnection:
+    """
+    Shared libvirt connection
+
+    Connections are pooled by URI, so all domains driven from one process
+    share a single connection. Calls are counted and retried once on a new
+    connection, if the connection was lost.
+    """
+
+    _pool = {}
+    _pool_lock = threading.Lock()
+
+    def __init__(self, uri=None):
+        """
+        Initialize connection, use get() to obtain a shared connection
+
+        :param uri - URI for libvirt connection
+        """
+        self._uri = uri
+        self._conn = None
+        self._lock = threading.Lock()
+        self.generation = 0
+        self.rpc_count = 0
+
+    @classmethod
+    def get(cls, uri=None):
+        """
+        Shared connection for a libvirt URI
+
+        :param uri - URI for libvirt connection
+        """
+        with cls._pool_lock:
+            if uri not in cls._pool:
+                cls._pool[uri] = cls(uri)
+            return cls._pool[uri]
+
+    @classmethod
+    def close_all(cls):
+        """
+        Close all shared connections
+        """
+        with cls._pool_lock:
+            for connection in cls._pool.values():
+                connection.close()
+            cls._pool.clear()
+
+    @property
+    def conn(self):
+        """
+        Underlying libvirt connection, (re)opened on demand
+        """
+        with self._lock:
+            if self._conn is None:
+                LOG.debug('Open libvirt connection %s', self._uri or 'default')
+                self._conn = libvirt.open(self._uri)
+                self.generation += 1
+            return self._conn
+
+    def lost(self):
+        """
+        Check if the connection was lost, and forget it if so
+
+        The next call will open a new connection.
+        """
+        with self._lock:
+            try:
+                if self._conn is not None and self._conn.isAlive():
+                    return False
+            except libvirt.libvirtError:
+                pass
+            LOG.warning('Lost libvirt connection %s', self._uri or 'default')
+            self._conn = None
+            return True
+
+    def call(self, method, *args):
+        """
+        Call a method of the libvirt connection
+
+        :param method - Name of the virConnect method
+        :param args - Arguments for the method
+        """
+        self.count()
+        try:
+            return getattr(self.conn, method)(*args)
+        except libvirt.libvirtError:
+            if not self.lost():
+                raise
+        self.count()
+        return getattr(self.conn, method)(*args)
+
+    def count(self, calls=1):
+        """
+        Account for remote calls made on this connection
+
+        :param calls - Number of calls made
+        """
+        with self._lock:
+            self.rpc_count += calls
+
+    def close(self):
+        """
+        Close the underlying libvirt connection
+        """
+        with self._lock:
+            if self._conn is not None:
+                try:
+                    self._conn.close()
+                except libvirt.libvirtError:
+                    pass
+                self._conn = None
+
+    def __getattr__(self, name):
+        """
+        Proxy virConnect methods through call()
+        """
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return functools.partial(self.call, name)
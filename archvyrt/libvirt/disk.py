@@ -3,21 +3,34 @@
 # stdlib
 import logging
 import re
+import subprocess
+import time
 import xml.etree.ElementTree as ElementTree
 # 3rd-party
 import libvirt
 # archvyrt
+import archvyrt.tools as tools
 from .xml import LibvirtXml
 
 LOG = logging.getLogger(__name__)
 
+# volume creation flags by preallocation policy
+PREALLOCATION = {
+    'sparse': 0,
+    'metadata': libvirt.VIR_STORAGE_VOL_CREATE_PREALLOC_METADATA,
+    'falloc': libvirt.VIR_STORAGE_VOL_CREATE_PREALLOC_METADATA,
+    'full': 0,
+}
+
 
 class LibvirtDisk(LibvirtXml):
     """
     LibVirt Disk device object.
     """
 
-    def __init__(self, conn, name, alias, **kwargs):
+    # pylint: disable=too-many-arguments
+    def __init__(self, conn, name, alias, existing=False, source=None,
+                 overlay=False, run=None, **kwargs):
         """
         Initialie a libvirt disk.
 
@@ -26,26 +39,56 @@ class LibvirtDisk(LibvirtXml):
         :param conn - Libvirt connection (already established)
         :param name - Name of the virtual disk
         :param alias - Short name of the virtual disk
+        :param existing - Reuse the volume if it exists already
+        :param source - Volume to clone the new volume from
+        :param overlay - Create a qcow2 overlay backed by the source volume,
+                         instead of copying it
+        :param run - Callable running a command line, blocking until it is
+                     completed (used for full preallocation)
         :param kwargs - Additional properties of the disk:
                          pool - Storage pool name
                          fstype - Type of filesystem
                          target - Target device in guest (vda, vdb, ...)
                          mountpoint - Where to mount the disk in the guest
-                         capacity - Disk capacity in GB
+                         capacity - Disk capacity in bytes
+                         fsprofile - Filesystem format and mount tuning
+                         preallocation - Volume preallocation policy
+                                         (sparse, metadata, falloc, full)
+                         bus - Bus of the disk (virtio, scsi)
+                         driver - Driver attributes (cache, io, discard,
+                                  detect_zeroes, queues)
+                         number - Disk number, derived from the alias
+                                  when missing
         """
         super().__init__()
 
         self._alias = alias
         self._name = name
         self._properties = kwargs
+        self._source = source
+        self._overlay = overlay
+        self._run = run if run is not None else self._check_call
+        self._conn = conn
+        self.rpc_count = 0
 
+        if self.preallocation not in PREALLOCATION:
+            raise RuntimeError(
+                'Unsupported preallocation %s' % self.preallocation
+            )
+        # counted by the connection itself
+        self.rpc_count += 1
         lv_pool = conn.storagePoolLookupByName(self.pool)
-        lv_pool.createXML(
-            self._volume_xml(),
-            libvirt.VIR_STORAGE_VOL_CREATE_PREALLOC_METADATA
-        )
-        lv_volume = lv_pool.storageVolLookupByName(self.name)
-        self._path = lv_volume.path()
+        lv_volume = None
+        if existing:
+            try:
+                lv_volume = self._call(lv_pool, 'storageVolLookupByName',
+                                       self.name)
+                LOG.info('Reuse volume %s', self.name)
+            except libvirt.libvirtError:
+                pass
+        if lv_volume is None:
+            lv_volume = self._create_volume(lv_pool)
+        self._path = self._call(lv_volume, 'path')
 
         self._xml = ElementTree.Element('disk')
         self._xml.attrib['type'] = 'file'
@@ -53,20 +96,89 @@ class LibvirtDisk(LibvirtXml):
         driver_element = ElementTree.Element('driver')
         driver_element.attrib['name'] = 'qemu'
         driver_element.attrib['type'] = 'qcow2'
+        for key, value in sorted(self.driver.items()):
+            # queues of scsi disks are set on their controller
+            if key == 'queues' and self.bus == 'scsi':
+                continue
+            driver_element.attrib[key] = str(value)
         self._xml.append(driver_element)
         target_element = ElementTree.Element('target')
         target_element.attrib['dev'] = self.target
-        target_element.attrib['bus'] = 'virtio'
+        target_element.attrib['bus'] = self.bus
         self._xml.append(target_element)
         source_element = ElementTree.Element('source')
         source_element.attrib['file'] = self.path
         self._xml.append(source_element)
         alias_element = ElementTree.Element('alias')
-        alias_element.attrib['name'] = 'virtio-%s' % self.alias
+        alias_element.attrib['name'] = '%s-%s' % (self.bus, self.alias)
         self._xml.append(alias_element)
 
         LOG.debug("Define virtual disk %s (%s bytes)", self.name, self.capacity)
 
+    def _create_volume(self, lv_pool):
+        """
+        Create the qcow2 volume according to the preallocation policy
+
+        :param lv_pool - Libvirt storage pool
+        """
+        start = time.monotonic()
+        if self._source is not None and not self._overlay:
+            self._call(
+                lv_pool,
+                'createXMLFrom',
+                self._volume_xml(),
+                self._source,
+                PREALLOCATION[self.preallocation]
+            )
+        elif self._overlay:
+            # libvirt rejects preallocation of volumes with a backing store
+            self._call(lv_pool, 'createXML', self._volume_xml(), 0)
+        else:
+            self._call(
+                lv_pool,
+                'createXML',
+                self._volume_xml(),
+                PREALLOCATION[self.preallocation]
+            )
+        lv_volume = self._call(lv_pool, 'storageVolLookupByName', self.name)
+        if self._source is not None:
+            LOG.info('Cloned volume %s from %s', self.name,
+                     self._source.name())
+        elif self.preallocation == 'full':
+            # libvirt cannot fully preallocate qcow2, recreate the image
+            self._run(
+                tools.QEMU_IMG,
+                'create',
+                '-q',
+                '-f', 'qcow2',
+                '-o', 'preallocation=full',
+                self._call(lv_volume, 'path'),
+                self.capacity
+            )
+        LOG.info('Created volume %s with %s preallocation in %.2fs',
+                 self.name, 'no' if self._overlay else self.preallocation,
+                 time.monotonic() - start)
+        return lv_volume
+
+    def _call(self, lv_object, method, *args):
+        """
+        Call a method of a libvirt pool or volume, counting the call
+
+        :param lv_object - Libvirt storage pool or volume
+        :param method - Name of the method
+        :param args - Arguments for the method
+        """
+        self.rpc_count += 1
+        self._conn.count()
+        return getattr(lv_object, method)(*args)
+
+    @staticmethod
+    def _check_call(*cmds):
+        """
+        Run a unix command, if no other command runner was given
+        """
+        subprocess.check_call(cmds)
+
     def _volume_xml(self):
         """
         Generate Libvirt Volume XML, to create the actual Qcow2 image
@@ -79,14 +191,27 @@ class LibvirtDisk(LibvirtXml):
         capacity_element.text = self.capacity
         volume_xml.append(capacity_element)
         allocation_element = ElementTree.Element('allocation')
-        allocation_element.text = self.capacity
+        # libvirt uses falloc preallocation, if allocation covers capacity
+        if self.preallocation == 'falloc' and not self._overlay:
+            allocation_element.text = self.capacity
+        else:
+            allocation_element.text = '0'
         volume_xml.append(allocation_element)
         target_element = ElementTree.Element('target')
         format_element = ElementTree.Element('format')
         format_element.attrib['type'] = 'qcow2'
         target_element.append(format_element)
         volume_xml.append(target_element)
-        return self.format_xml(volume_xml)
+        if self._overlay:
+            backing_element = ElementTree.Element('backingStore')
+            path_element = ElementTree.Element('path')
+            path_element.text = self._call(self._source, 'path')
+            backing_element.append(path_element)
+            format_element = ElementTree.Element('format')
+            format_element.attrib['type'] = 'qcow2'
+            backing_element.append(format_element)
+            volume_xml.append(backing_element)
+        return self.format_xml(volume_xml, indent=None)
 
     @property
     def mountpoint(self):
@@ -98,10 +223,60 @@ class LibvirtDisk(LibvirtXml):
     @property
     def fstype(self):
         """
-        Filesystemi this disk (ext4, swap...) will hold
+        Filesystem this disk (ext4, xfs, swap...) will hold
         """
         return self._properties.get('fstype')
 
+    @property
+    def fsprofile(self):
+        """
+        Filesystem profile of this disk:
+            lazy_init - Initialize inode tables and journal lazily (ext4)
+            skip_discard - Do not discard blocks when formatting
+            noatime - Do not update access times
+            commit - Journal commit interval in seconds (ext4)
+            discard - Discard freed blocks online
+        """
+        return self._properties.get('fsprofile', {})
+
+    @property
+    def mkfs_options(self):
+        """
+        Additional mkfs options according to the filesystem profile
+        """
+        options = []
+        if self.fstype == 'ext4':
+            extended = []
+            if self.fsprofile.get('lazy_init'):
+                extended.append('lazy_itable_init=1')
+                extended.append('lazy_journal_init=1')
+            if self.fsprofile.get('skip_discard'):
+                extended.append('nodiscard')
+            if extended:
+                options.extend(['-E', ','.join(extended)])
+        elif self.fstype == 'xfs':
+            if self.fsprofile.get('skip_discard'):
+                options.append('-K')
+        return options
+
+    @property
+    def mount_options(self):
+        """
+        Mount options (fstab) according to the filesystem profile
+        """
+        options = ['rw']
+        if self.fsprofile.get('noatime'):
+            options.append('noatime')
+        else:
+            options.append('relatime')
+        if self.fstype == 'ext4':
+            options.append('data=ordered')
+            if self.fsprofile.get('commit'):
+                options.append('commit=%d' % int(self.fsprofile['commit']))
+        if self.fsprofile.get('discard'):
+            options.append('discard')
+        return ','.join(options)
+
     @property
     def alias(self):
         """
@@ -114,6 +289,8 @@ class LibvirtDisk(LibvirtXml):
         """
         Disk number, assumes alias is numbered (f.e. disk0, disk1, etc.)
         """
+        if self._properties.get('number') is not None:
+            return self._properties['number']
         return re.match(r'^.*?([0-9]+)$', self._alias).groups()[0]
 
     @property
@@ -121,7 +298,14 @@ class LibvirtDisk(LibvirtXml):
         """
         Disk capacity in bytes
         """
-        return str(int(self._properties.get('capacity')) * 1073741824)
+        return str(int(self._properties.get('capacity')))
+
+    @property
+    def preallocation(self):
+        """
+        Volume preallocation policy (sparse, metadata, falloc, full)
+        """
+        return self._properties.get('preallocation', 'metadata')
 
     @property
     def name(self):
@@ -150,3 +334,36 @@ class LibvirtDisk(LibvirtXml):
         Target (guest) device name for this disk (vda, vdb, vdc...)
         """
         return self._properties.get('target')
+
+    @property
+    def bus(self):
+        """
+        Bus this disk is attached to (virtio, scsi)
+        """
+        return self._properties.get('bus', 'virtio')
+
+    @property
+    def driver(self):
+        """
+        Driver attributes of this disk (cache, io, discard, ...)
+        """
+        return self._properties.get('driver', {})
+
+    @property
+    def iothread(self):
+        """
+        Number of the iothread serving this disk, None for the main loop
+        """
+        value = self._xml.find('driver').attrib.get('iothread')
+        return int(value) if value is not None else None
+
+    @iothread.setter
+    def iothread(self, value):
+        """
+        Number of the iothread serving this disk, None for the main loop
+        """
+        driver_element = self._xml.find('driver')
+        if value is None:
+            driver_element.attrib.pop('iothread', None)
+        else:
+            driver_element.attrib['iothread'] = str(value)
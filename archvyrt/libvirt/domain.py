@@ -1,9 +1,13 @@
 """archvyrt libvirt domain module"""
 
 # stdlib
+import copy
+import functools
 import logging
 import xml.etree.ElementTree as ElementTree
 # archvyrt
+from archvyrt.numa import format_cpuset
+from .xml import ARCHVYRT_NS
 from .xml import LibvirtXml
 
 LOG = logging.getLogger(__name__)
@@ -65,23 +69,34 @@ class LibvirtDomain(LibvirtXml):
         Setup default devices, such as emulator, console and input devices
         """
         devices_element = ElementTree.Element('devices')
+        for template in self._device_templates():
+            devices_element.append(copy.deepcopy(template))
+        self._xml.append(devices_element)
+
+    @classmethod
+    @functools.lru_cache(maxsize=None)
+    def _device_templates(cls):
+        """
+        Static default devices, built once and copied into each domain
+        """
         emulator_element = ElementTree.Element('emulator')
         emulator_element.text = '/usr/bin/qemu-system-x86_64'
-        devices_element.append(emulator_element)
-        devices_element.append(self.__prepare_serial_devices())
-        devices_element.append(self.__prepare_console_devices())
         keyboard_element = ElementTree.Element('input')
         keyboard_element.attrib['type'] = 'keyboard'
         keyboard_element.attrib['bus'] = 'ps2'
-        devices_element.append(keyboard_element)
         mouse_element = ElementTree.Element('input')
         mouse_element.attrib['type'] = 'mouse'
         mouse_element.attrib['bus'] = 'ps2'
-        devices_element.append(mouse_element)
-        devices_element.append(self.__prepare_graphics_devices())
-        devices_element.append(self.__prepare_video_devices())
-        devices_element.append(self.__prepare_memballoon_devices())
-        self._xml.append(devices_element)
+        return (
+            emulator_element,
+            cls.__prepare_serial_devices(),
+            cls.__prepare_console_devices(),
+            keyboard_element,
+            mouse_element,
+            cls.__prepare_graphics_devices(),
+            cls.__prepare_video_devices(),
+            cls.__prepare_memballoon_devices(),
+        )
 
     @staticmethod
     def __prepare_console_devices():
@@ -213,6 +228,113 @@ class LibvirtDomain(LibvirtXml):
         resource_element.append(partition_element)
         self._xml.append(resource_element)
 
+    def set_memory_profile(self, profile, stats_period=10):
+        """
+        Setup memory backing and balloon according to a memory profile
+
+        :param profile - dedicated (locked hugepages, not shared, balloon
+                         never deflated) or overcommit (no hugepages,
+                         balloon with statistics, free page reporting and
+                         deflation on out of memory)
+        :param stats_period - Balloon statistics period in seconds
+        """
+        memorybacking_element = self._xml.find('memoryBacking')
+        memballoon_element = self._xml.find('devices/memballoon')
+        if profile == 'dedicated':
+            memorybacking_element.append(ElementTree.Element('nosharepages'))
+            memorybacking_element.append(ElementTree.Element('locked'))
+            memballoon_element.attrib['autodeflate'] = 'off'
+        elif profile == 'overcommit':
+            # without hugepages, memory may be shared by ksm
+            self._xml.remove(memorybacking_element)
+            memballoon_element.attrib['autodeflate'] = 'on'
+            memballoon_element.attrib['freePageReporting'] = 'on'
+            stats_element = ElementTree.Element('stats')
+            stats_element.attrib['period'] = str(stats_period)
+            memballoon_element.append(stats_element)
+        else:
+            raise RuntimeError('Unsupported memory profile %s' % profile)
+
+    def set_cpu(self, mode, model=None, features=None, sockets=1, cores=1,
+                threads=1):
+        """
+        Set the cpu model and topology presented to the guest
+
+        :param mode - CPU mode (host-passthrough, host-model, custom)
+        :param model - Named cpu model of custom mode
+        :param features - Feature policies, keyed by feature name
+        :param sockets - Number of sockets
+        :param cores - Number of cores per socket
+        :param threads - Number of threads per core
+        """
+        cpu_element = ElementTree.Element('cpu')
+        cpu_element.attrib['mode'] = mode
+        if mode == 'custom':
+            cpu_element.attrib['match'] = 'exact'
+            model_element = ElementTree.Element('model')
+            model_element.attrib['fallback'] = 'forbid'
+            model_element.text = model
+            cpu_element.append(model_element)
+        topology_element = ElementTree.Element('topology')
+        topology_element.attrib['sockets'] = str(sockets)
+        topology_element.attrib['cores'] = str(cores)
+        topology_element.attrib['threads'] = str(threads)
+        cpu_element.append(topology_element)
+        for name, policy in sorted((features or {}).items()):
+            feature_element = ElementTree.Element('feature')
+            feature_element.attrib['policy'] = policy
+            feature_element.attrib['name'] = name
+            cpu_element.append(feature_element)
+        self._xml.append(cpu_element)
+
+    def set_placement(self, placement):
+        """
+        Pin vCPUs, emulator and memory to a NUMA node of the host
+
+        :param placement - Placement on the host (see archvyrt.numa)
+        """
+        cputune_element = ElementTree.Element('cputune')
+        for vcpu, cpu in enumerate(placement.cpus):
+            vcpupin_element = ElementTree.Element('vcpupin')
+            vcpupin_element.attrib['vcpu'] = str(vcpu)
+            vcpupin_element.attrib['cpuset'] = str(cpu)
+            cputune_element.append(vcpupin_element)
+        emulatorpin_element = ElementTree.Element('emulatorpin')
+        emulatorpin_element.attrib['cpuset'] = format_cpuset(placement.cpus)
+        cputune_element.append(emulatorpin_element)
+        self._xml.append(cputune_element)
+        numatune_element = ElementTree.Element('numatune')
+        memory_element = ElementTree.Element('memory')
+        memory_element.attrib['mode'] = 'strict'
+        memory_element.attrib['nodeset'] = str(placement.node)
+        numatune_element.append(memory_element)
+        self._xml.append(numatune_element)
+        hugepages_element = self._xml.find('memoryBacking/hugepages')
+        if hugepages_element is not None:
+            page_element = ElementTree.Element('page')
+            page_element.attrib['size'] = str(placement.hugepage_size)
+            page_element.attrib['unit'] = 'KiB'
+            hugepages_element.append(page_element)
+
+    def add_scsi_controller(self, iothread=None, queues=None):
+        """
+        Add a virtio-scsi controller for scsi disks
+
+        :param iothread - Number of the iothread serving the controller
+        :param queues - Number of request queues
+        """
+        controller_element = ElementTree.Element('controller')
+        controller_element.attrib['type'] = 'scsi'
+        controller_element.attrib['index'] = '0'
+        controller_element.attrib['model'] = 'virtio-scsi'
+        driver_element = ElementTree.Element('driver')
+        if iothread is not None:
+            driver_element.attrib['iothread'] = str(iothread)
+        if queues is not None:
+            driver_element.attrib['queues'] = str(queues)
+        controller_element.append(driver_element)
+        self.add_device(controller_element)
+
     def add_device(self, device_xml):
         """
         Add additional device to this libvirt domain.
@@ -222,6 +344,73 @@ class LibvirtDomain(LibvirtXml):
         devices_node = self._xml.find('devices')
         devices_node.append(device_xml)
 
+    @property
+    def machine(self):
+        """
+        Machine type (pc, q35)
+        """
+        return self._xml.find('os/type').attrib['machine']
+
+    @machine.setter
+    def machine(self, value):
+        """
+        Machine type (pc, q35)
+        """
+        self._xml.find('os/type').attrib['machine'] = value
+
+    @property
+    def guesttype(self):
+        """
+        Guest type the domain was provisioned as, from its metadata
+        """
+        guest_element = self._xml.find(
+            'metadata/{%s}guest' % ARCHVYRT_NS
+        )
+        if guest_element is None:
+            return None
+        return guest_element.attrib.get('guesttype')
+
+    @guesttype.setter
+    def guesttype(self, value):
+        """
+        Guest type the domain is provisioned as, stored in its metadata
+        """
+        metadata_element = self._xml.find('metadata')
+        if metadata_element is None:
+            metadata_element = ElementTree.Element('metadata')
+            self._xml.append(metadata_element)
+        guest_element = metadata_element.find('{%s}guest' % ARCHVYRT_NS)
+        if guest_element is None:
+            guest_element = ElementTree.Element('{%s}guest' % ARCHVYRT_NS)
+            metadata_element.append(guest_element)
+        guest_element.attrib['guesttype'] = value
+
+    @property
+    def iothreads(self):
+        """
+        Number of iothreads available to devices
+        """
+        iothreads_element = self._xml.find('iothreads')
+        if iothreads_element is None:
+            return 0
+        return int(iothreads_element.text)
+
+    @iothreads.setter
+    def iothreads(self, value):
+        """
+        Number of iothreads available to devices
+        """
+        iothreads_element = self._xml.find('iothreads')
+        if not value:
+            if iothreads_element is not None:
+                self._xml.remove(iothreads_element)
+        elif iothreads_element is not None:
+            iothreads_element.text = str(value)
+        else:
+            iothreads_element = ElementTree.Element('iothreads')
+            iothreads_element.text = str(value)
+            self._xml.append(iothreads_element)
+
     @property
     def vcpu(self):
         """
@@ -1,7 +1,6 @@
 """archvyrt libvirt network module"""
 
 # stdlib
-import ipaddress
 import logging
 import xml.etree.ElementTree as ElementTree
 # archvyrt
@@ -20,21 +19,23 @@ class LibvirtNetwork(LibvirtXml):
         Build XML representation
 
         :param name - Short name of this network device (eth0, eth1, ...)
+        :param kwargs - Properties of the network device:
+                         bridge - Open vSwitch bridge to attach to
+                         vlan - VLAN tag on the bridge
+                         ipv4_address, ipv6_address - Interface addresses
+                         ipv4_gateway, ipv6_gateway - Default gateways
+                         dns - DNS servers (ipaddress objects)
+                         queues - Number of queue pairs
+                         rx_queue_size - Size of the receive virtqueues
+                         tx_queue_size - Size of the transmit virtqueues
         """
         super().__init__()
 
-        try:
-            self._ipv4 = kwargs.get('ipv4')
-        except KeyError:
-            self._ipv4 = None
-        try:
-            self._ipv6 = kwargs.get('ipv6')
-        except KeyError:
-            self._ipv6 = None
-
         self._name = name
+        self._properties = kwargs
         self._vlan = kwargs.get('vlan')
         self._bridge = kwargs.get('bridge')
+        self._queues = kwargs.get('queues') or 1
         self._xml = ElementTree.Element('interface')
         self._xml.attrib['type'] = 'bridge'
         source_element = ElementTree.Element('source')
@@ -52,6 +53,14 @@ class LibvirtNetwork(LibvirtXml):
         model_element = ElementTree.Element('model')
         model_element.attrib['type'] = 'virtio'
         self._xml.append(model_element)
+        driver_element = ElementTree.Element('driver')
+        driver_element.attrib['name'] = 'vhost'
+        if self.queues > 1:
+            driver_element.attrib['queues'] = str(self.queues)
+        for key in ('rx_queue_size', 'tx_queue_size'):
+            if kwargs.get(key):
+                driver_element.attrib[key] = str(kwargs[key])
+        self._xml.append(driver_element)
 
     @property
     def name(self):
@@ -60,6 +69,22 @@ class LibvirtNetwork(LibvirtXml):
         """
         return self._name
 
+    @property
+    def queues(self):
+        """
+        Number of queue pairs of this network device
+        """
+        return self._queues
+
+    @property
+    def ethtool(self):
+        """
+        Command enabling all queue pairs in the guest, None with one queue
+        """
+        if self.queues > 1:
+            return 'ethtool -L %s combined %d' % (self.name, self.queues)
+        return None
+
     @property
     def netctl(self):
         """
@@ -92,6 +117,8 @@ class LibvirtNetwork(LibvirtXml):
             for server in self.dns:
                 dns.append("'%s'" % str(server))
             config.append('DNS=(%s)' % " ".join(dns))
+        if self.ethtool:
+            config.append("ExecUpPost='%s || true'" % self.ethtool)
         return config
 
     @property
@@ -103,9 +130,13 @@ class LibvirtNetwork(LibvirtXml):
         """
         config = list()
         config.append('auto %s' % self.name)
+        post_up = []
+        if self.ethtool:
+            post_up.append('  post-up %s || true' % self.ethtool)
         if not self.ipv4_address and not self.ipv6_address:
             config.append('iface %s inet manual' % self.name)
             config.append('  up ifconfig %s up' % self.name)
+            config.extend(post_up)
         else:
             if self.ipv4_address:
                 config.append('iface %s inet static' % self.name)
@@ -113,12 +144,15 @@ class LibvirtNetwork(LibvirtXml):
                 config.append('  netmask %s' % self.ipv4_address.with_prefixlen.split('/', 1)[1])
                 if self.ipv4_gateway:
                     config.append('  gateway %s' % str(self.ipv4_gateway))
+                config.extend(post_up)
+                post_up = []
             if self.ipv6_address:
                 config.append('iface %s inet6 static' % self.name)
                 config.append('  address %s' % self.ipv6_address.ip)
                 config.append('  netmask %s' % self.ipv6_address.with_prefixlen.split('/', 1)[1])
                 if self.ipv6_gateway:
                     config.append('  gateway %s' % str(self.ipv6_gateway))
+                config.extend(post_up)
         return config
 
     @property
@@ -126,55 +160,35 @@ class LibvirtNetwork(LibvirtXml):
         """
         DNS servers configured for this network (returns a list)
         """
-        dns = []
-        try:
-            for server in self._ipv4.get('dns', []):
-                dns.append(ipaddress.ip_address(server))
-            for server in self._ipv6.get('dns', []):
-                dns.append(ipaddress.ip_address(server))
-        except AttributeError:
-            pass
-        return dns
+        return list(self._properties.get('dns') or [])
 
     @property
     def ipv4_address(self):
         """
         IPv4 address for this interface
         """
-        try:
-            return ipaddress.ip_interface(self._ipv4['address'])
-        except (KeyError, ValueError, TypeError):
-            return None
+        return self._properties.get('ipv4_address')
 
     @property
     def ipv4_gateway(self):
         """
         IPv4 default gateway for this interface
         """
-        try:
-            return ipaddress.ip_address(self._ipv4['gateway'])
-        except (KeyError, ValueError, TypeError):
-            return None
+        return self._properties.get('ipv4_gateway')
 
     @property
     def ipv6_address(self):
         """
         IPv6 address for this interface
         """
-        try:
-            return ipaddress.ip_interface(self._ipv6['address'])
-        except (KeyError, ValueError, TypeError):
-            return None
+        return self._properties.get('ipv6_address')
 
     @property
     def ipv6_gateway(self):
         """
         IPv6 default gateway for this interface
         """
-        try:
-            return ipaddress.ip_address(self._ipv6['gateway'])
-        except (KeyError, ValueError, TypeError):
-            return None
+        return self._properties.get('ipv6_gateway')
 
     @property
     def bridge(self):
@@ -1,7 +1,40 @@
 """archvyrt libvirt device module"""
 
+import copy
 import xml.etree.ElementTree as ElementTree
-import xml.dom.minidom
+
+# namespace of the metadata archvyrt stores in libvirt domains
+ARCHVYRT_NS = 'https://github.com/andrekeller/archvyrt/xmlns/domain/1.0'
+
+# prefixes of namespaces found in the metadata of libvirt domains, others
+# are serialized with generated prefixes (ns0, ns1, ...)
+ElementTree.register_namespace(
+    'libosinfo', 'http://libosinfo.org/xmlns/libvirt/domain/1.0'
+)
+ElementTree.register_namespace('archvyrt', ARCHVYRT_NS)
+
+
+def _indent_xml(element, indent, level=0):
+    """
+    Indent an element and its children in place, by setting their text and
+    tail whitespace
+
+    Whitespace-only text and tails (f.e. from XML returned by libvirt) are
+    replaced, so already indented XML is not indented twice.
+    """
+    children = list(element)
+    if not children:
+        if element.text is not None and not element.text.strip():
+            element.text = None
+        return
+    if element.text is None or not element.text.strip():
+        element.text = '\n' + indent * (level + 1)
+    for child in children:
+        _indent_xml(child, indent, level + 1)
+        if child.tail is None or not child.tail.strip():
+            child.tail = '\n' + indent * (level + 1)
+    if not children[-1].tail.strip():
+        children[-1].tail = '\n' + indent * level
 
 
 class LibvirtXml:
@@ -11,16 +44,26 @@ class LibvirtXml:
         self._xml = ElementTree.Element('root')
 
     @staticmethod
-    def format_xml(et_xml):
+    def format_xml(et_xml, indent='  '):
         """
-        Return a pretty formatted XML
+        Return a formatted XML, serialized straight from the ElementTree
 
         :param et_xml - ElementTree XML object
+        :param indent - Indentation per level, None for compact XML
+        """
+        if indent is None:
+            return ElementTree.tostring(et_xml, encoding='unicode')
+        # indent a copy, the whitespace must not end up in compact XML
+        et_xml = copy.deepcopy(et_xml)
+        _indent_xml(et_xml, indent)
+        et_xml.tail = None
+        return ElementTree.tostring(et_xml, encoding='unicode')
+
+    def compact(self):
+        """
+        Return a compact XML representation, f.e. to pass it to libvirt
         """
-        reparsed = xml.dom.minidom.parseString(
-            ElementTree.tostring(et_xml, encoding='unicode')
-        )
-        return reparsed.toprettyxml(indent="  ").strip()
+        return self.format_xml(self.xml, indent=None)
 
     def __str__(self):
         """
@@ -0,0 +1,135 @@
+"""archvyrt nbd module"""
+
+# stdlib
+import fcntl
+import logging
+import os
+import re
+import tempfile
+import threading
+import time
+
+LOG = logging.getLogger(__name__)
+
+
+class NbdAllocator:
+    """
+    Allocator for free network block devices (/dev/nbdN)
+
+    A device is considered free, if the kernel reports no attached client
+    process in sysfs. Allocated devices are protected by a host-wide lock
+    file, so concurrent provisioning runs never pick the same device.
+    """
+
+    def __init__(self, sysfs_root='/sys', lock_dir='/run/lock'):
+        """
+        Initialize allocator
+
+        :param sysfs_root - Root of sysfs, to lookup nbd devices
+        :param lock_dir - Directory holding the device lock files
+        """
+        self._sysfs_root = sysfs_root
+        self._lock_dir = lock_dir
+        self._locks = {}
+        self._mutex = threading.Lock()
+
+    @classmethod
+    def simulated(cls, devices=16):
+        """
+        Allocator on a simulated sysfs, used when replaying recorded runs
+
+        :param devices - Number of simulated nbd devices
+        """
+        root = tempfile.mkdtemp(prefix='archvyrt-nbd-')
+        for number in range(devices):
+            os.makedirs(os.path.join(root, 'block', 'nbd%d' % number))
+        return cls(sysfs_root=root, lock_dir=root)
+
+    def _devices(self):
+        """
+        All nbd devices known to the kernel, in numeric order
+        """
+        devices = []
+        block = os.path.join(self._sysfs_root, 'block')
+        for name in os.listdir(block):
+            match = re.match(r'^nbd([0-9]+)$', name)
+            if match:
+                devices.append((int(match.group(1)), name))
+        return [name for _, name in sorted(devices)]
+
+    def _in_use(self, name):
+        """
+        Check if a nbd device is connected according to sysfs
+        """
+        return os.path.exists(
+            os.path.join(self._sysfs_root, 'block', name, 'pid')
+        )
+
+    def allocate(self):
+        """
+        Allocate and lock a free nbd device
+
+        Returns the device path (f.e. /dev/nbd3)
+        """
+        with self._mutex:
+            for name in self._devices():
+                if name in self._locks or self._in_use(name):
+                    continue
+                lockfile = open(
+                    os.path.join(self._lock_dir, 'archvyrt-%s.lock' % name),
+                    'w'
+                )
+                try:
+                    fcntl.flock(lockfile, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except OSError:
+                    lockfile.close()
+                    continue
+                # device might have been connected while acquiring the lock
+                if self._in_use(name):
+                    lockfile.close()
+                    continue
+                self._locks[name] = lockfile
+                LOG.debug('Allocated /dev/%s', name)
+                return '/dev/%s' % name
+        raise RuntimeError('No free nbd device available')
+
+    def wait_disconnected(self, device, timeout=30):
+        """
+        Wait until the client of a nbd device is gone
+
+        qemu-nbd -d only asks the client to disconnect, it may hold the lock
+        of its image for a moment afterwards.
+
+        :param device - Device path returned by allocate()
+        :param timeout - Seconds to wait at most
+        """
+        name = os.path.basename(device)
+        deadline = time.monotonic() + timeout
+        while self._in_use(name):
+            if time.monotonic() > deadline:
+                raise RuntimeError('%s still connected after %ds'
+                                   % (device, timeout))
+            time.sleep(0.05)
+
+    def release(self, device):
+        """
+        Release a previously allocated nbd device
+
+        :param device - Device path returned by allocate()
+        """
+        name = os.path.basename(device)
+        with self._mutex:
+            lockfile = self._locks.pop(name, None)
+        if lockfile is not None:
+            lockfile.close()
+            LOG.debug('Released %s', device)
+
+    def release_all(self):
+        """
+        Release all devices allocated by this allocator
+
+        Only to be used on process shutdown, the allocator is shared by
+        concurrent provisioners, which release their own devices.
+        """
+        for name in list(self._locks):
+            self.release('/dev/%s' % name)
@@ -0,0 +1,214 @@
+"""archvyrt numa module
+
+places domains on a single NUMA node of the host, with pinned vCPUs and
+hugepage backed memory of that node.
+"""
+
+# stdlib
+import collections
+import logging
+import os
+import threading
+import xml.etree.ElementTree as ElementTree
+
+LOG = logging.getLogger(__name__)
+
+HostNode = collections.namedtuple(
+    'HostNode',
+    ['id', 'cpus', 'memory', 'hugepages']
+)
+
+Placement = collections.namedtuple(
+    'Placement',
+    ['node', 'cpus', 'hugepage_size']
+)
+
+
+def parse_cpuset(cpuset):
+    """
+    Parse a libvirt cpuset (f.e. 0-3,^2,8) into a set of cpu numbers
+
+    :param cpuset - cpuset string
+    """
+    cpus = set()
+    excluded = set()
+    for item in cpuset.split(','):
+        item = item.strip()
+        if not item:
+            continue
+        target = cpus
+        if item.startswith('^'):
+            target = excluded
+            item = item[1:]
+        if '-' in item:
+            first, last = item.split('-', 1)
+            target.update(range(int(first), int(last) + 1))
+        else:
+            target.add(int(item))
+    return cpus - excluded
+
+
+def format_cpuset(cpus):
+    """
+    Format cpu numbers as a libvirt cpuset, using ranges where possible
+
+    :param cpus - Iterable of cpu numbers
+    """
+    ranges = []
+    for cpu in sorted(cpus):
+        if ranges and ranges[-1][1] == cpu - 1:
+            ranges[-1][1] = cpu
+        else:
+            ranges.append([cpu, cpu])
+    return ','.join(
+        str(first) if first == last else '%d-%d' % (first, last)
+        for first, last in ranges
+    )
+
+
+def pinned_cpus(domain_xml):
+    """
+    Host cpus the vCPUs of a domain are pinned to
+
+    :param domain_xml - Libvirt XML of the domain
+    """
+    cpus = set()
+    xml = ElementTree.fromstring(domain_xml)
+    vcpu = xml.find('vcpu')
+    if vcpu is not None and vcpu.attrib.get('cpuset'):
+        cpus.update(parse_cpuset(vcpu.attrib['cpuset']))
+    for vcpupin in xml.findall('cputune/vcpupin'):
+        cpus.update(parse_cpuset(vcpupin.attrib['cpuset']))
+    return cpus
+
+
+class NumaPlacer:
+    """
+    Places domains on NUMA nodes of the host
+
+    The host topology is read from the libvirt capabilities XML, the free
+    hugepages of each node from sysfs. Host cpus and hugepages assigned by
+    this placer are reserved, so concurrently provisioned domains are
+    placed apart.
+    """
+
+    def __init__(self, capabilities, sysfs_root='/sys', pinned=()):
+        """
+        Initialize placer
+
+        :param capabilities - Libvirt capabilities XML of the host
+        :param sysfs_root - Root of sysfs, to lookup free hugepages
+        :param pinned - Host cpus already pinned by existing domains
+        """
+        self._sysfs_root = sysfs_root
+        self._pinned = set(pinned)
+        self._lock = threading.Lock()
+        self._nodes = self._parse_nodes(capabilities)
+
+    @classmethod
+    def from_connection(cls, conn, sysfs_root='/sys'):
+        """
+        Placer for the host of a libvirt connection
+
+        Host cpus pinned by all defined domains count as used.
+
+        :param conn - Libvirt connection
+        :param sysfs_root - Root of sysfs, to lookup free hugepages
+        """
+        pinned = set()
+        for domain in conn.listAllDomains(0):
+            pinned.update(pinned_cpus(domain.XMLDesc(0)))
+        return cls(conn.getCapabilities(), sysfs_root, pinned)
+
+    @property
+    def nodes(self):
+        """
+        NUMA nodes of the host
+        """
+        return list(self._nodes)
+
+    def _parse_nodes(self, capabilities):
+        """
+        Parse the NUMA nodes of the host from its capabilities XML
+        """
+        nodes = []
+        xml = ElementTree.fromstring(capabilities)
+        for cell in xml.findall('host/topology/cells/cell'):
+            node = int(cell.attrib['id'])
+            memory = cell.find('memory')
+            # order cpus by core, so sibling threads are assigned together
+            cpus = sorted(
+                cell.findall('cpus/cpu'),
+                key=lambda cpu: (int(cpu.attrib.get('socket_id', 0)),
+                                 int(cpu.attrib.get('core_id', 0)),
+                                 int(cpu.attrib['id']))
+            )
+            hugepages = {}
+            for pages in cell.findall('pages'):
+                size = int(pages.attrib['size'])
+                if size > 4:
+                    hugepages[size] = self._free_hugepages(node, size)
+            nodes.append(HostNode(
+                node,
+                tuple(int(cpu.attrib['id']) for cpu in cpus),
+                int(memory.text) if memory is not None else 0,
+                hugepages
+            ))
+        return nodes
+
+    def _free_hugepages(self, node, size):
+        """
+        Number of free hugepages of a size on a node, according to sysfs
+
+        :param node - NUMA node number
+        :param size - Hugepage size in KiB
+        """
+        path = os.path.join(
+            self._sysfs_root, 'devices', 'system', 'node', 'node%d' % node,
+            'hugepages', 'hugepages-%dkB' % size, 'free_hugepages'
+        )
+        try:
+            with open(path) as fobj:
+                return int(fobj.read().strip())
+        except (OSError, ValueError):
+            return 0
+
+    def place(self, vcpu, memory):
+        """
+        Place a domain on a node and reserve its cpus and hugepages
+
+        The node with the most free hugepage memory, that has enough free
+        cpus and hugepages is chosen. The largest hugepage size that divides
+        the memory of the domain is preferred.
+
+        :param vcpu - Number of virtual cpus
+        :param memory - Memory in MB
+        """
+        memory_kib = int(memory) * 1024
+        with self._lock:
+            candidates = []
+            for node in self._nodes:
+                free = [cpu for cpu in node.cpus if cpu not in self._pinned]
+                if len(free) < int(vcpu):
+                    continue
+                for size in sorted(node.hugepages, reverse=True):
+                    if memory_kib % size == 0 and \
+                            node.hugepages[size] >= memory_kib // size:
+                        free_memory = sum(
+                            count * page for page, count
+                            in node.hugepages.items()
+                        )
+                        candidates.append((-free_memory, node.id, node,
+                                           size, free[:int(vcpu)]))
+                        break
+            if not candidates:
+                raise RuntimeError(
+                    'No NUMA node has %s free cpus and %s MB of free '
+                    'hugepages' % (vcpu, memory)
+                )
+            _, _, node, size, cpus = min(candidates, key=lambda c: c[:2])
+            self._pinned.update(cpus)
+            node.hugepages[size] -= memory_kib // size
+        LOG.info('Place domain on NUMA node %d, cpus %s, %d KiB hugepages',
+                 node.id, format_cpuset(cpus), size)
+        return Placement(node.id, tuple(cpus), size)
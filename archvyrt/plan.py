@@ -0,0 +1,633 @@
+"""archvyrt plan module
+
+compiles JSON VM definitions into immutable provisioning plans, reporting
+all problems of a definition at once before anything is provisioned.
+"""
+
+# stdlib
+import collections
+import ipaddress
+import logging
+import posixpath
+import re
+import types
+import xml.etree.ElementTree as ElementTree
+# 3rd-party
+import libvirt
+# archvyrt
+from archvyrt.libvirt.disk import PREALLOCATION
+from archvyrt.libvirt.domain import LibvirtDomain
+
+LOG = logging.getLogger(__name__)
+
+GUESTTYPES = ('archlinux', 'ubuntu', 'plain')
+
+# build engines of linux guests
+ENGINES = ('nbd', 'offline')
+
+# filesystems mounted in the guest, besides swap
+FILESYSTEMS = ('ext4', 'xfs')
+
+# machine types, q35 provides a pcie topology
+MACHINES = ('pc', 'q35')
+
+# cpu modes, host-model and custom keep domains migratable between hosts
+CPU_MODES = ('host-passthrough', 'host-model', 'custom')
+
+CPU_FEATURE_POLICIES = ('force', 'require', 'optional', 'disable', 'forbid')
+
+# memory profiles, dedicated memory is backed by locked hugepages, overcommitted
+# memory is reclaimed through the balloon
+MEMORY_PROFILES = ('dedicated', 'overcommit')
+
+# buses of disks, scsi disks are attached to a virtio-scsi controller
+DISK_BUSES = ('virtio', 'scsi')
+
+# disk driver attributes and their allowed values
+DISK_DRIVER = {
+    'cache': ('none', 'writeback', 'writethrough', 'directsync', 'unsafe'),
+    'io': ('native', 'threads', 'io_uring'),
+    'discard': ('unmap', 'ignore'),
+    'detect_zeroes': ('off', 'on', 'unmap'),
+}
+
+FSPROFILE = ('lazy_init', 'skip_discard', 'noatime', 'commit', 'discard')
+
+# top-level keys of a VM definition
+KEYS = ('hostname', 'fqdn', 'guesttype', 'vcpu', 'memory', 'disks',
+        'networks', 'rng', 'access', 'engine', 'template', 'machine', 'cpu',
+        'iothreads', 'memory_profile')
+
+DomainPlan = collections.namedtuple(
+    'DomainPlan',
+    ['fqdn', 'hostname', 'guesttype', 'engine', 'machine', 'cpu', 'vcpu',
+     'memory', 'memory_profile', 'iothreads', 'disks',
+     'mounts', 'networks', 'rng_bytes', 'password', 'sshkeys', 'template',
+     'definition']
+)
+
+CpuPlan = collections.namedtuple(
+    'CpuPlan',
+    ['mode', 'model', 'features', 'sockets', 'cores', 'threads']
+)
+
+TemplatePlan = collections.namedtuple(
+    'TemplatePlan',
+    ['domain', 'overlay']
+)
+
+DiskPlan = collections.namedtuple(
+    'DiskPlan',
+    ['alias', 'number', 'name', 'pool', 'capacity', 'fstype', 'mountpoint',
+     'target', 'bus', 'driver', 'preallocation', 'fsprofile']
+)
+
+NetworkPlan = collections.namedtuple(
+    'NetworkPlan',
+    ['alias', 'bridge', 'vlan', 'ipv4_address', 'ipv4_gateway',
+     'ipv6_address', 'ipv6_gateway', 'dns', 'queues', 'rx_queue_size',
+     'tx_queue_size']
+)
+
+# virtqueue sizes supported by virtio-net
+NETWORK_QUEUE_SIZES = (256, 512, 1024)
+
+
+def _freeze(value):
+    """
+    Read-only copy of a JSON value, objects become mapping proxies and
+    arrays tuples
+    """
+    if isinstance(value, dict):
+        return types.MappingProxyType(
+            {key: _freeze(item) for key, item in value.items()}
+        )
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(item) for item in value)
+    return value
+
+
+def _positive_int(value, what, problems):
+    """
+    Convert a value to a positive integer, record a problem if impossible
+    """
+    if isinstance(value, bool):
+        problems.append('%s must be an integer, got %r' % (what, value))
+        return None
+    try:
+        number = int(value)
+    except (TypeError, ValueError):
+        problems.append('%s must be an integer, got %r' % (what, value))
+        return None
+    if number <= 0:
+        problems.append('%s must be positive, got %r' % (what, value))
+        return None
+    return number
+
+
+def _ip(parser, value, what, problems):
+    """
+    Parse an IP address or interface, record a problem if impossible
+    """
+    if value is None:
+        return None
+    if not isinstance(value, str):
+        problems.append('%s must be a string, got %r' % (what, value))
+        return None
+    try:
+        return parser(value)
+    except (TypeError, ValueError):
+        problems.append('%s is not a valid address: %r' % (what, value))
+        return None
+
+
+def _mount_order(disk):
+    """
+    Sort key mounting parent mountpoints before their children
+    """
+    mountpoint = disk.mountpoint.rstrip('/')
+    return (mountpoint.count('/'), mountpoint)
+
+
+def _compile_disk(fqdn, alias, details, guesttype, problems):
+    """
+    Compile a single disk definition
+    """
+    what = 'disk %s' % alias
+    if not isinstance(details, dict):
+        problems.append('%s must be an object' % what)
+        return None
+    match = re.match(r'^.*?([0-9]+)$', alias)
+    if not match:
+        problems.append('%s: alias must end with a disk number' % what)
+    capacity = _positive_int(details.get('capacity'),
+                             '%s: capacity' % what, problems)
+    if not details.get('pool'):
+        problems.append('%s: pool is missing' % what)
+    if not re.match(r'^[hsv]d[a-z]+$', str(details.get('target', ''))):
+        problems.append('%s: invalid target %r' % (what,
+                                                   details.get('target')))
+    bus = details.get('bus', 'virtio')
+    if bus not in DISK_BUSES:
+        problems.append('%s: unsupported bus %r' % (what, bus))
+    elif bus == 'scsi' and \
+            not str(details.get('target', '')).startswith('sd'):
+        problems.append('%s: scsi disks need an sd* target' % what)
+    driver = _compile_driver(what, details.get('driver', {}), problems)
+    fstype = details.get('fstype')
+    mountpoint = details.get('mountpoint')
+    if isinstance(mountpoint, str) and mountpoint.startswith('/'):
+        mountpoint = posixpath.normpath(mountpoint)
+    if guesttype != 'plain':
+        if fstype in FILESYSTEMS:
+            if not isinstance(mountpoint, str) or \
+                    not mountpoint.startswith('/'):
+                problems.append('%s: mountpoint must be an absolute path'
+                                % what)
+        elif fstype != 'swap':
+            problems.append('%s: unsupported fstype %r' % (what, fstype))
+    preallocation = details.get('preallocation', 'metadata')
+    if preallocation not in PREALLOCATION:
+        problems.append('%s: unsupported preallocation %r'
+                        % (what, preallocation))
+    fsprofile = details.get('fsprofile', {})
+    if not isinstance(fsprofile, dict):
+        problems.append('%s: fsprofile must be an object' % what)
+    else:
+        for key in sorted(set(fsprofile) - set(FSPROFILE)):
+            problems.append('%s: unknown fsprofile option %r' % (what, key))
+        if 'commit' in fsprofile:
+            _positive_int(fsprofile['commit'], '%s: commit' % what, problems)
+    return DiskPlan(
+        alias,
+        # disk00 is disk number 0 as well
+        str(int(match.group(1))) if match else None,
+        '%s-%s.qcow2' % (fqdn, alias),
+        details.get('pool'),
+        capacity * 1073741824 if capacity else None,
+        fstype,
+        mountpoint if fstype in FILESYSTEMS else None,
+        details.get('target'),
+        bus,
+        _freeze(driver),
+        preallocation,
+        _freeze(fsprofile) if isinstance(fsprofile, dict) else _freeze({})
+    )
+
+
+def _compile_driver(what, details, problems):
+    """
+    Compile the driver tuning of a disk
+
+    Attributes not defined are left to the defaults of libvirt and qemu.
+    """
+    if not isinstance(details, dict):
+        problems.append('%s: driver must be an object' % what)
+        return {}
+    driver = dict(details)
+    for key in sorted(set(driver) - set(DISK_DRIVER) - {'queues'}):
+        problems.append('%s: unknown driver option %r' % (what, key))
+    for key, values in sorted(DISK_DRIVER.items()):
+        if key in driver and driver[key] not in values:
+            problems.append('%s: unsupported %s %r'
+                            % (what, key, driver[key]))
+    if 'queues' in driver:
+        driver['queues'] = _positive_int(driver['queues'],
+                                         '%s: queues' % what, problems)
+    if driver.get('io') == 'native' and \
+            driver.get('cache') not in ('none', 'directsync'):
+        problems.append('%s: native io requires cache none or directsync'
+                        % what)
+    if driver.get('detect_zeroes') == 'unmap' and \
+            driver.get('discard') != 'unmap':
+        problems.append('%s: detect_zeroes unmap requires discard unmap'
+                        % what)
+    return driver
+
+
+def _compile_network(alias, details, vcpu, problems):
+    """
+    Compile a single network definition
+    """
+    what = 'network %s' % alias
+    if not isinstance(details, dict):
+        problems.append('%s must be an object' % what)
+        return None
+    if not details.get('bridge'):
+        problems.append('%s: bridge is missing' % what)
+    vlan = details.get('vlan')
+    if vlan is not None:
+        vlan = _positive_int(vlan, '%s: vlan' % what, problems)
+        if vlan is not None and vlan > 4094:
+            problems.append('%s: vlan must be below 4095' % what)
+    dns = []
+    addresses = {}
+    for family in ('ipv4', 'ipv6'):
+        config = details.get(family) or {}
+        if not isinstance(config, dict):
+            problems.append('%s: %s must be an object' % (what, family))
+            config = {}
+        address = _ip(ipaddress.ip_interface, config.get('address'),
+                      '%s: %s address' % (what, family), problems)
+        gateway = _ip(ipaddress.ip_address, config.get('gateway'),
+                      '%s: %s gateway' % (what, family), problems)
+        version = 4 if family == 'ipv4' else 6
+        for ip in (address, gateway):
+            if ip is not None and ip.version != version:
+                problems.append('%s: %s is not an %s address'
+                                % (what, ip, family))
+        if gateway is not None and config.get('address') is None:
+            problems.append('%s: %s gateway without address' % (what, family))
+        servers = config.get('dns', [])
+        if not isinstance(servers, list):
+            problems.append('%s: %s dns must be a list' % (what, family))
+            servers = []
+        for server in servers:
+            if server is None:
+                problems.append('%s: %s dns must be a string, got None'
+                                % (what, family))
+                continue
+            dns.append(_ip(ipaddress.ip_address, server,
+                           '%s: %s dns' % (what, family), problems))
+        addresses[family] = (address, gateway)
+    # one queue pair per vcpu, so packet processing scales with the vcpus
+    queues = _positive_int(details.get('queues', vcpu or 1),
+                           '%s: queues' % what, problems)
+    sizes = {}
+    for key, default in (('rx_queue_size', 1024), ('tx_queue_size', None)):
+        sizes[key] = details.get(key, default)
+        if sizes[key] is not None and sizes[key] not in NETWORK_QUEUE_SIZES:
+            problems.append('%s: %s must be one of %s' % (
+                what, key, ', '.join(str(size) for size in NETWORK_QUEUE_SIZES)
+            ))
+    return NetworkPlan(
+        alias,
+        details.get('bridge'),
+        vlan,
+        addresses['ipv4'][0],
+        addresses['ipv4'][1],
+        addresses['ipv6'][0],
+        addresses['ipv6'][1],
+        tuple(dns),
+        queues,
+        sizes['rx_queue_size'],
+        sizes['tx_queue_size']
+    )
+
+
+def _compile_cpu(details, vcpu, problems):
+    """
+    Compile the cpu definition of a domain
+    """
+    if not isinstance(details, dict):
+        problems.append('cpu must be an object')
+        details = {}
+    mode = details.get('mode', 'host-passthrough')
+    if mode not in CPU_MODES:
+        problems.append('cpu: unsupported mode %r' % mode)
+    model = details.get('model')
+    if mode == 'custom' and not model:
+        problems.append('cpu: custom mode requires a model')
+    elif mode != 'custom' and model:
+        problems.append('cpu: model requires custom mode')
+    features = details.get('features', {})
+    if not isinstance(features, dict):
+        problems.append('cpu: features must be an object')
+        features = {}
+    for name, policy in sorted(features.items()):
+        if policy not in CPU_FEATURE_POLICIES:
+            problems.append('cpu: unsupported policy %r of feature %s'
+                            % (policy, name))
+    topology = details.get('topology', {})
+    if not isinstance(topology, dict):
+        problems.append('cpu: topology must be an object')
+        topology = {}
+    sockets = _positive_int(topology.get('sockets', 1), 'cpu: sockets',
+                            problems)
+    threads = _positive_int(topology.get('threads', 1), 'cpu: threads',
+                            problems)
+    cores = topology.get('cores')
+    if cores is None and vcpu and sockets and threads:
+        cores = vcpu // (sockets * threads)
+    # without vcpus, there is nothing to derive the cores from
+    if cores is not None or vcpu is not None:
+        cores = _positive_int(cores, 'cpu: cores', problems)
+    if vcpu and sockets and cores and threads and \
+            sockets * cores * threads != vcpu:
+        problems.append('cpu: topology %dx%dx%d does not match %d vcpus'
+                        % (sockets, cores, threads, vcpu))
+    return CpuPlan(mode, model, _freeze(features), sockets, cores, threads)
+
+
+def _compile_template(details, engine, problems):
+    """
+    Compile the template definition of a domain
+    """
+    if details is None:
+        return None
+    if not isinstance(details, dict):
+        problems.append('template must be an object')
+        return None
+    if not isinstance(details.get('domain'), str) or \
+            not details.get('domain'):
+        problems.append('template: domain is missing')
+    if not isinstance(details.get('overlay', False), bool):
+        problems.append('template: overlay must be true or false')
+    if engine == 'offline':
+        problems.append('template: not supported by the offline engine')
+    return TemplatePlan(details.get('domain'), details.get('overlay', False))
+
+
+def template_volumes(conn, name):
+    """
+    Volumes of a template domain, keyed by their target device
+
+    :param conn - Libvirt connection
+    :param name - Name of the template domain
+    """
+    volumes = {}
+    template_xml = ElementTree.fromstring(conn.lookupByName(name).XMLDesc(0))
+    for disk in template_xml.iter('disk'):
+        source = disk.find('source')
+        target = disk.find('target')
+        if source is None or target is None or 'file' not in source.attrib:
+            continue
+        volumes[target.attrib['dev']] = conn.storageVolLookupByPath(
+            source.attrib['file']
+        )
+    return volumes
+
+
+def compile_definition(definition, name='definition'):
+    """
+    Validate a VM definition and compile it into a DomainPlan
+
+    All problems found are collected and raised as a single RuntimeError.
+
+    :param definition - JSON definition of domain
+    :param name - Name of the definition used in messages (f.e. its path)
+    """
+    if not isinstance(definition, dict):
+        raise RuntimeError('Invalid %s: must be an object' % name)
+    problems = []
+    for key in sorted(set(definition) - set(KEYS)):
+        LOG.warning('Unknown key %r in %s', key, name)
+    for key in ('hostname', 'fqdn'):
+        if not isinstance(definition.get(key), str) or \
+                not definition.get(key):
+            problems.append('%s is missing' % key)
+    fqdn = definition.get('fqdn')
+    guesttype = definition.get('guesttype')
+    if guesttype not in GUESTTYPES:
+        problems.append('unsupported guesttype %r' % guesttype)
+    engine = definition.get('engine', 'nbd')
+    if engine not in ENGINES:
+        problems.append('unsupported engine %r' % engine)
+    machine = definition.get('machine', 'pc')
+    if machine not in MACHINES:
+        problems.append('unsupported machine %r' % machine)
+    vcpu = _positive_int(definition.get('vcpu'), 'vcpu', problems)
+    memory = _positive_int(definition.get('memory'), 'memory', problems)
+    cpu = _compile_cpu(definition.get('cpu', {}), vcpu, problems)
+    memory_profile = definition.get('memory_profile', 'dedicated')
+    if memory_profile not in MEMORY_PROFILES:
+        problems.append('unsupported memory_profile %r' % memory_profile)
+
+    disks = []
+    if not isinstance(definition.get('disks'), dict) or \
+            not definition.get('disks'):
+        problems.append('disks are missing')
+    else:
+        for alias, details in sorted(definition['disks'].items()):
+            disk = _compile_disk(fqdn, alias, details, guesttype, problems)
+            if disk is not None:
+                disks.append(disk)
+    for field in ('number', 'target', 'mountpoint'):
+        values = [getattr(disk, field) for disk in disks
+                  if getattr(disk, field) is not None]
+        for value in sorted(set(values)):
+            if values.count(value) > 1:
+                problems.append('%s %s used by multiple disks'
+                                % (field, value))
+    iothreads = definition.get('iothreads')
+    if iothreads is None:
+        iothreads = min(len(disks), vcpu or 1)
+    elif isinstance(iothreads, bool) or iothreads != 0:
+        iothreads = _positive_int(iothreads, 'iothreads', problems)
+    mounts = tuple(sorted(
+        (disk for disk in disks if disk.mountpoint is not None),
+        key=_mount_order
+    ))
+    if engine == 'offline':
+        # filesystems are populated by mkfs, which only ext4 supports
+        for disk in disks:
+            if disk.fstype not in ('ext4', 'swap'):
+                problems.append('disk %s: fstype %r not supported by the '
+                                'offline engine' % (disk.alias, disk.fstype))
+    if guesttype in ('archlinux', 'ubuntu'):
+        if not any(disk.mountpoint == '/' for disk in disks):
+            problems.append('no disk is mounted as /')
+        if not any(disk.number == '0' for disk in disks):
+            problems.append('no boot disk (disk number 0) defined')
+
+    networks = []
+    if not isinstance(definition.get('networks', {}), dict):
+        problems.append('networks must be an object')
+    else:
+        for alias, details in sorted(definition.get('networks', {}).items()):
+            network = _compile_network(alias, details, vcpu, problems)
+            if network is not None:
+                networks.append(network)
+
+    rng_bytes = None
+    if 'rng' in definition:
+        rng = definition['rng'] or {}
+        if not isinstance(rng, dict):
+            problems.append('rng must be an object')
+            rng = {}
+        rng_bytes = _positive_int(rng.get('bytes', 2048), 'rng bytes',
+                                  problems)
+
+    template = _compile_template(definition.get('template'), engine,
+                                 problems)
+    if template is not None:
+        for disk in disks:
+            # cloned volumes are copied, not recreated fully allocated
+            if disk.preallocation == 'full':
+                problems.append('disk %s: full preallocation cannot be '
+                                'combined with a template' % disk.alias)
+
+    access = definition.get('access') or {}
+    if not isinstance(access, dict):
+        problems.append('access must be an object')
+        access = {}
+    sshkeys = access.get('ssh-keys') or {}
+    if not isinstance(sshkeys, dict):
+        problems.append('access: ssh-keys must be an object')
+        sshkeys = {}
+    for key, value in sorted(sshkeys.items()):
+        if not isinstance(value, dict) or \
+                not value.get('type') or not value.get('key'):
+            problems.append('ssh-key %s needs a type and a key' % key)
+    password = access.get('password')
+    if password is not None and not isinstance(password, str):
+        problems.append('access: password must be a string')
+
+    if problems:
+        raise RuntimeError('Invalid %s:\n  %s' % (name, '\n  '.join(problems)))
+    return DomainPlan(
+        fqdn,
+        definition.get('hostname'),
+        guesttype,
+        engine,
+        machine,
+        cpu,
+        vcpu,
+        memory,
+        memory_profile,
+        iothreads,
+        tuple(disks),
+        mounts,
+        tuple(networks),
+        rng_bytes,
+        password,
+        _freeze(sshkeys) or None,
+        template,
+        _freeze(definition)
+    )
+
+
+def _check_template(conn, plan, problems):
+    """
+    Check the template of a plan, record problems found
+    """
+    name = plan.template.domain
+    try:
+        lv_domain = conn.lookupByName(name)
+        if lv_domain.isActive():
+            problems.append('template %s of %s is running'
+                            % (name, plan.fqdn))
+        template = LibvirtDomain(name)
+        template.xml = lv_domain.XMLDesc(0)
+        volumes = template_volumes(conn, name)
+    except libvirt.libvirtError:
+        problems.append('template %s of %s does not exist'
+                        % (name, plan.fqdn))
+        return
+    if template.guesttype != plan.guesttype:
+        problems.append('template %s has guesttype %s, %s has %s' % (
+            name, template.guesttype or 'unknown', plan.fqdn, plan.guesttype
+        ))
+    for disk in plan.disks:
+        if disk.target not in volumes:
+            problems.append('template %s has no disk %s for %s'
+                            % (name, disk.target, plan.fqdn))
+        elif disk.capacity < volumes[disk.target].info()[1]:
+            problems.append('disk %s of %s is smaller than its template'
+                            % (disk.alias, plan.fqdn))
+
+
+def check_plans(conn, plans, existing=()):
+    """
+    Check plans against libvirt, before any volume is created
+
+    Verifies that no domain or volume with the same name exists, that the
+    storage pools exist and have enough space for fully allocated volumes,
+    and that templates are shut off and provide all disks.
+    All problems are collected and raised as a single RuntimeError.
+
+    :param conn - Libvirt connection
+    :param plans - DomainPlans to be provisioned together
+    :param existing - FQDNs of domains resumed, which may exist already
+    """
+    problems = []
+    fqdns = [plan.fqdn for plan in plans]
+    for fqdn in sorted(set(fqdns)):
+        if fqdns.count(fqdn) > 1:
+            problems.append('domain %s is defined multiple times' % fqdn)
+    for fqdn in sorted(set(fqdns) - set(existing)):
+        try:
+            conn.lookupByName(fqdn)
+            problems.append('domain %s already exists' % fqdn)
+        except libvirt.libvirtError:
+            pass
+
+    for plan in plans:
+        if plan.template is None or plan.fqdn in existing:
+            continue
+        _check_template(conn, plan, problems)
+
+    pools = {}
+    for plan in plans:
+        if plan.fqdn in existing:
+            continue
+        for disk in plan.disks:
+            pools.setdefault(disk.pool, []).append(disk)
+    for name, disks in sorted(pools.items()):
+        try:
+            pool = conn.storagePoolLookupByName(name)
+        except libvirt.libvirtError:
+            problems.append('storage pool %s does not exist' % name)
+            continue
+        for disk in disks:
+            try:
+                pool.storageVolLookupByName(disk.name)
+                problems.append('volume %s already exists in pool %s'
+                                % (disk.name, name))
+            except libvirt.libvirtError:
+                pass
+        available = pool.info()[3]
+        # only fully allocated volumes reserve their capacity up front
+        required = sum(disk.capacity for disk in disks
+                       if disk.preallocation in ('falloc', 'full'))
+        if required > available:
+            problems.append(
+                'storage pool %s has %d bytes available, %d required'
+                % (name, available, required)
+            )
+        elif sum(disk.capacity for disk in disks) > available:
+            LOG.warning('Storage pool %s is overcommitted by the planned '
+                        'volumes', name)
+
+    if problems:
+        raise RuntimeError('Plan check failed:\n  %s' % '\n  '.join(problems))
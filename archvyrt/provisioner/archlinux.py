@@ -5,27 +5,64 @@ import logging
 import os
 # archvyrt
 import archvyrt.tools as tools
-from .base import LinuxProvisioner
+from .offline import OfflineProvisioner
 
 LOG = logging.getLogger(__name__)
 
 
-class ArchlinuxProvisioner(LinuxProvisioner):
+class ArchlinuxProvisioner(OfflineProvisioner):
     """
     ArchLinux Provisioner
     """
 
+    PACKAGE_CACHE = '/var/cache/pacman/pkg'
+
+    # pacman has no option to skip fsync
+    UNSAFE_IO_PRELOAD = True
+
     def _install(self):
         """
         ArchLinux base installation
         """
         LOG.info('Do ArchLinux installation')
+        self.bootstrap('rolling', self.packages, self._pacstrap)
+
+    def _pacstrap(self):
+        """
+        Bootstrap ArchLinux base system using pacstrap
+        """
+        env = os.environ.copy()
+        env.update(self.unsafe_io_env)
         self.run(
             tools.PACSTRAP,
             self.target,
-            'base'
+            *self.packages,
+            env=env
         )
 
+    def _packages(self):
+        """
+        Packages required, by provisioning phase
+        """
+        packages = super()._packages()
+        packages.update({
+            'install': ['base'],
+            'boot_config': ['grub'],
+            'access_config': ['openssh'],
+        })
+        return packages
+
+    def _package_files(self):
+        """
+        Package cache filename prefixes of all packages installed in the guest
+        """
+        prefixes = []
+        for line in self.runchroot('pacman', '-Q', output=True).splitlines():
+            fields = line.split()
+            if len(fields) == 2:
+                prefixes.append('%s-%s-' % tuple(fields))
+        return prefixes
+
     def _network_config(self):
         """
         Domain network configuration
@@ -55,9 +92,13 @@ class ArchlinuxProvisioner(LinuxProvisioner):
                 '/etc/netctl/%s' % network.name,
                 network.netctl
             )
+            # profiles of a template are enabled already
+            unit = '%s/etc/systemd/system/netctl@%s.service' % (
+                self.target, network.name
+            )
             self.runchroot(
                 'netctl',
-                'enable',
+                'reenable' if os.path.exists(unit) else 'enable',
                 network.name
             )
 
@@ -121,8 +162,12 @@ class ArchlinuxProvisioner(LinuxProvisioner):
         Domain bootloader, initrd configuration
         """
         LOG.info('Setup boot configuration')
+        modules = ['virtio', 'virtio_blk', 'virtio_pci', 'virtio_net',
+                   'virtio_balloon']
+        if any(disk.bus == 'scsi' for disk in self.domain.disks):
+            modules.append('virtio_scsi')
         self.writetargetfile('/etc/mkinitcpio.conf', [
-            'MODULES="virtio virtio_blk virtio_pci virtio_net"',
+            'MODULES="%s"' % ' '.join(modules),
             'BINARIES=""',
             'FILES=""',
             'HOOKS="base udev autodetect modconf block mdadm_udev lvm2 '
@@ -133,16 +178,18 @@ class ArchlinuxProvisioner(LinuxProvisioner):
             '-p',
             'linux'
         )
-        self.runchroot(
-            'pacman',
-            '-Syy',
-            '--noconfirm',
-            'grub'
-        )
+        # the offline engine installs the bootloader once the image is built
+        if not self.offline:
+            self._bootloader()
+
+    def _bootloader(self):
+        """
+        Install grub on the boot device
+        """
         self.runchroot(
             'grub-install',
             '--target=i386-pc',
-            '/dev/nbd0'
+            self.bootdev
         )
         self.runchroot(
             'grub-mkconfig',
@@ -156,7 +203,7 @@ class ArchlinuxProvisioner(LinuxProvisioner):
             '-i',
             '-e',
             's/vmlinuz-linux root=[^ ]*/vmlinuz-linux root=UUID=%s/' %
-            self._uuid['ext4']['/'],
+            self.rootuuid,
             '%s/boot/grub/grub.cfg' % self.target
         )
 
@@ -165,12 +212,6 @@ class ArchlinuxProvisioner(LinuxProvisioner):
         Domain access configuration such as sudo/ssh and local users
         """
         LOG.info('Setup ssh/local user access')
-        self.runchroot(
-            'pacman',
-            '-Syy',
-            '--noconfirm',
-            'openssh'
-        )
         self.runchroot(
             'systemctl',
             'enable',
@@ -194,7 +235,7 @@ class ArchlinuxProvisioner(LinuxProvisioner):
                 authorized_keys.append(
                     "%s %s %s" % (value['type'], value['key'], key)
                 )
-            os.mkdir('%s/root/.ssh' % self.target)
+            self.makedirstarget('/root/.ssh')
             self.writetargetfile(
                 '/root/.ssh/authorized_keys',
                 authorized_keys
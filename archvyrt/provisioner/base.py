@@ -1,26 +1,66 @@
 """archvyrt provisioner base module"""
 
 # stdlib
+import asyncio
+import contextlib
+import functools
+import glob
+import json
 import logging
 import os
 import subprocess
+import threading
 
 # archvyrt
 import archvyrt.tools as tools
+from archvyrt.engine import Engine
+from archvyrt.executor import SubprocessExecutor
+from archvyrt.nbd import NbdAllocator
+from archvyrt.plan import FILESYSTEMS
+from archvyrt.timing import TimingReport
 
 LOG = logging.getLogger(__name__)
 
+# guest files identifying a single machine, left out of cached bootstraps
+IDENTITY_FILES = (
+    '/etc/machine-id',
+    '/etc/ssh/ssh_host_*',
+    '/var/lib/dbus/machine-id',
+)
+
+# qemu-nbd options by provisioning io mode, native aio requires O_DIRECT and
+# thus cannot be combined with the write-back cache of the fast mode
+NBD_OPTIONS = {
+    'safe': ['-n'],
+    'fast': ['--cache=unsafe', '--aio=threads', '--discard=unmap'],
+}
+
+# compaction modes of volumes once provisioned
+COMPACT_MODES = ('sparse', 'compressed')
+
+# start sector of the data partition on the boot disk and on other disks
+BOOT_PART_START = 4096
+DATA_PART_START = 2048
+
 
 class Provisioner:
     """
     Base provisioner for domain
     """
 
-    def __init__(self, domain):
+    def __init__(self, domain, timing=None, executor=None):
         """
         Initialize provisioner
+
+        :param domain - Domain to provision
+        :param timing - TimingReport to record phases and commands in
+        :param executor - Executor running commands and file operations
         """
         self._domain = domain
+        self._timing = timing if timing is not None else TimingReport(None)
+        self._executor = (executor if executor is not None
+                          else SubprocessExecutor())
+        self._cancel = threading.Event()
 
     @property
     def domain(self):
@@ -29,44 +69,60 @@ class Provisioner:
         """
         return self._domain
 
-    @staticmethod
-    def _runcmd(cmds, output=False, **kwargs):
+    @property
+    def timing(self):
+        """
+        Timing report of this provisioner
+        """
+        return self._timing
+
+    async def _aruncmd(self, cmds, output=False, **kwargs):
         """
         Run a unix command
+
+        Wall clock time, CPU time and exit status of the command are
+        recorded in the timing report.
         """
-        # output shall be captured
-        if output:
-            LOG.debug('Run command: %s', ' '.join(cmds))
-            rval = subprocess.check_output(
-                cmds,
-                stderr=subprocess.STDOUT,
-                **kwargs
-            ).decode()
-        # output does not matter, send it to /dev/null
-        else:
-            with open(os.devnull, 'w') as devnull:
-                LOG.debug('Run command: %s', ' '.join(cmds))
-                rval = subprocess.call(
+        if self._cancel.is_set():
+            raise RuntimeError('Cancelled before running %s' % ' '.join(cmds))
+        LOG.debug('Run command: %s', ' '.join(cmds))
+        result = await self._executor.execute(cmds, output, **kwargs)
+        self._timing.command(
+            cmds,
+            result.wall,
+            result.cpu_user,
+            result.cpu_system,
+            result.returncode
+        )
+        if result.returncode != 0:
+            if output:
+                raise subprocess.CalledProcessError(
+                    result.returncode,
                     cmds,
-                    stdout=devnull,
-                    stderr=devnull,
-                    **kwargs
+                    output=result.output
                 )
-            if rval != 0:
-                raise RuntimeError(
-                    'Command %s failed, env: %s' % (' '.join(cmds),
-                                                    kwargs.get('env', 'default'))
-                )
-        return rval
+            raise RuntimeError(
+                'Command %s failed, env: %s' % (' '.join(cmds),
+                                                kwargs.get('env', 'default'))
+            )
+        if output:
+            return result.output
+        return result.returncode
+
+    def _runcmd(self, cmds, output=False, **kwargs):
+        """
+        Run a unix command, blocking until it is completed
+
+        Must not be called from a coroutine, use _aruncmd() there.
+        """
+        return asyncio.run(self._aruncmd(cmds, output, **kwargs))
 
-    @staticmethod
-    def writefile(filename, lines, mode='w'):
+    def writefile(self, filename, lines, mode='w'):
         """
         Write to a file
         """
         LOG.debug('Write file %s', filename)
-        with open(filename, mode) as fobj:
-            fobj.write('%s\n' % '\n'.join(lines))
+        self._executor.writefile(filename, lines, mode)
 
     def cleanup(self):
         """
@@ -80,22 +136,104 @@ class LinuxProvisioner(Provisioner):
     Linux Base Provisioner
     """
 
-    def __init__(self, domain, target="/provision"):
+    # package cache directory in the guest
+    PACKAGE_CACHE = None
+
+    # phases followed by a snapshot of all disks
+    CHECKPOINTS = ('install', 'boot_config')
+
+    # guest files (path: lines) making the package manager skip fsync, while
+    # provisioning with unsafe io
+    UNSAFE_IO_FILES = {}
+
+    # preload libeatmydata into bootstrap and guest commands, while
+    # provisioning with unsafe io
+    UNSAFE_IO_PRELOAD = False
+
+    # pylint: disable=too-many-arguments,too-many-locals
+    def __init__(self, domain, target="/provision", cache=None, nbd=None,
+                 pkgcache=None, timing=None, executor=None, concurrency=4,
+                 journal=None, io_mode='safe', unsafe_io=False,
+                 compact=None):
         """
         Initializes and runs the provisioner.
+
+        :param domain - Domain to provision
+        :param target - Temporary mountpoint for provisioning
+        :param cache - BootstrapCache to reuse bootstrapped guests from
+        :param nbd - NbdAllocator to allocate nbd devices from
+        :param pkgcache - PackageCache shared with the guest during install
+        :param timing - TimingReport to record phases and commands in
+        :param executor - Executor running commands and file operations
+        :param concurrency - Maximum number of steps running concurrently
+        :param journal - Started CheckpointJournal to record phases and
+                         snapshots in, provisioning resumes from its latest
+                         snapshot
+        :param io_mode - Cache mode of attached disks, safe or fast (unsafe
+                         write-back cache, flushed before disconnecting)
+        :param unsafe_io - Suppress fsync of the package manager in the
+                           guest, the filesystems are synced once before
+                           they are unmounted
+        :param compact - Compact volumes once provisioned, sparse (trim and
+                         rewrite) or compressed (additionally compress)
         """
-        super().__init__(domain)
+        super().__init__(domain, timing, executor)
+        if io_mode not in NBD_OPTIONS:
+            raise RuntimeError('Unsupported io mode %s' % io_mode)
+        self._io_mode = io_mode
+        self._timing.io_mode = io_mode
+        self._unsafe_io = unsafe_io
+        self._timing.unsafe_io = unsafe_io
+        if compact is not None and compact not in COMPACT_MODES:
+            raise RuntimeError('Unsupported compaction %s' % compact)
+        self._compact = compact
         self._target = target
+        self._cache = cache
+        self._nbd = nbd if nbd is not None else NbdAllocator()
+        self._pkgcache = pkgcache
+        self._pkgcache_snapshot = None
+        self._pkgcache_mounted = False
+        self._bootdev = None
+        self._devices = []
         self._uuid = {}
         self._cleanup = []
+        self._offline = domain.plan.engine == 'offline'
+        self._template = domain.plan.template
+        # arch-chroot mounts api filesystems into the target for each
+        # invocation, so concurrent chroot commands would clobber each other
+        self._chroot_lock = threading.Lock()
+        self._concurrency = concurrency
+        self._journal = journal
+        self._resume_from = None
+        self._skip = set()
+        if journal is not None and journal.snapshot and not self._offline:
+            self._resume_from = journal.snapshot['name']
+            # disks and package cache are attached again on resume
+            self._skip = set(journal.snapshot['phases']) - {
+                'prepare_disks', 'mount_package_cache'
+            }
+            LOG.info('Resume %s from snapshot %s',
+                     domain.fqdn, self._resume_from)
 
-        self._prepare_disks()
-        self._install()
-        self._network_config()
-        self._locale_config()
-        self._fstab_config()
-        self._boot_config()
-        self._access_config()
+        checkpoints = {}
+        engine = Engine(concurrency=concurrency, cancel=self._cancel)
+        for name, after in self._phases():
+            engine.add(name, self._timed(name),
+                       [checkpoints.get(phase, phase) for phase in after])
+            if journal is not None and name in self.CHECKPOINTS and \
+                    not self._offline:
+                checkpoints[name] = 'checkpoint_%s' % name
+                engine.add(checkpoints[name],
+                           functools.partial(self._checkpoint, name),
+                           (name,))
+        try:
+            engine.run_sync()
+        except BaseException:
+            self._cancel.clear()
+            # leave the disks detached, so provisioning can be resumed
+            self._detach_disks(ignore_errors=True)
+            raise
+        self._cancel.clear()
 
     @property
     def target(self):
@@ -104,14 +242,158 @@ class LinuxProvisioner(Provisioner):
         """
         return self._target
 
-    def run(self, *cmds, output=False, **kwargs):
+    @property
+    def rootuuid(self):
+        """
+        UUID of the root filesystem
+        """
+        for fstype in FILESYSTEMS:
+            if '/' in self._uuid.get(fstype, {}):
+                return self._uuid[fstype]['/']
+        return None
+
+    @property
+    def offline(self):
+        """
+        Whether the guest is built in a staging directory (offline engine)
+        instead of on nbd attached disks
+        """
+        return self._offline
+
+    @property
+    def template(self):
+        """
+        Template the guest is cloned from, None if built from scratch
+        """
+        return self._template
+
+    @property
+    def bootdev(self):
+        """
+        Block device of the boot disk, while it is attached to the host
+        """
+        return self._bootdev
+
+    def _phases(self):
+        """
+        Provisioning phases and the phases they depend on
+
+        Guests cloned from a template only redo the per-guest phases.
+        """
+        if self._template is not None:
+            return (
+                ('prepare_disks', ()),
+                ('network_config', ('prepare_disks',)),
+                ('fstab_config', ('prepare_disks',)),
+                ('identity_config', ('prepare_disks',)),
+                ('bootloader', ('fstab_config',)),
+                ('access_config', ('identity_config',)),
+                ('finalize', ('network_config', 'bootloader',
+                              'access_config')),
+            )
+        return (
+            ('prepare_disks', ()),
+            ('mount_package_cache', ('prepare_disks',)),
+            ('install', ('mount_package_cache',)),
+            ('network_config', ('install',)),
+            ('locale_config', ('install',)),
+            ('fstab_config', ('install',)),
+            ('boot_config', ('network_config', 'locale_config',
+                             'fstab_config')),
+            ('access_config', ('boot_config',)),
+            ('umount_package_cache', ('access_config',)),
+            ('finalize', ('umount_package_cache',)),
+        )
+
+    def _timed(self, name):
+        """
+        Phase method for a phase name, wrapped to record its timing
+
+        :param name - Name of the phase
+        """
+        phase = getattr(self, '_%s' % name)
+        if name in self._skip:
+            def timed_phase():
+                LOG.info('Skip phase %s, completed before', name)
+        elif asyncio.iscoroutinefunction(phase):
+            async def timed_phase():
+                with self._timing.phase(name):
+                    await phase()
+                self._completed(name)
+        else:
+            def timed_phase():
+                with self._timing.phase(name):
+                    phase()
+                self._completed(name)
+        return timed_phase
+
+    def _completed(self, name):
+        """
+        Record a completed phase in the checkpoint journal
+
+        :param name - Name of the phase
+        """
+        if self._journal is not None:
+            self._journal.complete(name)
+
+    def _checkpoint(self, phase):
+        """
+        Snapshot all disks after a phase
+
+        qemu-nbd holds a write lock on the images, so disks are detached
+        while the snapshot is taken, _detach_disks() waits for the qemu-nbd
+        clients to exit.
+
+        :param phase - Name of the phase just completed
+        """
+        name = 'archvyrt-%s' % phase
+        if name in self._journal.snapshots:
+            return
+        with self._timing.phase('checkpoint_%s' % phase):
+            LOG.info('Snapshot disks after %s', phase)
+            pkgcache = self._pkgcache_mounted
+            self._unbind_package_cache()
+            self._detach_disks()
+            for disk in self.domain.disks:
+                self.run(
+                    tools.QEMU_IMG,
+                    'snapshot',
+                    '-c', name,
+                    disk.path
+                )
+            self._journal.snapshot_taken(name)
+            asyncio.run(self._attach_disks())
+            if pkgcache:
+                self._bind_package_cache()
+
+    @property
+    def unsafe_io_env(self):
+        """
+        Environment preloading libeatmydata, if provisioning with unsafe io
+
+        Only meant for the bootstrap and package installation commands, the
+        library is removed from the guest once provisioned.
+        """
+        if self._unsafe_io and self.UNSAFE_IO_PRELOAD:
+            return {'LD_PRELOAD': tools.LIBEATMYDATA}
+        return {}
+
+    async def arun(self, *cmds, output=False, **kwargs):
         """
         Runs a command, ensures proper environment
         """
         env = kwargs.pop('env', os.environ.copy())
-        return self._runcmd(cmds, output, env=env, **kwargs)
+        return await self._aruncmd(cmds, output, env=env, **kwargs)
 
-    def runchroot(self, *cmds, output=False, add_env=None, **kwargs):
+    def run(self, *cmds, output=False, **kwargs):
+        """
+        Runs a command, ensures proper environment
+
+        Blocking variant of arun()
+        """
+        return asyncio.run(self.arun(*cmds, output=output, **kwargs))
+
+    async def arunchroot(self, *cmds, output=False, add_env=None, **kwargs):
         """
         Runs a command in the guest
         """
@@ -126,7 +408,23 @@ class LinuxProvisioner(Provisioner):
             env.update(add_env)
         chroot_cmds = (tools.ARCH_CHROOT,
                        self.target) + cmds
-        return self.run(*chroot_cmds, output=output, env=env, **kwargs)
+        # poll the lock, to not block the event loop
+        while not self._chroot_lock.acquire(blocking=False):
+            await asyncio.sleep(0.05)
+        try:
+            return await self.arun(*chroot_cmds, output=output, env=env,
+                                   **kwargs)
+        finally:
+            self._chroot_lock.release()
+
+    def runchroot(self, *cmds, output=False, add_env=None, **kwargs):
+        """
+        Runs a command in the guest
+
+        Blocking variant of arunchroot()
+        """
+        return asyncio.run(self.arunchroot(*cmds, output=output,
+                                           add_env=add_env, **kwargs))
 
     def writetargetfile(self, filename, lines, mode='w'):
         """
@@ -140,148 +438,715 @@ class LinuxProvisioner(Provisioner):
         Change permission of file in the guest
         """
         targetfilename = "%s%s" % (self.target, filename)
-        os.chmod(targetfilename, chmod)
+        self._executor.chmod(targetfilename, chmod)
+
+    def makedirstarget(self, path):
+        """
+        Create a directory (including missing parents) in the guest
+        """
+        self._executor.makedirs("%s%s" % (self.target, path), exist_ok=True)
 
     def deletetargetfile(self, filename):
         """
         Delete a file in the guest
         """
         targetfilename = "%s%s" % (self.target, filename)
-        os.remove(targetfilename)
+        self._executor.remove(targetfilename)
+
+    @property
+    def packages(self):
+        """
+        Packages required by all provisioning phases
+
+        These are installed in one transaction during the base installation.
+        """
+        packages = set()
+        for phase_packages in self._packages().values():
+            packages.update(phase_packages)
+        return sorted(packages)
+
+    def _packages(self):
+        """
+        Packages required, by provisioning phase
+        """
+        packages = {}
+        if any(disk.fstype == 'xfs' for disk in self.domain.disks):
+            packages['fstab_config'] = ['xfsprogs']
+        if any(network.ethtool for network in self.domain.networks):
+            # enables the queue pairs of multiqueue network devices
+            packages['network_config'] = ['ethtool']
+        return packages
+
+    def bootstrap(self, release, packages, bootstrap):
+        """
+        Bootstrap the guest, reusing a cached bootstrap if available
+
+        :param release - Release of the guest distribution
+        :param packages - Packages installed by the bootstrap
+        :param bootstrap - Callable doing the actual bootstrap
+        """
+        self._enable_unsafe_io()
+        if self._cache is None:
+            with self._package_cache_lock():
+                bootstrap()
+            return
+        key = self._cache.key(self.domain.guesttype, release, packages)
+        archive = self._cache.lookup(key)
+        if archive:
+            self.run(
+                tools.TAR,
+                '--numeric-owner',
+                '--xattrs',
+                '--acls',
+                '-xzpf',
+                archive,
+                '-C',
+                self.target
+            )
+            self._reset_identity()
+            return
+        try:
+            with self._package_cache_lock():
+                bootstrap()
+            self.run(
+                tools.TAR,
+                '--numeric-owner',
+                '--xattrs',
+                '--acls',
+                '--exclude=./lost+found',
+                '--exclude=.%s/*' % self.PACKAGE_CACHE,
+                *('--exclude=.%s' % path for path in self._unsafe_io_files()),
+                *('--exclude=.%s' % path for path in IDENTITY_FILES),
+                '-czf',
+                self._cache.partial(key),
+                '-C',
+                self.target,
+                '.'
+            )
+        except BaseException:
+            self._cache.abandon(key)
+            raise
+        self._cache.commit(key)
+
+    def _unsafe_io_files(self):
+        """
+        Guest files placed to suppress fsync, removed once provisioned
+        """
+        files = list(self.UNSAFE_IO_FILES)
+        if self.UNSAFE_IO_PRELOAD:
+            files.append(tools.LIBEATMYDATA)
+        return files
+
+    def _enable_unsafe_io(self):
+        """
+        Make the package manager in the guest skip fsync
+
+        libeatmydata is copied to the same path in the guest, so it is
+        preloaded by commands run on the host and in the chroot alike.
+        """
+        if not self._unsafe_io:
+            return
+        LOG.info('Suppress fsync while installing %s', self.domain.fqdn)
+        for path, lines in self.UNSAFE_IO_FILES.items():
+            self.makedirstarget(os.path.dirname(path))
+            self.writetargetfile(path, lines)
+        if self.UNSAFE_IO_PRELOAD:
+            if not os.path.exists(tools.LIBEATMYDATA):
+                raise RuntimeError('Unsafe io requires %s (libeatmydata)'
+                                   % tools.LIBEATMYDATA)
+            self.makedirstarget(os.path.dirname(tools.LIBEATMYDATA))
+            self.run(
+                tools.CP,
+                tools.LIBEATMYDATA,
+                '%s%s' % (self.target, tools.LIBEATMYDATA)
+            )
+
+    def _finalize(self):
+        """
+        Remove provisioning helpers from the guest
+
+        Helpers are looked up regardless of the io mode, a resumed run may
+        continue from a snapshot taken with unsafe io.
+        """
+        for path in self._unsafe_io_files():
+            if os.path.exists('%s%s' % (self.target, path)):
+                self.deletetargetfile(path)
+
+    def _mount_package_cache(self):
+        """
+        Bind-mount the shared host package cache into the guest
+        """
+        if self._pkgcache is None:
+            return
+        self._pkgcache_snapshot = self._pkgcache.snapshot(
+            self.domain.guesttype
+        )
+        self._bind_package_cache()
+
+    def _package_cache_lock(self):
+        """
+        Context manager serializing package downloads into the shared
+        package cache, with concurrent provisioners of the same guest type
+        """
+        if self._pkgcache is None:
+            return contextlib.nullcontext()
+        return self._pkgcache.lock(self.domain.guesttype)
+
+    def _bind_package_cache(self):
+        """
+        Bind-mount the package cache directory into the guest
+        """
+        guestdir = '%s%s' % (self.target, self.PACKAGE_CACHE)
+        self._executor.makedirs(guestdir, exist_ok=True)
+        self.run(
+            tools.MOUNT,
+            '--bind',
+            self._pkgcache.directory(self.domain.guesttype),
+            guestdir
+        )
+        self._pkgcache_mounted = True
+
+    def _unbind_package_cache(self):
+        """
+        Unmount the package cache directory from the guest, if mounted
+        """
+        if not self._pkgcache_mounted:
+            return
+        self.run(
+            tools.UMOUNT,
+            '%s%s' % (self.target, self.PACKAGE_CACHE)
+        )
+        self._pkgcache_mounted = False
+
+    def _umount_package_cache(self):
+        """
+        Remove the shared host package cache from the guest again
+        """
+        if self._pkgcache is None:
+            return
+        self._unbind_package_cache()
+        self._pkgcache.report(
+            self.domain.guesttype,
+            self._pkgcache_snapshot,
+            self._package_files()
+        )
+
+    def _package_files(self):
+        """
+        Package cache filename prefixes of all packages installed in the guest
+        """
+        raise NotImplementedError
 
     def cleanup(self):
         """
         Cleanup actions, such as unmounting and disconnecting disks
         """
+        with self._timing.phase('cleanup'):
+            if self._compact and not self._offline:
+                self._trim()
+            self._detach_disks()
+            if self._journal is not None:
+                for name in self._journal.snapshots:
+                    for disk in self.domain.disks:
+                        self.run(
+                            tools.QEMU_IMG,
+                            'snapshot',
+                            '-d', name,
+                            disk.path
+                        )
+                self._journal.discard()
+        if self._compact and not self._offline:
+            with self._timing.phase('compact'):
+                asyncio.run(self._compact_volumes())
+
+    def _trim(self):
+        """
+        Discard unused blocks of all mounted filesystems
+
+        Disks are attached with discard enabled, so freed blocks are
+        unmapped in the images and dropped when compacting.
+        """
+        LOG.info('Trim filesystems of %s', self.domain.fqdn)
+        for disk in self.domain.mounts:
+            self.run(
+                tools.FSTRIM,
+                '%s/%s' % (self.target, disk.mountpoint.lstrip('/'))
+            )
+
+    async def _compact_volumes(self):
+        """
+        Rewrite all volumes, dropping unallocated and zero clusters
+        """
+        reclaimed = {}
+        await asyncio.gather(*(
+            self._compact_volume(disk, reclaimed)
+            for disk in self.domain.disks
+        ))
+        self._timing.reclaimed = reclaimed
+
+    async def _compact_volume(self, disk, reclaimed):
+        """
+        Rewrite a single volume, compressed if requested
+
+        :param disk - Disk to compact
+        :param reclaimed - dict to store the bytes reclaimed in, keyed by
+                           volume name
+        """
+        if disk.preallocation in ('falloc', 'full'):
+            LOG.info('Skip compacting %s, fully preallocated', disk.name)
+            return
+        if self._template is not None and self._template.overlay:
+            LOG.info('Skip compacting %s, overlay of its template', disk.name)
+            return
+        before = await self._allocation(disk.path)
+        image = '%s.compact' % disk.path
+        compress = ['-c'] if self._compact == 'compressed' else []
+        try:
+            await self.arun(
+                tools.QEMU_IMG,
+                'convert',
+                '-f', 'qcow2',
+                '-O', 'qcow2',
+                *compress,
+                disk.path,
+                image
+            )
+            for tool in (tools.CHOWN, tools.CHMOD):
+                await self.arun(
+                    tool,
+                    '--reference=%s' % disk.path,
+                    image
+                )
+            await self.arun(
+                tools.MV,
+                '-f',
+                image,
+                disk.path
+            )
+        except BaseException:
+            await self.arun(
+                tools.RM,
+                '-f',
+                image
+            )
+            raise
+        reclaimed[disk.name] = before - await self._allocation(disk.path)
+        LOG.info('Compacted %s, %d bytes reclaimed',
+                 disk.name, reclaimed[disk.name])
+
+    async def _allocation(self, path):
+        """
+        Bytes allocated on the host by an image
+
+        :param path - Path of the image
+        """
+        return json.loads(await self.arun(
+            tools.QEMU_IMG,
+            'info',
+            '--output=json',
+            path,
+            output=True
+        ))['actual-size']
+
+    def _detach_disks(self, ignore_errors=False):
+        """
+        Unmount and disconnect all disks
+
+        :param ignore_errors - Log failing commands and continue
+        """
+        if ignore_errors:
+            try:
+                self._unbind_package_cache()
+            except (RuntimeError, subprocess.CalledProcessError):
+                LOG.warning('Unmounting package cache failed')
         for cmd in reversed(self._cleanup):
-            self.run(*cmd)
+            if cmd[0] in (tools.BLOCKDEV, tools.SYNC):
+                phase = self._timing.phase('flush')
+            else:
+                phase = contextlib.nullcontext()
+            try:
+                with phase:
+                    self.run(*cmd)
+            except (RuntimeError, subprocess.CalledProcessError):
+                if not ignore_errors:
+                    raise
+                LOG.warning('Cleanup command %s failed', ' '.join(cmd))
+        self._cleanup = []
+        # the allocator is shared with concurrent provisioners, only release
+        # the devices of this one, once their images are closed
+        for dev in self._devices:
+            try:
+                self._nbd.wait_disconnected(dev)
+            except RuntimeError:
+                if not ignore_errors:
+                    raise
+                LOG.warning('%s is still connected', dev)
+                continue
+            self._nbd.release(dev)
+        self._devices = []
 
-    def _prepare_disks(self):
+    async def _prepare_disks(self):
         """
         Format and mount disks
+
+        Disks are attached, partitioned and formatted concurrently, then
+        mounted in the order of their mountpoint depth. When resuming, disks
+        are reverted to the latest snapshot and attached without formatting.
+        Disks cloned from a template are personalized instead of formatted.
         """
         LOG.info('Prepare disks')
+        if self._resume_from:
+            await self._revert_disks(self._resume_from)
+            await self._attach_disks()
+            return
+        if self._template is not None:
+            await self._personalize_disks()
+            return
+        partitions = {}
+        engine = Engine(concurrency=self._concurrency, cancel=self._cancel)
         for disk in self.domain.disks:
-            dev = '/dev/nbd%s' % disk.number
-            cur_part = 0
-            # "mount" qcow2 image file as block device
-            self.run(
-                tools.QEMU_NBD,
-                '-n',
-                '-c',
-                dev,
+            engine.add(disk.alias, functools.partial(self._format_disk,
+                                                     disk, partitions))
+        await engine.run()
+        await self._mount_disks(partitions)
+
+    async def _revert_disks(self, name):
+        """
+        Revert all disks to a snapshot
+
+        :param name - Name of the qcow2 snapshot
+        """
+        LOG.info('Revert disks to snapshot %s', name)
+        await asyncio.gather(*(
+            self.arun(
+                tools.QEMU_IMG,
+                'snapshot',
+                '-a', name,
                 disk.path
             )
+            for disk in self.domain.disks
+        ))
+
+    async def _attach_disks(self):
+        """
+        Attach and mount already formatted disks
+        """
+        partitions = {}
+        engine = Engine(concurrency=self._concurrency, cancel=self._cancel)
+        for disk in self.domain.disks:
+            engine.add(disk.alias, functools.partial(self._attach_disk,
+                                                     disk, partitions))
+        await engine.run()
+        await self._mount_disks(partitions)
+
+    async def _personalize_disks(self):
+        """
+        Grow and personalize disks cloned from a template, then mount them
+        """
+        partitions = {}
+        engine = Engine(concurrency=self._concurrency, cancel=self._cancel)
+        for disk in self.domain.disks:
+            engine.add(disk.alias, functools.partial(self._personalize_disk,
+                                                     disk, partitions))
+        await engine.run()
+        await self._mount_disks(partitions)
+        for disk in self.domain.mounts:
+            if disk.fstype == 'xfs':
+                # xfs can only be grown while mounted
+                await self.arun(
+                    tools.XFS_GROWFS,
+                    '%s/%s' % (self.target, disk.mountpoint.lstrip('/'))
+                )
+
+    async def _personalize_disk(self, disk, partitions):
+        """
+        Attach a single disk cloned from a template
+
+        The data partition is grown to the capacity of the disk and the
+        filesystem gets a new UUID, so clones of a template can be told
+        apart.
+
+        :param disk - Disk to personalize
+        :param partitions - dict to store partition device and uuid in,
+                            keyed by disk alias
+        """
+        dev = await self._connect_disk(disk)
+        cur_part = 2 if disk.number == '0' else 1
+        start = BOOT_PART_START if cur_part == 2 else DATA_PART_START
+        # move the backup partition table to the end of the disk and
+        # recreate the data partition, up to the end of the disk
+        await self.arun(
+            tools.SGDISK,
+            '-e',
+            '-d', str(cur_part),
+            dev
+        )
+        endsector = int((await self.arun(
+            tools.SGDISK,
+            '-E',
+            dev,
+            output=True)).strip())
+        typecode = '8200' if disk.fstype == 'swap' else '8300'
+        await self.arun(
+            tools.SGDISK,
+            '-n', '%d:%d:%d' % (cur_part, start, endsector),
+            '-t', '%d:%s' % (cur_part, typecode),
+            dev
+        )
+        partition = '%sp%d' % (dev, cur_part)
+        if disk.fstype == 'ext4':
+            await self.arun(
+                tools.E2FSCK,
+                '-f',
+                '-p',
+                partition
+            )
+            await self.arun(
+                tools.RESIZE2FS,
+                partition
+            )
+            await self.arun(
+                tools.TUNE2FS,
+                '-U', 'random',
+                partition
+            )
+        elif disk.fstype == 'xfs':
+            await self.arun(
+                tools.XFS_ADMIN,
+                '-U', 'generate',
+                partition
+            )
+        elif disk.fstype == 'swap':
+            # swap holds no data, recreate it at the new size
+            await self.arun(
+                tools.MKSWAP,
+                '-f',
+                partition
+            )
+        else:
+            raise RuntimeError('Unsupported fstype %s' % disk.fstype)
+        partitions[disk.alias] = (partition, await self._blkid(partition))
+
+    async def _attach_disk(self, disk, partitions):
+        """
+        Attach a single formatted disk
+
+        :param disk - Disk to attach
+        :param partitions - dict to store partition device and uuid in,
+                            keyed by disk alias
+        """
+        dev = await self._connect_disk(disk)
+        # the boot disk holds the bios boot partition first
+        partition = '%sp%d' % (dev, 2 if disk.number == '0' else 1)
+        partitions[disk.alias] = (partition, await self._blkid(partition))
+
+    async def _mount_disks(self, partitions):
+        """
+        Mount attached disks and enable swap
+
+        :param partitions - Partition device and uuid, keyed by disk alias
+        """
+        for disk in self.domain.mounts:
+            partition, _ = partitions[disk.alias]
+            mountpoint = '%s/%s' % (self.target, disk.mountpoint.lstrip('/'))
+            if disk.mountpoint != '/':
+                # create mountpoint, exists already when reattaching
+                self._executor.makedirs(mountpoint, exist_ok=True)
+            await self.arun(
+                tools.MOUNT,
+                partition,
+                mountpoint
+            )
             self._cleanup.append([
-                tools.QEMU_NBD,
-                '-d',
-                dev,
+                tools.UMOUNT,
+                mountpoint,
             ])
-            # create empty partition table
-            self.run(
-                tools.SGDISK,
-                '-o',
-                dev
-            )
-            # On first disk, we create a bios boot partition
-            if disk.number == '0':
-                cur_part += 1
-                self.run(
-                    tools.SGDISK,
-                    '-n', '%d:2048:4095' % cur_part,
-                    '-t', '%d:ef02' % cur_part,
-                    dev
-                )
-                endsector = self.run(
-                    tools.SGDISK,
-                    '-E',
-                    dev,
-                    output=True).strip()
-                cur_part += 1
-                self.run(
-                    tools.SGDISK,
-                    '-n', '%d:4096:%s' % (cur_part, endsector),
-                    dev
-                )
-            else:
-                # create single partition
-                cur_part += 1
-                self.run(
-                    tools.SGDISK,
-                    '-n', '%d' % cur_part,
-                    dev
-                )
-            if disk.fstype == 'ext4':
-                # format ext4
-                self.run(
-                    tools.MKFS_EXT4,
-                    '%sp%d' % (dev, cur_part)
-                )
-                mountpoint = '/provision/%s' % disk.mountpoint.lstrip('/')
-                if disk.mountpoint == '/':
-                    # set a filesystem label to aid grub configuration
-                    self.run(
-                        tools.TUNE2FS,
-                        '-L',
-                        'ROOTFS',
-                        '%sp%d' % (dev, cur_part)
-                    )
-                else:
-                    # create mountpoint
-                    os.makedirs(mountpoint)
-                self.run(
-                    tools.MOUNT,
-                    '%sp%d' % (dev, cur_part),
-                    mountpoint
-                )
-                self._cleanup.append([
-                    tools.UMOUNT,
-                    mountpoint,
-                ])
-                uuid = self.run(
-                    tools.BLKID,
-                    '-s',
-                    'UUID',
-                    '-o',
-                    'value',
-                    '%sp%d' % (dev, cur_part),
-                    output=True
-                ).strip()
-                self._uuid.setdefault('ext4', {})[disk.mountpoint] = uuid
-            elif disk.fstype == 'swap':
-                # set partition type to linux swap
-                self.run(
-                    tools.SGDISK,
-                    '-t',
-                    '%d:8200' % cur_part,
-                    dev
-                )
-                # format swap space
-                self.run(
-                    tools.MKSWAP,
-                    '-f',
-                    '%sp%d' % (dev, cur_part)
-                )
-                self.run(
+        for disk in self.domain.disks:
+            partition, _ = partitions[disk.alias]
+            if disk.fstype == 'swap':
+                await self.arun(
                     tools.SWAPON,
-                    '%sp%d' % (dev, cur_part)
+                    partition
                 )
                 self._cleanup.append([
                     tools.SWAPOFF,
-                    '%sp%d' % (dev, cur_part)
+                    partition
                 ])
-                uuid = self.run(
-                    tools.BLKID,
-                    '-s',
-                    'UUID',
-                    '-o',
-                    'value',
-                    '%sp%d' % (dev, cur_part),
-                    output=True
-                ).strip()
-                self._uuid.setdefault('swap', []).append(uuid)
-            else:
-                raise RuntimeError('Unsupported fstype %s' % disk.fstype)
+        if self._unsafe_io:
+            # write back everything fsync was skipped for, before unmounting
+            self._cleanup.append([
+                tools.SYNC
+            ])
+
+        # collect uuids in disk order, regardless of which finished first
+        self._uuid = {}
+        for disk in self.domain.disks:
+            _, fsuuid = partitions[disk.alias]
+            if disk.fstype in FILESYSTEMS:
+                self._uuid.setdefault(disk.fstype, {})[disk.mountpoint] = \
+                    fsuuid
+            elif disk.fstype == 'swap':
+                self._uuid.setdefault('swap', []).append(fsuuid)
+
+    async def _format_disk(self, disk, partitions):
+        """
+        Attach, partition and format a single disk
+
+        :param disk - Disk to format
+        :param partitions - dict to store partition device and uuid in,
+                            keyed by disk alias
+        """
+        dev = await self._connect_disk(disk)
+        cur_part, _ = await self._partition(disk, dev)
+        partition = '%sp%d' % (dev, cur_part)
+        if disk.fstype == 'ext4':
+            # format ext4
+            await self.arun(
+                tools.MKFS_EXT4,
+                *disk.mkfs_options,
+                partition
+            )
+            if disk.mountpoint == '/':
+                # set a filesystem label to aid grub configuration
+                await self.arun(
+                    tools.TUNE2FS,
+                    '-L',
+                    'ROOTFS',
+                    partition
+                )
+        elif disk.fstype == 'xfs':
+            # format xfs, set a filesystem label to aid grub configuration
+            label = ['-L', 'ROOTFS'] if disk.mountpoint == '/' else []
+            await self.arun(
+                tools.MKFS_XFS,
+                '-f',
+                *label,
+                *disk.mkfs_options,
+                partition
+            )
+        elif disk.fstype == 'swap':
+            # format swap space
+            await self.arun(
+                tools.MKSWAP,
+                '-f',
+                partition
+            )
+        else:
+            raise RuntimeError('Unsupported fstype %s' % disk.fstype)
+        partitions[disk.alias] = (partition, await self._blkid(partition))
+
+    async def _partition(self, disk, dev):
+        """
+        Create the partition table of a disk
+
+        Returns number and end sector of the data partition.
+
+        :param disk - Disk to partition
+        :param dev - Block device or image file of the disk
+        """
+        cur_part = 0
+        # create empty partition table
+        await self.arun(
+            tools.SGDISK,
+            '-o',
+            dev
+        )
+        endsector = int((await self.arun(
+            tools.SGDISK,
+            '-E',
+            dev,
+            output=True)).strip())
+        # On first disk, we create a bios boot partition
+        if disk.number == '0':
+            cur_part += 1
+            await self.arun(
+                tools.SGDISK,
+                '-n', '%d:%d:%d' % (cur_part, DATA_PART_START,
+                                    BOOT_PART_START - 1),
+                '-t', '%d:ef02' % cur_part,
+                dev
+            )
+            cur_part += 1
+            await self.arun(
+                tools.SGDISK,
+                '-n', '%d:%d:%d' % (cur_part, BOOT_PART_START, endsector),
+                dev
+            )
+        else:
+            # create single partition
+            cur_part += 1
+            await self.arun(
+                tools.SGDISK,
+                '-n', '%d:%d:%d' % (cur_part, DATA_PART_START, endsector),
+                dev
+            )
+        if disk.fstype == 'swap':
+            # set partition type to linux swap
+            await self.arun(
+                tools.SGDISK,
+                '-t',
+                '%d:8200' % cur_part,
+                dev
+            )
+        return cur_part, endsector
+
+    async def _connect_disk(self, disk):
+        """
+        Connect the image of a disk to a free nbd device
+
+        :param disk - Disk to connect
+        """
+        dev = self._nbd.allocate()
+        self._devices.append(dev)
+        if disk.number == '0':
+            self._bootdev = dev
+        options = list(NBD_OPTIONS[self._io_mode])
+        if self._compact and '--discard=unmap' not in options:
+            # unmap trimmed blocks in the image, so compaction drops them
+            options.append('--discard=unmap')
+        # "mount" qcow2 image file as block device
+        await self.arun(
+            tools.QEMU_NBD,
+            *options,
+            '-c',
+            dev,
+            disk.path
+        )
+        if self._io_mode == 'fast':
+            # write the image to stable storage once disconnected
+            self._cleanup.append([
+                tools.SYNC,
+                disk.path
+            ])
+        self._cleanup.append([
+            tools.QEMU_NBD,
+            '-d',
+            dev,
+        ])
+        if self._io_mode == 'fast':
+            # hand all buffered writes to qemu-nbd before disconnecting
+            self._cleanup.append([
+                tools.BLOCKDEV,
+                '--flushbufs',
+                dev
+            ])
+        return dev
+
+    async def _blkid(self, partition):
+        """
+        Filesystem UUID of a partition
+
+        :param partition - Partition device
+        """
+        return (await self.arun(
+            tools.BLKID,
+            '-s',
+            'UUID',
+            '-o',
+            'value',
+            partition,
+            output=True
+        )).strip()
 
     def _install(self):
         """
@@ -307,21 +1172,38 @@ class LinuxProvisioner(Provisioner):
         """
         LOG.info('Write fstab configuration')
         swap_lines = []
-        ext4_lines = []
-        for key, value in self._uuid.items():
-            fsckcount = 0
-            if key == 'swap':
-                for uuid in value:
-                    swap_lines.append("UUID=%s none swap defaults 0 0" % uuid)
-            elif key == 'ext4':
-                for mountpoint, uuid in sorted(value.items()):
-                    fsckcount += 1
-                    ext4_lines.append(
-                        "UUID=%s %s ext4 rw,relatime,data=ordered 0 %d" % (
-                            uuid, mountpoint, fsckcount
-                        )
-                    )
-        self.writetargetfile('/etc/fstab', ext4_lines + swap_lines, 'a')
+        fs_lines = []
+        for uuid in self._uuid.get('swap', []):
+            swap_lines.append("UUID=%s none swap defaults 0 0" % uuid)
+        for disk in self.domain.mounts:
+            # root is checked first, xfs is checked at mount time, not by fsck
+            if disk.fstype == 'xfs':
+                fsckpass = 0
+            elif disk.mountpoint == '/':
+                fsckpass = 1
+            else:
+                fsckpass = 2
+            fs_lines.append(
+                "UUID=%s %s %s %s 0 %d" % (
+                    self._uuid[disk.fstype][disk.mountpoint],
+                    disk.mountpoint,
+                    disk.fstype,
+                    disk.mount_options,
+                    fsckpass
+                )
+            )
+        # the fstab of a template lists the filesystems of the template
+        mode = 'w' if self._template is not None else 'a'
+        self.writetargetfile('/etc/fstab', fs_lines + swap_lines, mode)
+        if any(disk.driver.get('discard') == 'unmap'
+               for disk in self.domain.disks):
+            # discards were requested explicitly, trim periodically, so
+            # thin volumes shrink again
+            self.runchroot(
+                'systemctl',
+                'enable',
+                'fstrim.timer'
+            )
 
     def _boot_config(self):
         """
@@ -329,6 +1211,47 @@ class LinuxProvisioner(Provisioner):
         """
         raise NotImplementedError
 
+    def _bootloader(self):
+        """
+        Install the bootloader on the boot device
+        """
+        raise NotImplementedError
+
+    def _identity_config(self):
+        """
+        Reset machine-id and ssh host keys inherited from a template
+        """
+        LOG.info('Reset machine identity')
+        self._reset_identity()
+
+    def _reset_identity(self):
+        """
+        Give the guest its own machine-id and ssh host keys
+
+        Used for guests restored from a cached bootstrap or cloned from a
+        template, which would share them otherwise.
+        """
+        # an empty machine-id is generated again on first boot
+        self.runchroot(
+            'truncate',
+            '-s', '0',
+            '/etc/machine-id'
+        )
+        if os.path.isdir('%s/var/lib/dbus' % self.target):
+            self.runchroot(
+                'ln',
+                '-sf',
+                '/etc/machine-id',
+                '/var/lib/dbus/machine-id'
+            )
+        for key in glob.glob('%s/etc/ssh/ssh_host_*' % self.target):
+            self._executor.remove(key)
+        if os.path.exists('%s/usr/bin/ssh-keygen' % self.target):
+            self.runchroot(
+                'ssh-keygen',
+                '-A'
+            )
+
     def _access_config(self):
         """
         Domain access configuration such as sudo/ssh and local users
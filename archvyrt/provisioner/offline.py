@@ -0,0 +1,371 @@
+"""archvyrt offline engine provisioner module"""
+
+# stdlib
+import asyncio
+import functools
+import logging
+import threading
+from uuid import uuid4
+
+# archvyrt
+import archvyrt.tools as tools
+from archvyrt.engine import Engine
+from archvyrt.plan import FILESYSTEMS
+from .base import BOOT_PART_START
+from .base import DATA_PART_START
+from .base import LinuxProvisioner
+
+LOG = logging.getLogger(__name__)
+
+# minimum size of a tmpfs staging directory for the offline engine, if the
+# filesystems of a guest do not fit into a smaller one, it is staged on disk
+STAGING_TMPFS_MIN = 4 * 1073741824
+
+# tmpfs staging sizes reserved by concurrent provisioners, by staging path
+STAGING_TMPFS_RESERVED = {}
+STAGING_TMPFS_LOCK = threading.Lock()
+
+
+class OfflineProvisioner(LinuxProvisioner):
+    """
+    Linux Provisioner, building guests with the offline engine on request
+
+    Guests using the offline engine are installed into a staging directory
+    instead of nbd attached disks, their disk images are built from the
+    staging tree once provisioned.
+    """
+
+    @property
+    def staging(self):
+        """
+        Staging directory of the offline engine
+        """
+        return '%s.staging' % self.target
+
+    def _phases(self):
+        """
+        Provisioning phases and the phases they depend on
+
+        The offline engine builds the disk images last.
+        """
+        phases = super()._phases()
+        if self.offline:
+            phases += (('build_images', ('finalize',)),)
+        return phases
+
+    async def _prepare_disks(self):
+        """
+        Format and mount disks, or prepare the staging directory
+        """
+        if self.offline:
+            LOG.info('Prepare staging directory')
+            await self._prepare_staging()
+            return
+        await super()._prepare_disks()
+
+    def _detach_disks(self, ignore_errors=False):
+        """
+        Unmount and disconnect all disks, release the staging tmpfs
+
+        :param ignore_errors - Log failing commands and continue
+        """
+        try:
+            super()._detach_disks(ignore_errors)
+        finally:
+            self._release_staging_tmpfs()
+
+    async def _prepare_staging(self):
+        """
+        Prepare the staging directory of the offline engine
+
+        The guest is staged on tmpfs if enough memory is available, the
+        staging root is bind-mounted to the target, so the target is a
+        mountpoint as for the nbd engine. Filesystem UUIDs are generated up
+        front, they are applied when the images are built.
+        """
+        self._executor.makedirs(self.staging, exist_ok=True)
+        self._cleanup.append([
+            tools.RM,
+            '-rf',
+            '--one-file-system',
+            self.staging
+        ])
+        size = self._reserve_staging_tmpfs()
+        if size:
+            LOG.info('Stage %s on tmpfs (%d MB)', self.domain.fqdn,
+                     size // 1048576)
+            await self.arun(
+                tools.MOUNT,
+                '-t', 'tmpfs',
+                '-o', 'size=%d,mode=0755' % size,
+                'archvyrt',
+                self.staging
+            )
+            self._cleanup.append([
+                tools.UMOUNT,
+                self.staging
+            ])
+        else:
+            LOG.info('Stage %s on disk', self.domain.fqdn)
+        root = '%s/root' % self.staging
+        self._executor.makedirs(root, exist_ok=True)
+        await self.arun(
+            tools.MOUNT,
+            '--bind',
+            root,
+            self.target
+        )
+        self._cleanup.append([
+            tools.UMOUNT,
+            self.target
+        ])
+        for disk in self.domain.mounts:
+            if disk.mountpoint != '/':
+                self._executor.makedirs(
+                    '%s/%s' % (self.target, disk.mountpoint.lstrip('/')),
+                    exist_ok=True
+                )
+        self._uuid = {}
+        for disk in self.domain.disks:
+            if disk.fstype in FILESYSTEMS:
+                self._uuid.setdefault(disk.fstype, {})[disk.mountpoint] = \
+                    str(uuid4())
+            elif disk.fstype == 'swap':
+                self._uuid.setdefault('swap', []).append(str(uuid4()))
+
+    def _reserve_staging_tmpfs(self):
+        """
+        Reserve the size of a tmpfs for staging, or 0 to stage on disk
+
+        The tmpfs is sized for the filesystems of the guest. Concurrent
+        provisioners share half of the available memory, a guest is staged
+        on disk if its filesystems do not fit into its share and the share
+        is below the minimum tmpfs size.
+        """
+        capacity = sum(int(disk.capacity) for disk in self.domain.disks
+                       if disk.fstype in FILESYSTEMS)
+        with STAGING_TMPFS_LOCK:
+            available = self._available_memory() // 2 - sum(
+                STAGING_TMPFS_RESERVED.values()
+            )
+            size = min(capacity, available)
+            if size < capacity and size < STAGING_TMPFS_MIN:
+                return 0
+            STAGING_TMPFS_RESERVED[self.staging] = size
+        return size
+
+    def _release_staging_tmpfs(self):
+        """
+        Release the tmpfs size reserved for staging
+        """
+        with STAGING_TMPFS_LOCK:
+            STAGING_TMPFS_RESERVED.pop(self.staging, None)
+
+    @staticmethod
+    def _available_memory():
+        """
+        Memory available on the host in bytes
+        """
+        try:
+            with open('/proc/meminfo') as meminfo:
+                for line in meminfo:
+                    if line.startswith('MemAvailable:'):
+                        return int(line.split()[1]) * 1024
+        except OSError:
+            pass
+        return 0
+
+    async def _build_images(self):
+        """
+        Build the disk images of the offline engine from the staging tree
+
+        Each filesystem is created and populated in a single pass by
+        mkfs.ext4 directly inside a partitioned raw image, the bootloader is
+        installed via a loop device, then the raw images are converted to
+        the qcow2 volumes.
+        """
+        LOG.info('Build disk images')
+        # move nested filesystems out of the tree of their parent, deepest
+        # first, leaving empty mountpoints behind
+        sources = {}
+        for disk in reversed(self.domain.mounts):
+            if disk.mountpoint == '/':
+                sources[disk.alias] = '%s/root' % self.staging
+                continue
+            sources[disk.alias] = '%s/%s' % (self.staging, disk.alias)
+            subtree = '%s/root/%s' % (self.staging,
+                                      disk.mountpoint.lstrip('/'))
+            await self.arun(
+                tools.MV,
+                '-T',
+                subtree,
+                sources[disk.alias]
+            )
+            self._executor.makedirs(subtree)
+
+        engine = Engine(concurrency=self._concurrency, cancel=self._cancel)
+        for disk in self.domain.disks:
+            engine.add(disk.alias, functools.partial(
+                self._build_image, disk, sources.get(disk.alias)
+            ))
+        await engine.run()
+
+        await self._install_bootloader_offline()
+
+        await asyncio.gather(*(
+            self._convert_image(disk) for disk in self.domain.disks
+        ))
+
+    async def _build_image(self, disk, source):
+        """
+        Build the partitioned raw image of a single disk
+
+        :param disk - Disk to build
+        :param source - Staging directory holding the disks filesystem tree
+        """
+        image = '%s.raw' % disk.path
+        self._cleanup.append([
+            tools.RM,
+            '-f',
+            image
+        ])
+        await self.arun(
+            tools.QEMU_IMG,
+            'create',
+            '-q',
+            '-f', 'raw',
+            image,
+            disk.capacity
+        )
+        cur_part, endsector = await self._partition(disk, image)
+        start = BOOT_PART_START if cur_part == 2 else DATA_PART_START
+        offset = start * 512
+        size = (endsector - start + 1) * 512
+        if disk.fstype == 'ext4':
+            options = list(disk.mkfs_options)
+            if '-E' in options:
+                index = options.index('-E') + 1
+                options[index] = '%s,offset=%d' % (options[index], offset)
+            else:
+                options.extend(['-E', 'offset=%d' % offset])
+            if disk.mountpoint == '/':
+                # set a filesystem label to aid grub configuration
+                options.extend(['-L', 'ROOTFS'])
+            await self.arun(
+                tools.MKFS_EXT4,
+                '-q',
+                '-U', self._uuid['ext4'][disk.mountpoint],
+                '-d', source,
+                *options,
+                image,
+                '%dk' % (size // 1024)
+            )
+        elif disk.fstype == 'swap':
+            # mkswap cannot write at an offset, only the swap header is
+            # copied into the partition
+            swap = '%s.swap' % image
+            await self.arun(
+                tools.QEMU_IMG,
+                'create',
+                '-q',
+                '-f', 'raw',
+                swap,
+                str(size)
+            )
+            swap_index = [d for d in self.domain.disks
+                          if d.fstype == 'swap'].index(disk)
+            await self.arun(
+                tools.MKSWAP,
+                '-f',
+                '-U', self._uuid['swap'][swap_index],
+                swap
+            )
+            await self.arun(
+                tools.DD,
+                'if=%s' % swap,
+                'of=%s' % image,
+                'bs=%d' % offset,
+                'count=1',
+                'seek=1',
+                'conv=notrunc'
+            )
+            self._executor.remove(swap)
+        else:
+            raise RuntimeError('Unsupported fstype %s' % disk.fstype)
+
+    async def _install_bootloader_offline(self):
+        """
+        Install the bootloader into the raw image of the boot disk
+
+        The images of the boot and root disks are attached as loop devices,
+        the root filesystem is mounted over the staging tree at the target
+        while installing.
+        """
+        devices = {}
+        try:
+            for disk in self.domain.disks:
+                if disk.number != '0' and disk.mountpoint != '/':
+                    continue
+                devices[disk.alias] = (await self.arun(
+                    tools.LOSETUP,
+                    '--find',
+                    '--show',
+                    '--partscan',
+                    '%s.raw' % disk.path,
+                    output=True
+                )).strip()
+                if disk.number == '0':
+                    self._bootdev = devices[disk.alias]
+                if disk.mountpoint == '/':
+                    root = '%sp%d' % (devices[disk.alias],
+                                      2 if disk.number == '0' else 1)
+            await self.arun(
+                tools.MOUNT,
+                root,
+                self.target
+            )
+            try:
+                await asyncio.get_running_loop().run_in_executor(
+                    None, self._bootloader
+                )
+            finally:
+                await self.arun(
+                    tools.UMOUNT,
+                    self.target
+                )
+        finally:
+            for dev in devices.values():
+                await self.arun(
+                    tools.LOSETUP,
+                    '-d',
+                    dev
+                )
+            self._bootdev = None
+
+    async def _convert_image(self, disk):
+        """
+        Convert the raw image of a disk to its qcow2 volume
+
+        :param disk - Disk to convert
+        """
+        image = '%s.raw' % disk.path
+        preallocation = disk.preallocation
+        if preallocation == 'sparse' or (
+                self._compact and preallocation == 'metadata'):
+            preallocation = 'off'
+        # images built offline hold no deleted data, they are compacted by
+        # converting them sparse
+        compress = []
+        if self._compact == 'compressed' and preallocation == 'off':
+            compress = ['-c']
+        await self.arun(
+            tools.QEMU_IMG,
+            'convert',
+            '-f', 'raw',
+            '-O', 'qcow2',
+            '-o', 'preallocation=%s' % preallocation,
+            *compress,
+            image,
+            disk.path
+        )
+        self._executor.remove(image)
@@ -2,25 +2,38 @@
 
 # stdlib
 import logging
-import os
 # archvyrt
 import archvyrt.tools as tools
-from .base import LinuxProvisioner
+from .offline import OfflineProvisioner
 
 LOG = logging.getLogger(__name__)
 
 
-class UbuntuProvisioner(LinuxProvisioner):
+class UbuntuProvisioner(OfflineProvisioner):
     """
     Ubuntu Provisioner
     """
 
+    PACKAGE_CACHE = '/var/cache/apt/archives'
+
+    # placed before debootstrap, so dpkg skips fsync from the first package
+    UNSAFE_IO_FILES = {
+        '/etc/dpkg/dpkg.cfg.d/archvyrt-unsafe-io': ['force-unsafe-io'],
+    }
+
     def _install(self):
         """
         Ubuntu base installation
         """
         LOG.info('Do Ubuntu installation')
+        self.bootstrap('bionic', self.packages, self._debootstrap)
+
+    def _debootstrap(self):
+        """
+        Bootstrap Ubuntu base system using debootstrap
+        """
         apt_env = {'DEBIAN_FRONTEND': "noninteractive"}
+        apt_env.update(self.unsafe_io_env)
         self.run(
             tools.DEBOOTSTRAP,
             'bionic',
@@ -32,6 +45,45 @@ class UbuntuProvisioner(LinuxProvisioner):
             'update',
             add_env=apt_env
         )
+        self.runchroot(
+            'apt-get',
+            '-qy',
+            'install',
+            *self.packages,
+            add_env=apt_env
+        )
+
+    def _packages(self):
+        """
+        Packages required, by provisioning phase
+        """
+        packages = super()._packages()
+        packages.update({
+            'boot_config': ['grub-pc', 'linux-image-virtual'],
+            'access_config': ['ssh'],
+        })
+        packages.setdefault('network_config', []).append('ifupdown')
+        return packages
+
+    def _package_files(self):
+        """
+        Package cache filename prefixes of all packages installed in the guest
+        """
+        prefixes = []
+        for line in self.runchroot(
+                'dpkg-query',
+                '-W',
+                '-f',
+                '${Package} ${Version} ${Architecture}\n',
+                output=True
+        ).splitlines():
+            fields = line.split()
+            if len(fields) == 3:
+                # apt escapes the epoch separator in archive filenames
+                prefixes.append('%s_%s_%s' % (fields[0],
+                                              fields[1].replace(':', '%3a'),
+                                              fields[2]))
+        return prefixes
 
     def _network_config(self):
         """
@@ -40,13 +92,6 @@ class UbuntuProvisioner(LinuxProvisioner):
         LOG.info('Setup guest networking')
 
         apt_env = {'DEBIAN_FRONTEND': "noninteractive"}
-        self.runchroot(
-            'apt-get',
-            '-qy',
-            'install',
-            'ifupdown',
-            add_env=apt_env
-        )
         self.runchroot(
             'apt-get',
             '-qy',
@@ -63,6 +108,7 @@ class UbuntuProvisioner(LinuxProvisioner):
         )
         self.runchroot(
             'rm',
+            '-f',
             '/etc/resolv.conf',
         )
         # get provisioned interfaces
@@ -137,20 +183,6 @@ class UbuntuProvisioner(LinuxProvisioner):
         Domain bootloader, initrd configuration
         """
         LOG.info('Setup boot configuration')
-        apt_env = {'DEBIAN_FRONTEND': "noninteractive"}
-        self.runchroot(
-            'apt-get',
-            '-qy',
-            'install',
-            'grub-pc',
-            'linux-image-virtual',
-            add_env=apt_env
-        )
-        self.runchroot(
-            'grub-install',
-            '--target=i386-pc',
-            '/dev/nbd0'
-        )
         # Enable serial console
         self.runchroot(
             'systemctl',
@@ -165,6 +197,29 @@ class UbuntuProvisioner(LinuxProvisioner):
             's/^\(GRUB_CMDLINE_LINUX_DEFAULT=\).*/\\1""/',
             '/etc/default/grub'
         )
+        # written per guest, the kernel may be restored from a cached
+        # bootstrap with an older module list
+        self.writetargetfile(
+            '/etc/initramfs-tools/modules',
+            ['virtio_balloon']
+        )
+        self.runchroot(
+            'update-initramfs',
+            '-u'
+        )
+        # the offline engine installs the bootloader once the image is built
+        if not self.offline:
+            self._bootloader()
+
+    def _bootloader(self):
+        """
+        Install grub on the boot device
+        """
+        self.runchroot(
+            'grub-install',
+            '--target=i386-pc',
+            self.bootdev
+        )
         self.runchroot(
             'update-grub',
         )
@@ -176,7 +231,7 @@ class UbuntuProvisioner(LinuxProvisioner):
             '-e',
             # pylint: disable=anomalous-backslash-in-string
             's/vmlinuz-\(.*\) root=[^ ]*/vmlinuz-\\1 root=UUID=%s/' %
-            self._uuid['ext4']['/'],
+            self.rootuuid,
             '%s/boot/grub/grub.cfg' % self.target
         )
 
@@ -185,14 +240,6 @@ class UbuntuProvisioner(LinuxProvisioner):
         Domain access configuration such as sudo/ssh and local users
         """
         LOG.info('Setup ssh/local user access')
-        apt_env = {'DEBIAN_FRONTEND': "noninteractive"}
-        self.runchroot(
-            'apt-get',
-            '-qy',
-            'install',
-            'ssh',
-            add_env=apt_env
-        )
         if self.domain.password:
             self.runchroot(
                 'usermod',
@@ -206,7 +253,7 @@ class UbuntuProvisioner(LinuxProvisioner):
                 authorized_keys.append(
                     "%s %s %s" % (value['type'], value['key'], key)
                 )
-            os.mkdir('%s/root/.ssh' % self.target)
+            self.makedirstarget('/root/.ssh')
             self.writetargetfile(
                 '/root/.ssh/authorized_keys',
                 authorized_keys
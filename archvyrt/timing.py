@@ -0,0 +1,111 @@
+"""archvyrt timing module"""
+
+# stdlib
+import contextlib
+import contextvars
+import json
+import logging
+import threading
+import time
+
+LOG = logging.getLogger(__name__)
+
+
+class TimingReport:
+    """
+    Timing of provisioning phases and external commands
+    """
+
+    def __init__(self, definition):
+        """
+        Initialize timing report
+
+        :param definition - Path to VM definition file being provisioned
+        """
+        self.definition = definition
+        self.domain = None
+        self.libvirt_calls = None
+        self.io_mode = None
+        self.unsafe_io = None
+        self.reclaimed = None
+        self._start = time.monotonic()
+        self._phases = []
+        self._commands = []
+        self._current = contextvars.ContextVar('phase', default=None)
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """
+        Context manager timing a provisioning phase
+
+        :param name - Name of the phase
+        """
+        token = self._current.set(name)
+        start = time.monotonic()
+        status = 'failed'
+        try:
+            yield
+            status = 'ok'
+        finally:
+            wall = time.monotonic() - start
+            self._current.reset(token)
+            with self._lock:
+                self._phases.append({
+                    'name': name,
+                    'wall': wall,
+                    'status': status,
+                })
+            LOG.debug('Phase %s %s after %.2fs', name, status, wall)
+
+    def command(self, cmds, wall, cpu_user, cpu_system, returncode):
+        """
+        Record timing of an external command
+
+        :param cmds - Command line
+        :param wall - Wall clock time in seconds
+        :param cpu_user - User CPU time of the child in seconds
+        :param cpu_system - System CPU time of the child in seconds
+        :param returncode - Exit status of the command
+        """
+        with self._lock:
+            self._commands.append({
+                'command': list(cmds),
+                'phase': self._current.get(),
+                'wall': wall,
+                'cpu_user': cpu_user,
+                'cpu_system': cpu_system,
+                'returncode': returncode,
+            })
+
+    def as_dict(self):
+        """
+        Machine-readable representation of this report
+        """
+        with self._lock:
+            return {
+                'definition': self.definition,
+                'domain': self.domain,
+                'libvirt_calls': self.libvirt_calls,
+                'io_mode': self.io_mode,
+                'unsafe_io': self.unsafe_io,
+                'reclaimed': self.reclaimed,
+                'flush': sum(phase['wall'] for phase in self._phases
+                             if phase['name'] == 'flush'),
+                'wall': time.monotonic() - self._start,
+                'phases': list(self._phases),
+                'commands': list(self._commands),
+            }
+
+    @staticmethod
+    def write(path, data):
+        """
+        Write timing data as JSON
+
+        :param path - Path of the report file
+        :param data - Data to write (see as_dict())
+        """
+        LOG.info('Write timing report %s', path)
+        with open(path, 'w') as fobj:
+            json.dump(data, fobj, indent=2)
+            fobj.write('\n')
@@ -5,15 +5,33 @@ this module lists all external commands used by archvyrt
 
 ARCH_CHROOT = '/usr/bin/arch-chroot'
 BLKID = '/usr/bin/blkid'
+BLOCKDEV = '/usr/bin/blockdev'
+CHMOD = '/usr/bin/chmod'
+CHOWN = '/usr/bin/chown'
+CP = '/usr/bin/cp'
+DD = '/usr/bin/dd'
 DEBOOTSTRAP = '/usr/bin/debootstrap'
+E2FSCK = '/usr/bin/e2fsck'
+FSTRIM = '/usr/bin/fstrim'
+LIBEATMYDATA = '/usr/lib/libeatmydata.so'
+LOSETUP = '/usr/bin/losetup'
 MKFS_EXT4 = '/usr/bin/mkfs.ext4'
+MKFS_XFS = '/usr/bin/mkfs.xfs'
 MKSWAP = '/usr/bin/mkswap'
 MOUNT = '/usr/bin/mount'
+MV = '/usr/bin/mv'
 PACSTRAP = '/usr/bin/pacstrap'
+QEMU_IMG = '/usr/bin/qemu-img'
 QEMU_NBD = '/usr/bin/qemu-nbd'
+RESIZE2FS = '/usr/bin/resize2fs'
+RM = '/usr/bin/rm'
 SED = '/usr/bin/sed'
 SGDISK = '/usr/bin/sgdisk'
 SWAPON = '/usr/bin/swapon'
 SWAPOFF = '/usr/bin/swapoff'
+SYNC = '/usr/bin/sync'
+TAR = '/usr/bin/tar'
 TUNE2FS = '/usr/bin/tune2fs'
 UMOUNT = '/usr/bin/umount'
+XFS_ADMIN = '/usr/bin/xfs_admin'
+XFS_GROWFS = '/usr/bin/xfs_growfs'
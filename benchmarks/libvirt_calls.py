@@ -0,0 +1,109 @@
+#!/usr/bin/python3
+
+"""
+Benchmark libvirt calls made to define domains.
+
+Domains with two disks and a network interface are defined against the
+libvirt test driver (test:///default) and started, as the plain provisioner
+does. The calls counted per domain are compared with the calls counted on
+the shared connection.
+
+The test driver only knows the "test" domain type and its default machine
+type, so both are adjusted in the XML passed to defineXML. The libvirt
+version and driver are printed along with the counts.
+
+Usage: python3 benchmarks/libvirt_calls.py [--domains N] [--connect URI]
+"""
+
+import argparse
+import time
+import xml.etree.ElementTree as ElementTree
+
+from archvyrt.domain import Domain
+from archvyrt.libvirt import LibvirtConnection
+from archvyrt.plan import compile_definition
+
+
+class TestDriverConnection(LibvirtConnection):
+    """
+    Shared connection, adjusting domain XML for the libvirt test driver
+    """
+
+    def call(self, method, *args):
+        if method == 'defineXML':
+            domain_xml = ElementTree.fromstring(args[0])
+            domain_xml.attrib['type'] = 'test'
+            domain_xml.find('os/type').attrib.pop('machine', None)
+            args = (ElementTree.tostring(domain_xml, encoding='unicode'),)
+        return super().call(method, *args)
+
+
+def definition(number, pool):
+    """
+    VM definition of a benchmark domain
+    """
+    return {
+        'guesttype': 'plain',
+        'hostname': 'bench%05d' % number,
+        'fqdn': 'bench%05d.example.org' % number,
+        'memory': 512,
+        'vcpu': 1,
+        'disks': {
+            'disk0': {'pool': pool, 'capacity': 1, 'target': 'vda',
+                      'preallocation': 'sparse'},
+            'disk1': {'pool': pool, 'capacity': 1, 'target': 'vdb',
+                      'preallocation': 'sparse'},
+        },
+        'networks': {
+            'eth0': {'bridge': 'br0'},
+        },
+    }
+
+
+def main():
+    """
+    Run the benchmark and print the calls counted
+    """
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--domains', default=100, type=int,
+                        help='Number of domains to define')
+    parser.add_argument('--connect', default='test:///default',
+                        help='Libvirt connection URI')
+    parser.add_argument('--pool', default='default-pool',
+                        help='Storage pool to create volumes in')
+    args = parser.parse_args()
+
+    conn = TestDriverConnection(args.connect)
+    # pylint: disable=protected-access
+    LibvirtConnection._pool[args.connect] = conn
+    # not counted, these calls are made on the underlying connection
+    version = conn.conn.getLibVersion()
+    print('libvirt %d.%d.%d, %s driver (%s)' % (
+        version // 1000000,
+        version // 1000 % 1000,
+        version % 1000,
+        conn.conn.getType(),
+        args.connect
+    ))
+
+    start = time.perf_counter()
+    calls = 0
+    for number in range(args.domains):
+        plan = compile_definition(definition(number, args.pool))
+        domain = Domain(plan, args.connect)
+        domain.autostart(True)
+        domain.start()
+        calls += domain.rpc_count
+    elapsed = time.perf_counter() - start
+    print('%d domains in %.2fs, %.1f libvirt calls per domain counted by '
+          'the domains, %.1f counted by the connection' % (
+              args.domains,
+              elapsed,
+              calls / args.domains,
+              conn.rpc_count / args.domains
+          ))
+    LibvirtConnection.close_all()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+#!/usr/bin/python3
+
+"""
+Benchmark building and serializing libvirt domain definitions.
+
+Each domain is built with a network interface and a rng device, then
+serialized twice: compact (as passed to libvirt) and indented (as logged
+and printed). The minidom mode serializes the indented XML by re-parsing it
+with minidom, as archvyrt did before serializing straight from ElementTree.
+
+Usage: python3 benchmarks/xml_serialization.py [--domains N] [--minidom]
+"""
+
+import argparse
+import time
+import xml.dom.minidom
+import xml.etree.ElementTree as ElementTree
+
+from archvyrt.libvirt import LibvirtDomain
+from archvyrt.libvirt import LibvirtNetwork
+from archvyrt.libvirt import LibvirtRng
+
+
+def minidom_xml(et_xml):
+    """
+    Indented XML, serialized by re-parsing with minidom
+    """
+    reparsed = xml.dom.minidom.parseString(
+        ElementTree.tostring(et_xml, encoding='unicode')
+    )
+    return reparsed.toprettyxml(indent='  ').strip()
+
+
+def build(number):
+    """
+    Build the definition of a domain
+    """
+    domain = LibvirtDomain('bench%05d.example.org' % number)
+    domain.machine = 'q35'
+    domain.memory = 2048
+    domain.vcpu = 2
+    domain.set_memory_profile('overcommit')
+    domain.set_cpu('host-passthrough')
+    network = LibvirtNetwork('eth0', bridge='br0', vlan=100, queues=2,
+                             rx_queue_size=1024)
+    domain.add_device(network.xml)
+    domain.add_device(LibvirtRng().xml)
+    return domain
+
+
+def main():
+    """
+    Run the benchmark and print the time taken
+    """
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--domains', default=10000, type=int,
+                        help='Number of domains to build')
+    parser.add_argument('--minidom', action='store_true',
+                        help='Serialize indented XML with minidom')
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    size = 0
+    for number in range(args.domains):
+        domain = build(number)
+        size += len(domain.compact())
+        if args.minidom:
+            size += len(minidom_xml(domain.xml))
+        else:
+            size += len(str(domain))
+    elapsed = time.perf_counter() - start
+    print('%d domains (%s) in %.2fs, %.1f us per domain, %d bytes' % (
+        args.domains,
+        'minidom' if args.minidom else 'elementtree',
+        elapsed,
+        elapsed / args.domains * 1e6,
+        size
+    ))
+
+
+if __name__ == '__main__':
+    main()
@@ -36,7 +36,7 @@ setup(
     install_requires=[
         'libvirt-python'
     ],
-    python_requires='>=3.4',
+    python_requires='>=3.8',
     entry_points={
         'console_scripts': [
             'archvyrt = archvyrt:main',
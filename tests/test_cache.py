@@ -0,0 +1,153 @@
+"""archvyrt cache module tests"""
+
+# stdlib
+import os
+import shutil
+import tempfile
+import threading
+import time
+import types
+import unittest
+# archvyrt
+from archvyrt.cache import BootstrapCache
+from archvyrt.cache import PackageCache
+from archvyrt.provisioner.base import LinuxProvisioner
+
+
+class BootstrapCacheTest(unittest.TestCase):
+    """
+    Lookup and refresh of cached bootstraps
+    """
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp(prefix='archvyrt-cache-')
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def store(self, cache, key):
+        with open(cache.partial(key), 'w') as fobj:
+            fobj.write('archive')
+        cache.commit(key)
+
+    def test_miss_then_hit(self):
+        cache = BootstrapCache(self.path)
+        key = cache.key('archlinux', 'rolling', ['base'])
+        self.assertIsNone(cache.lookup(key))
+        self.store(cache, key)
+        self.assertEqual(cache.lookup(key), cache.archive(key))
+
+    def test_key_depends_on_packages(self):
+        cache = BootstrapCache(self.path)
+        self.assertNotEqual(cache.key('ubuntu', 'bionic', ['ssh']),
+                            cache.key('ubuntu', 'bionic', ['ssh', 'grub']))
+
+    def test_refresh_once_per_run(self):
+        self.store(BootstrapCache(self.path), 'entry')
+        cache = BootstrapCache(self.path, refresh=True)
+        self.assertIsNone(cache.lookup('entry'))
+        self.store(cache, 'entry')
+        self.assertEqual(cache.lookup('entry'), cache.archive('entry'))
+
+    def test_concurrent_lookup_waits_for_commit(self):
+        cache = BootstrapCache(self.path)
+        self.assertIsNone(cache.lookup('entry'))
+        results = []
+        waiter = threading.Thread(
+            target=lambda: results.append(cache.lookup('entry'))
+        )
+        waiter.start()
+        waiter.join(0.2)
+        self.assertTrue(waiter.is_alive())
+        self.store(cache, 'entry')
+        waiter.join(5)
+        self.assertEqual(results, [cache.archive('entry')])
+
+    def test_abandon_hands_miss_to_waiter(self):
+        cache = BootstrapCache(self.path)
+        self.assertIsNone(cache.lookup('entry'))
+        results = []
+        waiter = threading.Thread(
+            target=lambda: results.append(cache.lookup('entry'))
+        )
+        waiter.start()
+        cache.abandon('entry')
+        waiter.join(5)
+        self.assertEqual(results, [None])
+        self.assertFalse(os.path.exists(cache.archive('entry')))
+
+    def test_max_age_at_least_one_day(self):
+        with self.assertRaises(RuntimeError):
+            BootstrapCache(self.path, max_age=0)
+
+
+class PackageCacheTest(unittest.TestCase):
+    """
+    Package cache shared by concurrent provisioners
+    """
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp(prefix='archvyrt-pkgcache-')
+        self.cache = PackageCache(self.path)
+        self.active = {}
+        self.overlaps = []
+        self.lock = threading.Lock()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def provisioner(self, guesttype):
+        """
+        Provisioner sharing the package cache, without disks attached
+        """
+        provisioner = LinuxProvisioner.__new__(LinuxProvisioner)
+        # pylint: disable=protected-access
+        provisioner._domain = types.SimpleNamespace(guesttype=guesttype)
+        provisioner._cache = None
+        provisioner._pkgcache = self.cache
+        provisioner._unsafe_io = False
+        return provisioner
+
+    def download(self, guesttype):
+        """
+        Bootstrap recording concurrent downloads of the same guest type
+        """
+        with self.lock:
+            self.active[guesttype] = self.active.get(guesttype, 0) + 1
+            self.overlaps.append(dict(self.active))
+        time.sleep(0.1)
+        with self.lock:
+            self.active[guesttype] -= 1
+
+    def bootstrap(self, guesttypes):
+        threads = [
+            threading.Thread(target=self.provisioner(guesttype).bootstrap,
+                             args=('rolling', ['base'],
+                                   lambda g=guesttype: self.download(g)))
+            for guesttype in guesttypes
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(5)
+
+    def test_same_guesttype_serialized(self):
+        self.bootstrap(['ubuntu', 'ubuntu', 'ubuntu'])
+        self.assertEqual(len(self.overlaps), 3)
+        self.assertTrue(all(active['ubuntu'] == 1
+                            for active in self.overlaps))
+
+    def test_other_guesttypes_concurrent(self):
+        self.bootstrap(['ubuntu', 'archlinux'])
+        self.assertIn({'ubuntu': 1, 'archlinux': 1}, self.overlaps)
+
+    def test_lock_not_pruned(self):
+        with self.cache.lock('ubuntu'):
+            pass
+        PackageCache(self.path, max_size=0).prune()
+        self.assertTrue(os.path.exists(os.path.join(self.path,
+                                                    '.ubuntu.lock')))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,26 @@
+"""archvyrt command line tests"""
+
+# stdlib
+import argparse
+import unittest
+# archvyrt
+from archvyrt import positive_int
+
+
+class PositiveIntTest(unittest.TestCase):
+    """
+    Argument type of --jobs
+    """
+
+    def test_valid(self):
+        self.assertEqual(positive_int('4'), 4)
+
+    def test_invalid(self):
+        for value in ('0', '-1', 'four', '1.5'):
+            with self.subTest(value=value):
+                with self.assertRaises(argparse.ArgumentTypeError):
+                    positive_int(value)
+
+
+if __name__ == '__main__':
+    unittest.main()
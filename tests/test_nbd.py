@@ -0,0 +1,113 @@
+"""archvyrt nbd module tests"""
+
+# stdlib
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+# archvyrt
+from archvyrt.nbd import NbdAllocator
+
+# holds the lock file passed as argument until stdin is closed
+HOLD_LOCK = (
+    'import fcntl, sys\n'
+    'lockfile = open(sys.argv[1], "w")\n'
+    'fcntl.flock(lockfile, fcntl.LOCK_EX)\n'
+    'print("locked", flush=True)\n'
+    'sys.stdin.read()\n'
+)
+
+
+class NbdAllocatorTest(unittest.TestCase):
+    """
+    Allocation of nbd devices on a fake sysfs
+    """
+
+    def setUp(self):
+        self.sysfs = tempfile.mkdtemp(prefix='archvyrt-sysfs-')
+        self.lock_dir = tempfile.mkdtemp(prefix='archvyrt-lock-')
+        # listed out of numeric order on purpose
+        for number in (10, 2, 1, 0):
+            os.makedirs(os.path.join(self.sysfs, 'block', 'nbd%d' % number))
+        os.makedirs(os.path.join(self.sysfs, 'block', 'loop0'))
+
+    def tearDown(self):
+        shutil.rmtree(self.sysfs)
+        shutil.rmtree(self.lock_dir)
+
+    def allocator(self):
+        return NbdAllocator(sysfs_root=self.sysfs, lock_dir=self.lock_dir)
+
+    def connect(self, name):
+        """
+        Report a client process attached to a device
+        """
+        with open(os.path.join(self.sysfs, 'block', name, 'pid'), 'w') as fobj:
+            fobj.write('4242\n')
+
+    def disconnect(self, name):
+        os.remove(os.path.join(self.sysfs, 'block', name, 'pid'))
+
+    def test_numeric_order(self):
+        allocator = self.allocator()
+        self.assertEqual([allocator.allocate() for _ in range(4)],
+                         ['/dev/nbd0', '/dev/nbd1', '/dev/nbd2', '/dev/nbd10'])
+        with self.assertRaises(RuntimeError):
+            allocator.allocate()
+
+    def test_skip_busy_device(self):
+        self.connect('nbd0')
+        self.assertEqual(self.allocator().allocate(), '/dev/nbd1')
+
+    def test_skip_locked_by_other_process(self):
+        lockfile = os.path.join(self.lock_dir, 'archvyrt-nbd0.lock')
+        holder = subprocess.Popen(
+            [sys.executable, '-c', HOLD_LOCK, lockfile],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            universal_newlines=True
+        )
+        try:
+            self.assertEqual(holder.stdout.readline().strip(), 'locked')
+            self.assertEqual(self.allocator().allocate(), '/dev/nbd1')
+        finally:
+            holder.stdin.close()
+            holder.wait()
+        self.assertEqual(self.allocator().allocate(), '/dev/nbd0')
+
+    def test_concurrent_allocators(self):
+        first = self.allocator()
+        second = self.allocator()
+        self.assertEqual(first.allocate(), '/dev/nbd0')
+        self.assertEqual(second.allocate(), '/dev/nbd1')
+
+    def test_release(self):
+        allocator = self.allocator()
+        other = self.allocator()
+        device = allocator.allocate()
+        self.assertEqual(other.allocate(), '/dev/nbd1')
+        allocator.release(device)
+        self.assertEqual(other.allocate(), device)
+        # releasing an unknown device is a no-op
+        allocator.release('/dev/nbd2')
+
+    def test_release_all(self):
+        allocator = self.allocator()
+        devices = [allocator.allocate() for _ in range(2)]
+        allocator.release_all()
+        other = self.allocator()
+        self.assertEqual([other.allocate() for _ in range(2)], devices)
+
+    def test_wait_disconnected(self):
+        allocator = self.allocator()
+        self.connect('nbd0')
+        with self.assertRaises(RuntimeError):
+            allocator.wait_disconnected('/dev/nbd0', timeout=0.1)
+        self.disconnect('nbd0')
+        allocator.wait_disconnected('/dev/nbd0', timeout=0.1)
+
+
+if __name__ == '__main__':
+    unittest.main()
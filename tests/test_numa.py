@@ -0,0 +1,143 @@
+"""archvyrt numa module tests"""
+
+# stdlib
+import os
+import shutil
+import tempfile
+import unittest
+# archvyrt
+from archvyrt.numa import NumaPlacer
+from archvyrt.numa import format_cpuset
+from archvyrt.numa import parse_cpuset
+from archvyrt.numa import pinned_cpus
+
+FIXTURES = os.path.join(os.path.dirname(__file__), 'fixtures')
+
+# free hugepages by node and size in KiB, as reported by sysfs
+FREE_HUGEPAGES = {
+    0: {2048: 512, 1048576: 0},
+    1: {2048: 1024, 1048576: 2},
+}
+
+
+class CpusetTest(unittest.TestCase):
+    """
+    Parsing and formatting of libvirt cpusets
+    """
+
+    def test_format_ranges(self):
+        self.assertEqual(format_cpuset([0, 1, 2, 4, 6, 7]), '0-2,4,6-7')
+
+    def test_format_unsorted(self):
+        self.assertEqual(format_cpuset({9, 3, 8, 2}), '2-3,8-9')
+
+    def test_format_single(self):
+        self.assertEqual(format_cpuset([5]), '5')
+
+    def test_format_empty(self):
+        self.assertEqual(format_cpuset([]), '')
+
+    def test_parse_exclusions(self):
+        self.assertEqual(parse_cpuset('0-3,^2,8'), {0, 1, 3, 8})
+
+    def test_roundtrip(self):
+        cpus = {0, 1, 2, 4, 6, 7, 12}
+        self.assertEqual(parse_cpuset(format_cpuset(cpus)), cpus)
+
+    def test_pinned_cpus(self):
+        domain_xml = (
+            '<domain><vcpu cpuset="0-1">4</vcpu><cputune>'
+            '<vcpupin vcpu="0" cpuset="4"/><vcpupin vcpu="1" cpuset="6-7"/>'
+            '</cputune></domain>'
+        )
+        self.assertEqual(pinned_cpus(domain_xml), {0, 1, 4, 6, 7})
+
+
+class NumaPlacerTest(unittest.TestCase):
+    """
+    Placement of domains on the nodes of the captured host
+    """
+
+    def setUp(self):
+        with open(os.path.join(FIXTURES, 'capabilities.xml')) as fobj:
+            self.capabilities = fobj.read()
+        self.sysfs = tempfile.mkdtemp(prefix='archvyrt-sysfs-')
+        for node, sizes in FREE_HUGEPAGES.items():
+            for size, free in sizes.items():
+                path = os.path.join(
+                    self.sysfs, 'devices', 'system', 'node', 'node%d' % node,
+                    'hugepages', 'hugepages-%dkB' % size
+                )
+                os.makedirs(path)
+                with open(os.path.join(path, 'free_hugepages'), 'w') as fobj:
+                    fobj.write('%d\n' % free)
+
+    def tearDown(self):
+        shutil.rmtree(self.sysfs)
+
+    def placer(self, pinned=()):
+        return NumaPlacer(self.capabilities, self.sysfs, pinned)
+
+    def test_nodes(self):
+        nodes = self.placer().nodes
+        self.assertEqual([node.id for node in nodes], [0, 1])
+        # sibling threads of a core are adjacent
+        self.assertEqual(nodes[0].cpus, (0, 2, 1, 3))
+        self.assertEqual(nodes[1].hugepages, {2048: 1024, 1048576: 2})
+
+    def test_prefer_node_with_most_free_hugepages(self):
+        placement = self.placer().place(2, 1024)
+        self.assertEqual(placement.node, 1)
+        self.assertEqual(placement.cpus, (4, 6))
+        self.assertEqual(placement.hugepage_size, 1048576)
+
+    def test_hugepage_size_divides_memory(self):
+        placement = self.placer().place(1, 512)
+        self.assertEqual(placement.node, 1)
+        self.assertEqual(placement.hugepage_size, 2048)
+
+    def test_skip_node_without_free_cpus(self):
+        placement = self.placer(pinned={4, 5, 6}).place(2, 512)
+        self.assertEqual(placement.node, 0)
+        self.assertEqual(placement.cpus, (0, 2))
+
+    def test_reserve_cpus_and_hugepages(self):
+        placer = self.placer()
+        first = placer.place(2, 2048)
+        second = placer.place(2, 2048)
+        self.assertEqual((first.node, first.hugepage_size), (1, 1048576))
+        self.assertEqual((second.node, second.hugepage_size), (1, 2048))
+        self.assertFalse(set(first.cpus) & set(second.cpus))
+        third = placer.place(1, 1024)
+        self.assertEqual(third.node, 0)
+
+    def test_out_of_cpus(self):
+        placer = self.placer(pinned=range(8))
+        with self.assertRaises(RuntimeError):
+            placer.place(1, 512)
+
+    def test_too_many_cpus(self):
+        with self.assertRaises(RuntimeError):
+            self.placer().place(5, 512)
+
+    def test_out_of_hugepages(self):
+        placer = self.placer()
+        with self.assertRaises(RuntimeError):
+            placer.place(1, 8192)
+        # a domain is backed by hugepages of a single size
+        with self.assertRaises(RuntimeError):
+            placer.place(1, 4096)
+        placer.place(1, 2048)
+        placer.place(1, 2048)
+        placer.place(1, 1024)
+        with self.assertRaises(RuntimeError):
+            placer.place(1, 2)
+
+    def test_missing_sysfs(self):
+        placer = NumaPlacer(self.capabilities, os.path.join(self.sysfs, 'x'))
+        with self.assertRaises(RuntimeError):
+            placer.place(1, 512)
+
+
+if __name__ == '__main__':
+    unittest.main()
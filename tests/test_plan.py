@@ -0,0 +1,237 @@
+"""archvyrt plan module tests"""
+
+# stdlib
+import copy
+import ipaddress
+import unittest
+import xml.etree.ElementTree as ElementTree
+# 3rd-party
+import libvirt
+# archvyrt
+from archvyrt.libvirt import LibvirtDomain
+from archvyrt.plan import check_plans
+from archvyrt.plan import compile_definition
+
+DEFINITION = {
+    'hostname': 'plan',
+    'fqdn': 'plan.example.org',
+    'guesttype': 'archlinux',
+    'vcpu': 2,
+    'memory': 1024,
+    'disks': {
+        'disk0': {'pool': 'hdd', 'capacity': 20, 'target': 'vda',
+                  'fstype': 'xfs', 'mountpoint': '/'},
+        'disk1': {'pool': 'hdd', 'capacity': 5, 'target': 'vdb',
+                  'fstype': 'ext4', 'mountpoint': '/var'},
+    },
+    'networks': {
+        'eth0': {'bridge': 'ovs0'},
+    },
+    'access': {'password': 'secret'},
+}
+
+# changes to the definition, by path, and the problem reported for them
+INVALID = (
+    ({'disks.disk00': {'pool': 'hdd', 'capacity': 1, 'target': 'vdc',
+                       'fstype': 'ext4', 'mountpoint': '/srv'}},
+     'number 0 used by multiple disks'),
+    ({'disks.disk1.mountpoint': '/var/../'},
+     'mountpoint / used by multiple disks'),
+    ({'networks.eth0.ipv4': {'address': 3232235777}},
+     'network eth0: ipv4 address must be a string, '
+     'got 3232235777'),
+    ({'networks.eth0.ipv4': {'address': '192.0.2.2/24', 'gateway': 1}},
+     'network eth0: ipv4 gateway must be a string, got 1'),
+    ({'networks.eth0.ipv6': {'dns': [None]}},
+     'network eth0: ipv6 dns must be a string, got None'),
+    ({'iothreads': True}, 'iothreads must be an integer, got True'),
+    ({'iothreads': False}, 'iothreads must be an integer, got False'),
+    ({'vcpu': True}, 'vcpu must be an integer, got True'),
+    ({'access.password': 1234}, 'access: password must be a string'),
+    ({'disks.disk1.driver': {'io': 'native'}},
+     'disk disk1: native io requires cache none or directsync'),
+    ({'template': {'domain': 'template.example.org'},
+      'disks.disk1.preallocation': 'full'},
+     'disk disk1: full preallocation cannot be combined with a template'),
+)
+
+
+def definition(**changes):
+    """
+    Copy of the definition, with values replaced by their dotted path
+    """
+    result = copy.deepcopy(DEFINITION)
+    for path, value in changes.items():
+        *parents, key = path.split('.')
+        target = result
+        for parent in parents:
+            target = target[parent]
+        target[key] = value
+    return result
+
+
+class CompileDefinitionTest(unittest.TestCase):
+    """
+    Compilation of VM definitions into plans
+    """
+
+    def problems(self, value):
+        with self.assertRaises(RuntimeError) as context:
+            compile_definition(value)
+        return str(context.exception).split('\n  ')[1:]
+
+    def test_invalid(self):
+        for changes, problem in INVALID:
+            with self.subTest(changes=changes):
+                self.assertIn(problem, self.problems(definition(**changes)))
+
+    def test_cores_not_reported_without_vcpu(self):
+        self.assertEqual(self.problems(definition(vcpu='two')),
+                         ["vcpu must be an integer, got 'two'"])
+
+    def test_mountpoint_normalized(self):
+        plan = compile_definition(definition(**{
+            'disks.disk1.mountpoint': '/var//log/'
+        }))
+        self.assertEqual([disk.mountpoint for disk in plan.mounts],
+                         ['/', '/var/log'])
+
+    def test_disk_number(self):
+        value = definition()
+        value['disks']['disk01'] = value['disks'].pop('disk1')
+        plan = compile_definition(value)
+        self.assertEqual([disk.number for disk in plan.disks], ['0', '1'])
+
+    def test_network_addresses(self):
+        plan = compile_definition(definition(**{
+            'networks.eth0.ipv6': {'address': '2001:db8::2/64',
+                                   'gateway': '2001:db8::1',
+                                   'dns': ['2001:db8::53']},
+        }))
+        network = plan.networks[0]
+        self.assertIsNone(network.ipv4_address)
+        self.assertEqual(network.ipv6_address,
+                         ipaddress.ip_interface('2001:db8::2/64'))
+        self.assertEqual(network.dns, (ipaddress.ip_address('2001:db8::53'),))
+
+    def test_machine_default(self):
+        self.assertEqual(compile_definition(definition()).machine, 'pc')
+        self.assertEqual(compile_definition(definition(machine='q35')).machine,
+                         'q35')
+
+    def test_driver_defaults_left_to_libvirt(self):
+        plan = compile_definition(definition(**{
+            'disks.disk1.driver': {'cache': 'none', 'discard': 'unmap'},
+        }))
+        self.assertEqual([dict(disk.driver) for disk in plan.disks],
+                         [{}, {'cache': 'none', 'discard': 'unmap'}])
+
+    def test_plan_immutable(self):
+        plan = compile_definition(definition())
+        with self.assertRaises(TypeError):
+            plan.definition['vcpu'] = 4
+        with self.assertRaises(TypeError):
+            plan.disks[0].driver['cache'] = 'unsafe'
+        with self.assertRaises(TypeError):
+            plan.cpu.features['vmx'] = 'require'
+        with self.assertRaises(TypeError):
+            plan.definition['disks']['disk0']['capacity'] = 1
+
+
+
+class FakeVolume:
+    """
+    Template volume of 1G
+    """
+
+    @staticmethod
+    def info():
+        return [0, 1073741824, 0]
+
+
+class FakeDomain:
+    """
+    Shut off template domain
+    """
+
+    def __init__(self, guesttype):
+        self._domain = LibvirtDomain('template.example.org')
+        if guesttype is not None:
+            self._domain.guesttype = guesttype
+        for target in ('vda', 'vdb'):
+            self._domain.add_device(ElementTree.fromstring(
+                '<disk><source file="/images/%s"/><target dev="%s"/></disk>'
+                % (target, target)
+            ))
+
+    @staticmethod
+    def isActive():
+        return 0
+
+    def XMLDesc(self, flags):  # pylint: disable=unused-argument
+        return self._domain.compact()
+
+
+class FakePool:
+    """
+    Storage pool of 1T without volumes
+    """
+
+    @staticmethod
+    def storageVolLookupByName(name):
+        raise libvirt.libvirtError('no volume %s' % name)
+
+    @staticmethod
+    def info():
+        return [0, 0, 0, 1024 * 1073741824]
+
+
+class FakeConnection:
+    """
+    Libvirt connection knowing the template domain only
+    """
+
+    def __init__(self, guesttype):
+        self._template = FakeDomain(guesttype)
+
+    def lookupByName(self, name):
+        if name == 'template.example.org':
+            return self._template
+        raise libvirt.libvirtError('no domain %s' % name)
+
+    @staticmethod
+    def storageVolLookupByPath(path):  # pylint: disable=unused-argument
+        return FakeVolume()
+
+    @staticmethod
+    def storagePoolLookupByName(name):  # pylint: disable=unused-argument
+        return FakePool()
+
+
+class CheckTemplateTest(unittest.TestCase):
+    """
+    Checks of templates against libvirt
+    """
+
+    def plan(self):
+        return compile_definition(definition(template={
+            'domain': 'template.example.org'
+        }))
+
+    def test_guesttype_matches(self):
+        check_plans(FakeConnection('archlinux'), [self.plan()])
+
+    def test_guesttype_mismatch(self):
+        with self.assertRaises(RuntimeError) as context:
+            check_plans(FakeConnection('ubuntu'), [self.plan()])
+        self.assertIn('template template.example.org has guesttype ubuntu, '
+                      'plan.example.org has archlinux', str(context.exception))
+
+    def test_guesttype_unknown(self):
+        with self.assertRaises(RuntimeError) as context:
+            check_plans(FakeConnection(None), [self.plan()])
+        self.assertIn('has guesttype unknown', str(context.exception))
+
+
+if __name__ == '__main__':
+    unittest.main()